@@ -25,6 +25,7 @@ find $BUILDDIR -name ".pyc" | xargs rm
 rm -rf $BUILDDIR/datastore/*
 rm -f $BUILDDIR/scavenger.ini 
 rm -rf $BUILDDIR/pexecenv/tasks
+rm -rf $BUILDDIR/benchmarks
 
 # Create the archive.
 tar cfvz $BUILDDIR.tar.gz $BUILDDIR
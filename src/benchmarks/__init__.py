@@ -0,0 +1,7 @@
+"""
+Benchmarks of the Scavenger daemon. The benchmarks run the surrogates in
+process against local stand-ins for Presence and the remote data store, so
+that no other nodes are needed. Run them from the source directory:
+
+    python -m benchmarks.run --help
+"""
@@ -0,0 +1,80 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-process stand-in for the datastore module. Handles owned by another
+store in the same process are resolved by calling that store directly.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from time import time
+
+class RemoteDataHandle(object):
+    def __init__(self, data_id, address):
+        super(RemoteDataHandle, self).__init__()
+        self.id = data_id
+        self.address = address
+
+# All stores in the process, by address.
+STORES = {}
+
+class RemoteDataStore(object):
+    DATA_TIMEOUT = 300.0
+
+    def __init__(self, address):
+        super(RemoteDataStore, self).__init__()
+        self.address = address
+        self.__data = {} # data id -> [data, expiry time]
+        self.__next_id = 0
+        self.__lock = allocate_lock()
+        STORES[address] = self
+
+    def store_data(self, data):
+        with self.__lock:
+            data_id = self.__next_id
+            self.__next_id += 1
+            self.__data[data_id] = [data, time() + RemoteDataStore.DATA_TIMEOUT]
+        return RemoteDataHandle(data_id, self.address)
+
+    def fetch_data(self, data_id):
+        with self.__lock:
+            try:
+                return self.__data[data_id][0]
+            except KeyError:
+                raise Exception('Unknown data id: %s'%data_id)
+
+    def retain(self, data_id, timeout = DATA_TIMEOUT):
+        with self.__lock:
+            if self.__data.has_key(data_id):
+                self.__data[data_id][1] = time() + timeout
+
+    def expire(self, data_id):
+        with self.__lock:
+            self.__data.pop(data_id, None)
+
+    def resolve_data_handle(self, handle, context = None):
+        try:
+            store = STORES[handle.address]
+        except KeyError:
+            raise Exception('Unknown data store: %s'%str(handle.address))
+        return store.fetch_data(handle.id)
+
+    def cleanup(self):
+        now = time()
+        with self.__lock:
+            for data_id, entry in self.__data.items():
+                if entry[1] < now:
+                    del self.__data[data_id]
@@ -0,0 +1,97 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-process stand-in for the presence module. All Presence instances in
+the process share one "network", so services registered by one instance
+are announced to the subscribers of all instances.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from copy import copy
+
+class PresenceService(object):
+    def __init__(self, name, port, data):
+        super(PresenceService, self).__init__()
+        self.name = name
+        self.port = port
+        self.data = data
+
+class _Network(object):
+    """The services and subscriptions of all Presence instances in the process."""
+
+    def __init__(self):
+        super(_Network, self).__init__()
+        self.services = {} # (node name, service name) -> PresenceService
+        self.subscribers = [] # (service name, callback)
+        self.lock = allocate_lock()
+        self.next_node = 0
+
+    def announce(self, node_name, service):
+        with self.lock:
+            callbacks = [callback for name, callback in self.subscribers if name == service.name]
+        for callback in callbacks:
+            callback(node_name, '127.0.0.1', copy(service))
+
+    def reset(self):
+        with self.lock:
+            self.services.clear()
+            self.subscribers = []
+
+NETWORK = _Network()
+
+def reset():
+    """Forgets all services and subscriptions, e.g., between benchmark runs."""
+    NETWORK.reset()
+
+class Presence(object):
+    def __init__(self, node_name = None):
+        super(Presence, self).__init__()
+        if node_name == None:
+            with NETWORK.lock:
+                node_name = 'node%i'%NETWORK.next_node
+                NETWORK.next_node += 1
+        self.__node_name = node_name
+
+    def connect(self):
+        pass
+
+    def get_node_name(self):
+        return self.__node_name
+
+    def register_service(self, service):
+        with NETWORK.lock:
+            NETWORK.services[(self.__node_name, service.name)] = service
+        NETWORK.announce(self.__node_name, service)
+
+    def update_service(self, service):
+        self.register_service(service)
+
+    def remove_service(self, service_name):
+        with NETWORK.lock:
+            NETWORK.services.pop((self.__node_name, service_name), None)
+
+    def subscribe(self, service_name, callback):
+        with NETWORK.lock:
+            NETWORK.subscribers.append((service_name, callback))
+            services = [(node, service) for (node, name), service in NETWORK.services.items()
+                        if name == service_name]
+        # Announce the services that are registered already.
+        for node, service in services:
+            callback(node, '127.0.0.1', copy(service))
+
+    def shutdown(self):
+        pass
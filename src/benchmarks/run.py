@@ -0,0 +1,275 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This executable script benchmarks the surrogates end-to-end: clients call
+the RPC server of a surrogate running in this process, with Presence and the
+remote data store replaced by local stand-ins. The results are written as
+JSON so that runs of different versions can be compared.
+
+Run it from the source directory, e.g.:
+
+    python -m benchmarks.run --cores 1,2 --concurrency 1,8 -o results.json
+"""
+
+from __future__ import with_statement
+from optparse import OptionParser
+from threading import Thread
+from thread import allocate_lock
+from time import time, sleep
+import subprocess
+import tempfile
+import platform
+import shutil
+import socket
+import json
+import sys
+import os
+
+import localpresence
+import localdatastore
+from workload import Workload, TASK_NAME, TASK_CODE, parse_mix, parse_list, percentile
+
+def install_standins():
+    """Makes the surrogates use the local stand-ins for Presence and the data store."""
+    sys.modules['presence'] = localpresence
+    sys.modules['datastore'] = localdatastore
+
+def source_version():
+    """Returns the git revision of the source tree, if it can be found."""
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        revision = process.communicate()[0].strip()
+        if process.returncode == 0:
+            return revision
+    except OSError:
+        pass
+    return None
+
+class Client(Thread):
+    """A client performing jobs on a surrogate until there are no more jobs."""
+
+    def __init__(self, address, jobs, lock, make_input, timeout):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.__address = address
+        self.__jobs = jobs
+        self.__lock = lock
+        self.__make_input = make_input
+        self.__timeout = timeout
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        # Imported here as the stand-ins must be installed first.
+        from frontends.peerrpc import PeerConnection
+        connection = PeerConnection(self.__address)
+        try:
+            while True:
+                with self.__lock:
+                    if len(self.__jobs) == 0:
+                        return
+                    job = self.__jobs.pop()
+                task_input = self.__make_input(job)
+                start = time()
+                try:
+                    connection.call('perform_task_intent', False)
+                    connection.call('perform_task', TASK_NAME, task_input, self.__timeout)
+                except Exception:
+                    self.errors += 1
+                    continue
+                self.latencies.append(time() - start)
+        finally:
+            connection.close()
+
+def run_benchmark(config, surrogate_class, cores, concurrency, workload, count, timeout):
+    """
+    Performs one benchmark run.
+    @rtype: dict
+    @return: The results of the run.
+    """
+    from frontends.peerrpc import PeerConnection
+
+    config.set_runtime('cpu', 'cores', str(cores))
+    localpresence.reset()
+    surrogate = surrogate_class()
+    server = Thread(target=surrogate.serve)
+    server.daemon = True
+    server.start()
+    try:
+        address = ('127.0.0.1', surrogate.rpc_server.get_address()[1])
+        connection = PeerConnection(address)
+        try:
+            if not connection.call('has_task', TASK_NAME):
+                connection.call('install_task', TASK_NAME, TASK_CODE)
+
+            # Prepare the payloads. Stored payloads are passed by handle.
+            rate = config.calibration.int_rate
+            payloads = {}
+            for _, size in workload.payloads:
+                payload = 'x' * int(size)
+                if workload.by_handle:
+                    payload = connection.call('store_data', payload)
+                payloads[int(size)] = payload
+            make_input = lambda (duration, size): (int(duration * rate), payloads[size], workload.output_size)
+
+            # Warm up every core with a short task.
+            for _ in range(0, cores):
+                connection.call('perform_task_intent', False)
+                connection.call('perform_task', TASK_NAME, (1, '', 0), timeout)
+            before = connection.call('get_stats')['cores']
+        finally:
+            connection.close()
+
+        # Run the clients.
+        jobs = workload.jobs(count)
+        requested = sum([duration for duration, _ in jobs])
+        jobs.reverse()
+        lock = allocate_lock()
+        clients = [Client(address, jobs, lock, make_input, timeout) for _ in range(0, concurrency)]
+        start = time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        wall = time() - start
+
+        connection = PeerConnection(address)
+        try:
+            after = connection.call('get_stats')['cores']
+        finally:
+            connection.close()
+    finally:
+        surrogate.shutdown()
+        server.join(5.0)
+        # Give the execution environment a moment to stop.
+        sleep(0.5)
+
+    # Compute the results.
+    latencies = []
+    errors = 0
+    for client in clients:
+        latencies.extend(client.latencies)
+        errors += client.errors
+    busy = []
+    executions = []
+    for name, (done, seconds) in after.items():
+        done_before, seconds_before = before.get(name, (0, 0.0))
+        executions.append(done - done_before)
+        busy.append(seconds - seconds_before)
+    # Cores that never performed a task count as idle.
+    busy.extend([0.0] * (cores - len(busy)))
+    executions.extend([0] * (cores - len(executions)))
+    return {'surrogate' : surrogate_class.__name__,
+            'cores' : cores,
+            'concurrency' : concurrency,
+            'tasks' : count,
+            'completed' : len(latencies),
+            'errors' : errors,
+            'wall_seconds' : wall,
+            'throughput' : len(latencies) / wall,
+            'latency' : {'mean' : sum(latencies) / len(latencies) if latencies else None,
+                         'p50' : percentile(latencies, 50), 'p90' : percentile(latencies, 90),
+                         'p99' : percentile(latencies, 99),
+                         'max' : max(latencies) if latencies else None},
+            # The share of the available core time that went into the work the
+            # tasks asked for. The rest is overhead or idle time.
+            'cpu_efficiency' : requested / (cores * wall),
+            # The busy time of a core is the time its tasks spent executing,
+            # which overlaps when a core interleaves several tasks.
+            'per_core' : {'executions' : executions, 'busy_seconds' : busy,
+                          'balance' : min(busy) / max(busy) if max(busy) > 0 else None}}
+
+def main():
+    parser = OptionParser(usage='python -m benchmarks.run [options]')
+    parser.add_option('-s', '--surrogates', default='static,dynamic',
+                      help='surrogates to benchmark [default: %default]')
+    parser.add_option('-c', '--cores', default='1',
+                      help='comma separated core counts [default: %default]')
+    parser.add_option('-n', '--concurrency', default='1,4',
+                      help='comma separated numbers of concurrent clients [default: %default]')
+    parser.add_option('-t', '--tasks', type='int', default=200,
+                      help='number of tasks per run [default: %default]')
+    parser.add_option('-d', '--durations', default='0.001:8,0.01:2',
+                      help='task duration mix in seconds, value:weight,... [default: %default]')
+    parser.add_option('-p', '--payloads', default='1024:9,1048576:1',
+                      help='input payload size mix in bytes, value:weight,... [default: %default]')
+    parser.add_option('--output-size', type='int', default=1024,
+                      help='bytes of payload returned by each task [default: %default]')
+    parser.add_option('--by-handle', action='store_true', default=False,
+                      help='pass payloads by data handle instead of by value')
+    parser.add_option('--timeout', type='float', default=120.0,
+                      help='task timeout in seconds [default: %default]')
+    parser.add_option('--seed', type='int', default=42, help='random seed [default: %default]')
+    parser.add_option('-o', '--output', default=None, help='write the JSON results to this file')
+    options, _ = parser.parse_args()
+
+    install_standins()
+    from frontends import Config
+    from frontends.static import StaticSurrogate
+    from frontends.dynamic import DynamicSurrogate
+    surrogates = {'static' : StaticSurrogate, 'dynamic' : DynamicSurrogate}
+
+    # Keep the config, the data store and the installed tasks of the 
+    # benchmark apart from the daemon's. The task tree is a package named 
+    # relative to the working directory, so the benchmark runs from the work
+    # directory, with the source directory kept on the path.
+    workdir = tempfile.mkdtemp(prefix='scavenger-benchmark-')
+    cwd = os.getcwd()
+    sys.path.insert(0, cwd)
+    try:
+        config = Config(os.path.join(workdir, 'benchmark.ini'))
+        config.set_runtime('datastore', 'directory', os.path.join(workdir, 'datastore'))
+        os.mkdir(os.path.join(workdir, 'benchmarktasks'))
+        open(os.path.join(workdir, 'benchmarktasks', '__init__.py'), 'w').close()
+        config.set_runtime('tasks', 'basedir', 'benchmarktasks')
+        os.chdir(workdir)
+        if not config.has_section('static'):
+            config.add_section('static')
+        config.set_runtime('static', 'name', 'benchmark, 0')
+
+        workload = Workload(parse_mix(options.durations), parse_mix(options.payloads),
+                            options.output_size, options.by_handle, options.seed)
+        runs = []
+        for name in options.surrogates.split(','):
+            for cores in parse_list(options.cores):
+                for concurrency in parse_list(options.concurrency):
+                    result = run_benchmark(config, surrogates[name], cores, concurrency,
+                                           workload, options.tasks, options.timeout)
+                    runs.append(result)
+                    print >> sys.stderr, '%s, %i core(s), %i client(s): %.1f tasks/s, p50 %.4fs, p99 %.4fs'%(
+                        name, cores, concurrency, result['throughput'],
+                        result['latency']['p50'] or 0.0, result['latency']['p99'] or 0.0)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, True)
+
+    results = {'version' : source_version(),
+               'timestamp' : time(),
+               'host' : {'name' : socket.gethostname(), 'platform' : platform.platform(),
+                         'python' : platform.python_version(),
+                         'calibration' : config.calibration.to_options()},
+               'workload' : workload.describe(),
+               'runs' : runs}
+    if options.output != None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+if __name__ == '__main__':
+    main()
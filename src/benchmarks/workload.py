@@ -0,0 +1,112 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the benchmark task and the workloads that drive it.
+"""
+
+import random
+
+# The benchmark task spins for a number of iterations of the loop that the
+# calibration suite measures, and returns part of its input.
+TASK_NAME = 'benchmark.scavenger.spin'
+TASK_CODE = """
+def perform(iterations, payload, output_size):
+    x = 0
+    for i in xrange(iterations):
+        x += 42
+        x /= 7
+        x *= 6
+        x -= 36
+    return payload[:output_size]
+"""
+
+def parse_mix(spec, convert = float):
+    """
+    Parses a weighted mix, e.g., "0.01:3,0.1:1" meaning that three out of four
+    values are 0.01 and the rest are 0.1. The weight may be left out.
+    @rtype: list of (value, weight) tuples
+    """
+    mix = []
+    for part in spec.split(','):
+        if ':' in part:
+            value, weight = part.split(':')
+        else:
+            value, weight = part, 1
+        mix.append((convert(value), float(weight)))
+    return mix
+
+def parse_list(spec, convert = int):
+    """Parses a comma separated list, e.g., "1,2,4"."""
+    return [convert(value) for value in spec.split(',')]
+
+def percentile(values, percent):
+    """Returns the given percentile of a list of values (nearest rank)."""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    index = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+class Workload(object):
+    """A mix of task durations and payload sizes."""
+
+    def __init__(self, durations, payloads, output_size = 0, by_handle = False, seed = 42):
+        """
+        Constructor.
+        @type durations: list of (float, float)
+        @param durations: The mix of task durations (seconds, weight).
+        @type payloads: list of (int, float)
+        @param payloads: The mix of input payload sizes (bytes, weight).
+        @type output_size: int
+        @param output_size: The maximum number of payload bytes returned by a task.
+        @type by_handle: bool
+        @param by_handle: Whether payloads are stored in the data store of the
+        surrogate and passed by handle rather than by value.
+        @type seed: int
+        @param seed: The seed of the random choices, so that runs are repeatable.
+        """
+        super(Workload, self).__init__()
+        self.durations = durations
+        self.payloads = payloads
+        self.output_size = output_size
+        self.by_handle = by_handle
+        self.seed = seed
+
+    @staticmethod
+    def __choose(rng, mix):
+        point = rng.random() * sum([weight for _, weight in mix])
+        for value, weight in mix:
+            point -= weight
+            if point < 0:
+                return value
+        return mix[-1][0]
+
+    def jobs(self, count):
+        """
+        Returns the jobs of a run.
+        @type count: int
+        @param count: The number of jobs.
+        @rtype: list of (float, int) tuples
+        @return: (duration, payload size) of each job.
+        """
+        rng = random.Random(self.seed)
+        return [(Workload.__choose(rng, self.durations), int(Workload.__choose(rng, self.payloads)))
+                for _ in range(0, count)]
+
+    def describe(self):
+        return {'durations' : self.durations, 'payloads' : self.payloads,
+                'output_size' : self.output_size, 'by_handle' : self.by_handle,
+                'seed' : self.seed}
@@ -0,0 +1,137 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the admission control of the surrogates. A task is turned
+away up front when the cores are backed up, when it is not expected to
+finish within its timeout, or when its client already has too many tasks in
+progress. Waiting for a timeout would only waste the time of everybody.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+
+class Overloaded(Exception):
+    """
+    Raised when a task is turned away. The client should try again after
+    retry_after seconds, or try another surrogate.
+    """
+    def __init__(self, retry_after, reason):
+        Exception.__init__(self, 'Overloaded', retry_after, reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class AdmissionControl(object):
+    """Keeps track of the tasks in progress and decides whether to admit new ones."""
+
+    # The weight of the newest duration in the running averages.
+    WEIGHT = 0.2
+    # The shortest retry-after hint given.
+    MIN_RETRY = 0.1
+
+    def __init__(self, cores, queue_depth = 0, client_limit = 0):
+        """
+        Constructor.
+        @type cores: int
+        @param cores: The number of cores performing the tasks.
+        @type queue_depth: int
+        @param queue_depth: The maximum number of tasks in progress per core.
+        Zero means no limit.
+        @type client_limit: int
+        @param client_limit: The maximum number of tasks in progress per client.
+        Zero means no limit.
+        """
+        super(AdmissionControl, self).__init__()
+        self.__cores = cores
+        self.__queue_depth = queue_depth
+        self.__client_limit = client_limit
+        self.__running = 0
+        self.__clients = {} # client id -> number of tasks in progress.
+        self.__durations = {} # task name -> average execution time.
+        self.__mean = 0.0 # The average execution time of all tasks.
+        self.__rejected = {'queue' : 0, 'deadline' : 0, 'client' : 0}
+        self._lock = allocate_lock()
+
+    def predicted_wait(self):
+        """Returns the number of seconds a new task is expected to wait for a core."""
+        with self._lock:
+            return self.__predicted_wait()
+
+    def __predicted_wait(self):
+        waiting = self.__running - self.__cores + 1
+        if waiting <= 0:
+            return 0.0
+        return waiting * self.__mean / self.__cores
+
+    def admit(self, task_name, timeout = None, client_id = None):
+        """
+        Admits a task or turns it away. An admitted task must be released.
+        @type task_name: str
+        @param task_name: The name of the task.
+        @type timeout: float
+        @param timeout: The number of seconds the client is willing to wait.
+        @type client_id: str
+        @param client_id: Identifies the client. Clients that do not identify
+        themselves are not limited individually.
+        @raise Overloaded: Raised if the task is turned away.
+        """
+        with self._lock:
+            wait = self.__predicted_wait()
+            if client_id != None and self.__client_limit > 0 and \
+               self.__clients.get(client_id, 0) >= self.__client_limit:
+                self.__rejected['client'] += 1
+                raise Overloaded(max(AdmissionControl.MIN_RETRY, self.__mean), 'client limit reached')
+            if self.__queue_depth > 0 and self.__running >= self.__cores * self.__queue_depth:
+                self.__rejected['queue'] += 1
+                raise Overloaded(max(AdmissionControl.MIN_RETRY, wait), 'queue full')
+            duration = self.__durations.get(task_name, 0.0)
+            if timeout != None and wait + duration > timeout:
+                self.__rejected['deadline'] += 1
+                raise Overloaded(max(AdmissionControl.MIN_RETRY, wait + duration - timeout),
+                                 'not expected to finish within %.1f seconds'%timeout)
+            self.__running += 1
+            if client_id != None:
+                self.__clients[client_id] = self.__clients.get(client_id, 0) + 1
+
+    def release(self, task_name, client_id = None, duration = None):
+        """
+        Releases an admitted task.
+        @type duration: float
+        @param duration: The execution time of the task, if it was performed.
+        """
+        w = AdmissionControl.WEIGHT
+        with self._lock:
+            self.__running -= 1
+            if client_id != None:
+                count = self.__clients.get(client_id, 0) - 1
+                if count > 0:
+                    self.__clients[client_id] = count
+                else:
+                    self.__clients.pop(client_id, None)
+            if duration != None:
+                if self.__durations.has_key(task_name):
+                    self.__durations[task_name] = (1 - w) * self.__durations[task_name] + w * duration
+                else:
+                    self.__durations[task_name] = duration
+                if self.__mean == 0.0:
+                    self.__mean = duration
+                else:
+                    self.__mean = (1 - w) * self.__mean + w * duration
+
+    def snapshot(self):
+        with self._lock:
+            return {'running' : self.__running, 'clients' : len(self.__clients),
+                    'mean_duration' : self.__mean, 'predicted_wait' : self.__predicted_wait(),
+                    'rejected' : dict(self.__rejected)}
@@ -0,0 +1,244 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the hardware calibration suite that measures the
+performance of the surrogate, and the fingerprint that the results are
+cached under.
+"""
+
+from __future__ import with_statement
+from multiprocessing import Process, Queue, cpu_count
+from threading import Timer
+from time import time
+import tempfile
+import platform
+import hashlib
+import struct
+import imp
+import sys
+import os
+
+def _read_lines(filename, prefix):
+    """Returns the lines of a file starting with the given prefix."""
+    try:
+        with open(filename) as f:
+            return [line.strip() for line in f if line.startswith(prefix)]
+    except IOError:
+        return []
+
+def hardware_fingerprint(cores = None):
+    """
+    Returns a fingerprint of the hardware (and Python interpreter) that the
+    surrogate runs on. The calibration must be redone if it changes.
+    @type cores: int
+    @param cores: The number of cores the surrogate is configured to use.
+    The scaling is measured over these, so they are part of the fingerprint.
+    @rtype: str
+    """
+    parts = [platform.machine(), platform.processor(),
+             platform.python_implementation(), platform.python_version(),
+             str(cpu_count()), str(cores)]
+    parts.extend(sorted(set(_read_lines('/proc/cpuinfo', 'model name'))))
+    parts.extend(_read_lines('/proc/meminfo', 'MemTotal'))
+    return hashlib.sha1('\n'.join(parts)).hexdigest()[:16]
+
+class _Flag(object):
+    """A flag that is raised by a timer after a number of seconds."""
+    def __init__(self, duration):
+        super(_Flag, self).__init__()
+        self.raised = False
+        self.__timer = Timer(duration, self.__raise)
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def __raise(self):
+        self.raised = True
+
+# The loops below are the loops of the old BogomipsMeasurer, which checked a
+# flag set by another thread in every iteration. The flag check is part of
+# the work measured, so it is kept to keep the rates on the same scale as
+# the CPU strengths announced by older surrogates.
+
+def measure_integer(duration):
+    """Returns the number of iterations per second of an integer loop."""
+    i = 0
+    x = 0
+    flag = _Flag(duration)
+    start = time()
+    while not flag.raised:
+        x += 42
+        x /= 7
+        x *= 6
+        x -= 36
+        i += 1
+    return i / (time() - start)
+
+def measure_float(duration):
+    """Returns the number of iterations per second of a floating point loop."""
+    i = 0
+    x = 0.0
+    flag = _Flag(duration)
+    start = time()
+    while not flag.raised:
+        x += 49.7
+        x /= 7.1
+        x *= 6.9
+        x -= 48.3
+        i += 1
+    return i / (time() - start)
+
+def _integer_worker(duration, results):
+    results.put(measure_integer(duration))
+
+def measure_scaling(cores, duration):
+    """
+    Measures how the integer throughput scales when all cores are busy.
+    @type cores: int
+    @param cores: The number of cores to load.
+    @rtype: float
+    @return: The combined throughput of all cores relative to a single core.
+    """
+    single = measure_integer(duration)
+    if cores <= 1 or single <= 0:
+        return 1.0
+    results = Queue()
+    workers = [Process(target=_integer_worker, args=(duration, results)) for _ in range(0, cores)]
+    for worker in workers:
+        worker.start()
+    total = sum([results.get() for _ in workers])
+    for worker in workers:
+        worker.join()
+    return total / single
+
+def measure_memory(size = 16 * 1024 * 1024, rounds = 8):
+    """Returns the memory bandwidth (in bytes/second) seen when copying data."""
+    data = bytearray(size)
+    start = time()
+    for _ in range(0, rounds):
+        copy = bytearray(data)
+    elapsed = time() - start
+    del copy
+    return (size * rounds) / max(elapsed, 1e-6)
+
+# The module imported when measuring import latency. It resembles a task
+# module that defines a handful of functions.
+_TASK_SOURCE = '\n'.join(['def task_%i(a, b):\n    return [x * b for x in range(a)]\n'%i
+                          for i in range(0, 50)])
+
+def measure_import(rounds = 5):
+    """Returns the average number of seconds it takes to import a task module."""
+    directory = tempfile.mkdtemp()
+    try:
+        total = 0.0
+        for i in range(0, rounds):
+            name = '__calibration_task_%i'%i
+            filename = os.path.join(directory, name + '.py')
+            with open(filename, 'w') as f:
+                f.write(_TASK_SOURCE)
+            start = time()
+            imp.load_source(name, filename)
+            total += time() - start
+            sys.modules.pop(name, None)
+        return total / rounds
+    finally:
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+
+class Calibration(object):
+    """The results of a run of the calibration suite."""
+
+    # The names of the results in the config file, and their wire format.
+    FIELDS = ('int', 'float', 'scaling', 'memory', 'import')
+    FORMAT = '!fffff'
+    SIZE = struct.calcsize(FORMAT)
+
+    def __init__(self, int_rate, float_rate, scaling, memory, import_latency):
+        """
+        Constructor.
+        @type int_rate: float
+        @param int_rate: Iterations per second of the integer loop on one core.
+        @type float_rate: float
+        @param float_rate: Iterations per second of the float loop on one core.
+        @type scaling: float
+        @param scaling: All-core integer throughput relative to one core.
+        @type memory: float
+        @param memory: Memory bandwidth in bytes/second.
+        @type import_latency: float
+        @param import_latency: Seconds it takes to import a task module.
+        """
+        super(Calibration, self).__init__()
+        self.int_rate = int_rate
+        self.float_rate = float_rate
+        self.scaling = scaling
+        self.memory = memory
+        self.import_latency = import_latency
+
+    @classmethod
+    def measure(cls, cores = None, duration = 0.25):
+        """
+        Runs the calibration suite.
+        @type cores: int
+        @param cores: The number of cores to measure the scaling over.
+        Defaults to the number of cores in the machine.
+        @type duration: float
+        @param duration: The number of seconds each throughput loop runs.
+        @rtype: Calibration
+        """
+        if cores == None:
+            cores = cpu_count()
+        return cls(measure_integer(duration), measure_float(duration),
+                   measure_scaling(cores, duration), measure_memory(), measure_import())
+
+    def strength(self):
+        """
+        Returns the single figure used as CPU strength. It is derived from
+        the loop rates the same way earlier versions of the surrogate did.
+        """
+        return ((self.int_rate + self.float_rate) / 2.0) / 25000
+
+    def values(self):
+        return (self.int_rate, self.float_rate, self.scaling, self.memory, self.import_latency)
+
+    def to_options(self):
+        """Returns the results as a dict of config options."""
+        return dict(zip(Calibration.FIELDS, [repr(value) for value in self.values()]))
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        Creates a calibration from config options.
+        @raise KeyError: Raised if a result is missing.
+        @raise ValueError: Raised if a result is not a number.
+        """
+        return cls(*[float(options[field]) for field in Calibration.FIELDS])
+
+    def pack(self):
+        return struct.pack(Calibration.FORMAT, *self.values())
+
+    @classmethod
+    def unpack(cls, data):
+        return cls(*struct.unpack(Calibration.FORMAT, data[:Calibration.SIZE]))
+
+    def __eq__(self, other):
+        return type(other) == type(self) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return 'int %.0f/s, float %.0f/s, scaling %.2f, memory %.0f MB/s, import %.1f ms'%(
+            self.int_rate, self.float_rate, self.scaling, self.memory / 1e6, self.import_latency * 1000)
@@ -1,8 +1,8 @@
 from __future__ import with_statement
 from ConfigParser import SafeConfigParser
-from threading import Thread
-from thread import allocate_lock
-from time import sleep, time
+from calibration import Calibration, hardware_fingerprint
+from detection import usable_cpus, link_speed
+import logging
 import os
 
 class Config(SafeConfigParser):
@@ -29,6 +29,7 @@ class Config(SafeConfigParser):
         # standard values must be plugged in...
         SafeConfigParser.__init__(self)
         self._filename = filename
+        self._runtime = {} # (section, option) -> value in the config file (or None)
         self.read(self._filename)
         self._dirty = False
         self.set_defaults()
@@ -48,8 +49,70 @@ class Config(SafeConfigParser):
     
     def set(self, section, option, value):
         self._dirty = True
+        self._runtime.pop((section, option), None)
         return SafeConfigParser.set(self, section, option, value)
 
+    def set_runtime(self, section, option, value):
+        """
+        Sets an option for this run only. The config file keeps its own value
+        (e.g., "auto"), so the option is derived anew the next time the
+        daemon starts.
+        """
+        if not self._runtime.has_key((section, option)):
+            if self.has_option(section, option):
+                self._runtime[(section, option)] = SafeConfigParser.get(self, section, option, raw=True)
+            else:
+                self._runtime[(section, option)] = None
+        return SafeConfigParser.set(self, section, option, value)
+
+    def is_runtime(self, section, option):
+        """Checks whether an option was derived at runtime rather than configured."""
+        return self._runtime.has_key((section, option))
+
+    def write(self, fp):
+        # Write the file values of the runtime options.
+        runtime = [(section, option, SafeConfigParser.get(self, section, option, raw=True)) 
+                   for section, option in self._runtime.keys()]
+        for section, option, _ in runtime:
+            if self._runtime[(section, option)] == None:
+                self.remove_option(section, option)
+            else:
+                SafeConfigParser.set(self, section, option, self._runtime[(section, option)])
+        try:
+            SafeConfigParser.write(self, fp)
+        finally:
+            for section, option, value in runtime:
+                SafeConfigParser.set(self, section, option, value)
+
+    def get_calibration(self, cores = None, measure = True):
+        """
+        Returns the hardware calibration of this machine. The calibration
+        suite is only run if no results are cached for the hardware
+        fingerprint of the machine.
+        @type cores: int
+        @param cores: The number of cores to measure the scaling over.
+        @type measure: bool
+        @param measure: If False, only cached results are returned.
+        @rtype: Calibration
+        @return: The calibration, or None if it is not cached and measure is False.
+        """
+        section = 'calibration-%s'%hardware_fingerprint(cores)
+        if self.has_section(section):
+            try:
+                return Calibration.from_options(dict(self.items(section)))
+            except (KeyError, ValueError):
+                if not measure:
+                    return None
+                logging.getLogger('config').warning('Invalid cached calibration - recalibrating.')
+        elif not measure:
+            return None
+        else:
+            self.add_section(section)
+        calibration = Calibration.measure(cores)
+        for option, value in calibration.to_options().items():
+            self.set(section, option, value)
+        return calibration
+
     # These media speeds are theoretical speeds in bytes/second * 0.75. 
     # For the wireless media types this is divided by two, which seems
     # to be the actual transfer speeds obtained using these media.
@@ -68,101 +131,163 @@ class Config(SafeConfigParser):
         if not self.has_section('network'):
             self.add_section('network')
         if not self.has_option('network', 'speed'):
-            self.set('network', 'speed', '500000')
-        else:
+            self.set('network', 'speed', 'auto')
+        elif self.get('network', 'speed') in Config.MEDIA.keys():
             # If the option is there we check whether we should
             # translate it into an integer here.
-            if self.get('network', 'speed') in Config.MEDIA.keys():
-                self.set('network', 'speed', 
-                         Config.MEDIA[self.get('network', 'speed')])
+            self.set('network', 'speed', 
+                     Config.MEDIA[self.get('network', 'speed')])
+        if self.get('network', 'speed') == 'auto':
+            # Use the speed of the wired link, if it can be detected. With
+            # measure enabled the dynamic surrogate replaces it with the
+            # throughput measured against a peer.
+            speed = link_speed()
+            if speed == None:
+                speed = Config.MEDIA['WLAN-b']
+            self.set_runtime('network', 'speed', str(speed))
+        if not self.has_option('network', 'measure'):
+            self.set('network', 'measure', 'no')
         
-        # CPU information.
+        # CPU information. The number of cores defaults to the number of
+        # CPUs usable by the process.
         if not self.has_section('cpu'):
             self.add_section('cpu')
-        if not self.has_option('cpu', 'strength'):
-            measurer = BogomipsMeasurer()
-            measurer.start()
-            int_perf, float_perf = measurer.measure(1.0)
-            measurer.shutdown()
-            del measurer
-            self.set('cpu', 'strength', str((((float_perf + int_perf) / 2.0)) / 25000))
         if not self.has_option('cpu', 'cores'):
-            self.set('cpu', 'cores', '1')
-            
+            self.set('cpu', 'cores', 'auto')
+        if self.get('cpu', 'cores') == 'auto':
+            self.set_runtime('cpu', 'cores', str(usable_cpus()))
+        # The calibration results are cached under the hardware fingerprint,
+        # so the suite only runs on the first start on new hardware. A
+        # strength given in the config file overrides the measured one, and
+        # then the suite is not run at all.
+        if self.has_option('cpu', 'strength'):
+            self.calibration = self.get_calibration(self.getint('cpu', 'cores'), False)
+        else:
+            self.calibration = self.get_calibration(self.getint('cpu', 'cores'))
+            self.set_runtime('cpu', 'strength', str(self.calibration.strength()))
+
+        # Peer context. Besides the default timeout, the section may hold a
+        # timeout per network media, e.g., "BT-1 = 15".
+        if not self.has_section('context'):
+            self.add_section('context')
+        if not self.has_option('context', 'timeout'):
+            self.set('context', 'timeout', '5.0')
+
+        # Data store.
+        if not self.has_section('datastore'):
+            self.add_section('datastore')
+        if not self.has_option('datastore', 'memory'):
+            self.set('datastore', 'memory', '67108864')
+        if not self.has_option('datastore', 'directory'):
+            self.set('datastore', 'directory', 'datastore')
+
+        # Forwarding of tasks to other surrogates when this one is saturated.
+        if not self.has_section('forwarding'):
+            self.add_section('forwarding')
+        if not self.has_option('forwarding', 'enabled'):
+            self.set('forwarding', 'enabled', 'no')
+        if not self.has_option('forwarding', 'threshold'):
+            self.set('forwarding', 'threshold', '2.0')
+        if not self.has_option('forwarding', 'max_hops'):
+            self.set('forwarding', 'max_hops', '1')
+
+        # Placement of tasks near their input data.
+        if not self.has_section('locality'):
+            self.add_section('locality')
+        if not self.has_option('locality', 'enabled'):
+            self.set('locality', 'enabled', 'yes')
+        if not self.has_option('locality', 'threshold'):
+            self.set('locality', 'threshold', '1.0')
+
+        # Cache of resolved data handles.
+        if not self.has_section('datacache'):
+            self.add_section('datacache')
+        if not self.has_option('datacache', 'size'):
+            self.set('datacache', 'size', '67108864')
+        if not self.has_option('datacache', 'timeout'):
+            self.set('datacache', 'timeout', '300')
+        if not self.has_option('datacache', 'workers'):
+            self.set('datacache', 'workers', '4')
+
+        # Traces of task executions. Executions taking at least threshold
+        # seconds are kept, as is a sample_rate fraction of the others.
+        if not self.has_section('tracing'):
+            self.add_section('tracing')
+        if not self.has_option('tracing', 'buffer'):
+            self.set('tracing', 'buffer', '256')
+        if not self.has_option('tracing', 'threshold'):
+            self.set('tracing', 'threshold', '1.0')
+        if not self.has_option('tracing', 'sample_rate'):
+            self.set('tracing', 'sample_rate', '0.01')
+
+        # Checkpoints of long-running tasks, so that they survive a restart.
+        # Results that no client is waiting for are kept for keep seconds.
+        if not self.has_section('checkpoint'):
+            self.add_section('checkpoint')
+        if not self.has_option('checkpoint', 'enabled'):
+            self.set('checkpoint', 'enabled', 'no')
+        if not self.has_option('checkpoint', 'directory'):
+            self.set('checkpoint', 'directory', 'checkpoints')
+        if not self.has_option('checkpoint', 'interval'):
+            self.set('checkpoint', 'interval', '60.0')
+        if not self.has_option('checkpoint', 'keep'):
+            self.set('checkpoint', 'keep', '3600')
+
+        # Admission control. A core may have queue_depth tasks in progress
+        # and a client client_limit tasks (zero means no limit).
+        if not self.has_section('admission'):
+            self.add_section('admission')
+        if not self.has_option('admission', 'queue_depth'):
+            self.set('admission', 'queue_depth', '16')
+        if not self.has_option('admission', 'client_limit'):
+            self.set('admission', 'client_limit', '0')
+
+        # Draining on shutdown. Tasks in progress are given deadline seconds
+        # to finish before the daemon exits.
+        if not self.has_section('drain'):
+            self.add_section('drain')
+        if not self.has_option('drain', 'deadline'):
+            self.set('drain', 'deadline', '30.0')
+
+        # The package (relative to the working directory) where installed
+        # task code is kept.
+        if not self.has_section('tasks'):
+            self.add_section('tasks')
+        if not self.has_option('tasks', 'basedir'):
+            self.set('tasks', 'basedir', 'pexecenv')
+
+        # Modules and tasks loaded before the cores are forked, as comma
+        # separated lists. Only modules that tasks may import are loaded.
+        if not self.has_section('preload'):
+            self.add_section('preload')
+        if not self.has_option('preload', 'modules'):
+            self.set('preload', 'modules', '')
+        if not self.has_option('preload', 'tasks'):
+            self.set('preload', 'tasks', '')
+
+        # Announcement of the activity level via Presence. The interval is in ms.
+        if not self.has_section('presence'):
+            self.add_section('presence')
+        if not self.has_option('presence', 'interval'):
+            self.set('presence', 'interval', '250')
+        if not self.has_option('presence', 'threshold'):
+            self.set('presence', 'threshold', '2')
+        if not self.has_option('presence', 'refresh'):
+            self.set('presence', 'refresh', '1.0')
             
-class BogomipsMeasurer(Thread):
-    def __init__(self):
-        Thread.__init__(self)
-        self.stop_thread = False
-        self.start_measurement = False
-        self.stop_measurement = False
-        self.int_measure = 0.0
-        self.float_measure = 0.0
-        self.daemon = True
-        self.signal = allocate_lock()
-        self.signal.acquire()
-        
-    def run(self):
-        # Wait for someone to tell you to start.
-        while not self.stop_thread:
-            while not self.start_measurement:
-                if self.stop_thread:
-                    return 0
-                sleep(0.01)
-        
-            # Measure integer performance. 
-            start_int = time()
-            i = 0
-            x = 0
-            while not self.stop_measurement:
-                x += 42
-                x /= 7
-                x *= 6
-                x -= 36
-                i += 1
-            stop_int = time()
-            if self.stop_thread:
-                return 0
-            try:
-                self.int_measure = float(i)/(stop_int-start_int)
-            except:
-                self.int_measure = 0.0
-                
-            # Measure float performance.
-            self.stop_measurement = False
-            start_float = time()
-            i = 0
-            x = 0.0
-            while not self.stop_measurement:
-                x += 49.7
-                x /= 7.1
-                x *= 6.9
-                x -= 48.3
-                i += 1
-            stop_float = time()
-            if self.stop_thread:
-                return 0
-            try:
-                self.float_measure = float(i)/(stop_float-start_float)
-            except:
-                self.float_measure = 0.0
-        
-            # Return to being idle.
-            self.start_measurement = False
-            self.stop_measurement = False
             
-            # Signal that data is ready.
-            self.signal.release()
-        
-    def measure(self, interval=0.10):
-        self.start_measurement = True
-        sleep(interval)
-        self.stop_measurement = True
-        sleep(interval)
-        self.stop_measurement = True
-        self.signal.acquire()
-        return (self.int_measure, self.float_measure)
-    
-    def shutdown(self):
-        self.stop_thread = True
-        self.stop_measurement = True
+    def getlist(self, section, option):
+        """Returns the items of a comma separated option."""
+        return [item.strip() for item in self.get(section, option).split(',') if item.strip() != '']
+
+    def get_media_timeouts(self):
+        """
+        Returns the peer timeouts configured for specific network media. 
+        @rtype: dict
+        @return: Maps media speeds to timeouts.
+        """
+        timeouts = {}
+        for media, speed in Config.MEDIA.items():
+            if self.has_option('context', media):
+                timeouts[int(speed)] = self.getfloat('context', media)
+        return timeouts
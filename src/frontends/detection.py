@@ -0,0 +1,146 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the detection of the resources available to the
+surrogate, i.e., the number of usable CPUs and the speed of the network link,
+and of the other daemon processes on the host.
+"""
+
+from __future__ import with_statement
+from multiprocessing import cpu_count
+import errno
+import os
+
+def _read_file(filename):
+    """Returns the stripped contents of a file, or None if it can not be read."""
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def parse_cpu_list(cpu_list):
+    """
+    Parses a list of CPUs as found in /proc, e.g., "0-3,6".
+    @rtype: int
+    @return: The number of CPUs in the list.
+    """
+    count = 0
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            count += int(last) - int(first) + 1
+        else:
+            count += 1
+    return count
+
+def affinity_cpus():
+    """Returns the number of CPUs that the process may run on, or None if unknown."""
+    status = _read_file('/proc/self/status')
+    if status == None:
+        return None
+    for line in status.splitlines():
+        if line.startswith('Cpus_allowed_list:'):
+            try:
+                return parse_cpu_list(line.split(':', 1)[1])
+            except ValueError:
+                return None
+    return None
+
+def quota_cpus():
+    """
+    Returns the number of CPUs that the CPU quota of the cgroup of the
+    process allows, or None if there is no quota.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>".
+    cpu_max = _read_file('/sys/fs/cgroup/cpu.max')
+    if cpu_max != None:
+        fields = cpu_max.split()
+        if len(fields) == 2 and fields[0] != 'max':
+            try:
+                quota, period = float(fields[0]), float(fields[1])
+            except ValueError:
+                return None
+            if quota > 0 and period > 0:
+                return quota / period
+        return None
+
+    # cgroup v1: a quota of -1 means that there is no quota.
+    quota = _read_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota == None or period == None:
+        return None
+    try:
+        quota, period = float(quota), float(period)
+    except ValueError:
+        return None
+    if quota > 0 and period > 0:
+        return quota / period
+    return None
+
+def usable_cpus():
+    """
+    Returns the number of CPUs that the surrogate can make use of, taking
+    the affinity mask and the cgroup CPU quota of the process into account.
+    @rtype: int
+    """
+    cpus = affinity_cpus()
+    if cpus == None:
+        cpus = cpu_count()
+    quota = quota_cpus()
+    if quota != None:
+        # A quota of 1.5 CPUs can keep two cores partially busy, but a core
+        # process that is throttled half the time is not worth having.
+        cpus = min(cpus, int(quota + 0.5))
+    return max(1, cpus)
+
+def link_speed():
+    """
+    Returns the speed of the fastest wired network link that is up, in
+    bytes/second * 0.75 like the speeds in Config.MEDIA, or None if the
+    speed can not be detected (e.g., for wireless links).
+    """
+    speeds = []
+    try:
+        interfaces = os.listdir('/sys/class/net')
+    except OSError:
+        return None
+    for interface in interfaces:
+        if interface == 'lo' or _read_file('/sys/class/net/%s/operstate'%interface) != 'up':
+            continue
+        speed = _read_file('/sys/class/net/%s/speed'%interface)
+        try:
+            # The speed is given in Mbit/s, and is -1 if unknown.
+            speed = int(speed)
+        except (TypeError, ValueError):
+            continue
+        if speed > 0:
+            speeds.append(speed)
+    if len(speeds) == 0:
+        return None
+    return int(max(speeds) * 1000000 / 8 * 0.75)
+
+def process_exists(pid):
+    """Checks whether a process with the given id exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        # The process may exist but belong to another user.
+        return error.errno == errno.EPERM
+    return True
@@ -0,0 +1,131 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This file contains the announcer that keeps the Presence service of
+the surrogate up to date."""
+
+from __future__ import with_statement
+from threading import Thread, Event
+from thread import allocate_lock
+from time import time
+import struct
+import logging
+
+def pack_service_data(cpu_strength, cpu_cores, active_tasks, network_speed, calibration = None):
+    """
+    Packs the data of the scavenger Presence service. The first 16 bytes hold
+    the fields known by all versions of the surrogate and the calibration
+    results, if any, follow after them.
+    """
+    data = struct.pack("!fIII", cpu_strength, cpu_cores, active_tasks, network_speed)
+    if calibration != None:
+        data += calibration.pack()
+    return data
+
+class ServiceAnnouncer(Thread):
+    """
+    Announces the activity level of the surrogate through its Presence service.
+    Activity changes are coalesced: an announcement goes out at most once per
+    interval, unless the activity has changed by at least the threshold since
+    the last announcement, in which case it goes out right away. The service
+    is re-announced every refresh period even if nothing has changed.
+    """
+
+    def __init__(self, presence, service, pack_data, interval, threshold, refresh):
+        """
+        Constructor.
+        @type presence: Presence
+        @param presence: The Presence connection.
+        @type service: PresenceService
+        @param service: The registered scavenger service.
+        @type pack_data: callable
+        @param pack_data: Function that packs the service data given the
+        activity count.
+        @type interval: float
+        @param interval: The minimum number of seconds between announcements.
+        @type threshold: int
+        @param threshold: The change in activity that is announced right away.
+        @type refresh: float
+        @param refresh: The maximum number of seconds between announcements.
+        """
+        super(ServiceAnnouncer, self).__init__()
+        self.daemon = True
+        self.__presence = presence
+        self.__service = service
+        self.__pack_data = pack_data
+        self.__interval = interval
+        self.__threshold = threshold
+        self.__refresh = refresh
+        self.__activity = 0
+        self.__announced = None
+        self.__urgent = False
+        self.__last_sent = 0.0
+        self.__wakeup = Event()
+        self.__shutdown = False
+        self.__logger = logging.getLogger('announcer')
+        self._lock = allocate_lock()
+
+    def set_activity(self, activity):
+        """Records a new activity level. This never blocks on the network."""
+        with self._lock:
+            self.__activity = activity
+            if self.__announced == None or abs(activity - self.__announced) >= self.__threshold:
+                self.__urgent = True
+        self.__wakeup.set()
+
+    def announce(self):
+        """Makes the announcer send the service data right away."""
+        with self._lock:
+            self.__urgent = True
+        self.__wakeup.set()
+
+    def shutdown(self):
+        self.__shutdown = True
+        self.__wakeup.set()
+
+    def run(self):
+        while not self.__shutdown:
+            # Sleep until the activity changes or the refresh period ends.
+            self.__wakeup.wait(self.__refresh)
+            self.__wakeup.clear()
+            if self.__shutdown:
+                return
+
+            # Small changes are held back until the interval has passed, which
+            # coalesces the changes made in the meantime into one announcement.
+            deadline = self.__last_sent + self.__interval
+            while not self.__shutdown:
+                with self._lock:
+                    urgent = self.__urgent
+                delay = deadline - time()
+                if urgent or delay <= 0:
+                    break
+                self.__wakeup.wait(delay)
+                self.__wakeup.clear()
+            if self.__shutdown:
+                return
+
+            # Send the announcement.
+            with self._lock:
+                activity = self.__activity
+                self.__urgent = False
+            try:
+                self.__service.data = self.__pack_data(activity)
+                self.__presence.update_service(self.__service)
+            except Exception:
+                self.__logger.exception('Error announcing service.')
+            with self._lock:
+                self.__announced = activity
+            self.__last_sent = time()
@@ -18,13 +18,19 @@ the scavenger client is moving within."""
 
 from __future__ import with_statement
 from presence import Presence
+# TODO: Why is the full path needed here!?
+from frontends.calibration import Calibration
 import struct
 from time import time
-from copy import deepcopy
+from copy import copy
 from thread import allocate_lock
+from heapq import heappush, heappop, heapreplace
+from bisect import insort, bisect_left
+from collections import deque
+import logging
 
 class ScavengerPeer(object):
-    def __init__(self, name, address, cpu_strength, cpu_cores, active_tasks, network_media):
+    def __init__(self, name, address, cpu_strength, cpu_cores, active_tasks, network_media, calibration = None):
         """
         Constructor.
         @type name: str
@@ -40,6 +46,8 @@ class ScavengerPeer(object):
         peer. This may be used as a utilization measurement for the peer.
         @type network_media: str
         @param network_media: The kind of media we can connect to this Peer with.
+        @type calibration: Calibration
+        @param calibration: The hardware calibration announced by the peer, if any.
         """
         super(ScavengerPeer, self).__init__()
         self.name = name.strip()
@@ -48,7 +56,9 @@ class ScavengerPeer(object):
         self.cpu_cores = cpu_cores
         self.active_tasks = active_tasks
         self.timestamp = time()
+        self.expires = None
         self.net = network_media
+        self.calibration = calibration
 
     def __eq__(self, other):
         if type(other) == type(self):
@@ -63,6 +73,15 @@ class ScavengerPeer(object):
         else:
             return False
         
+    def same_state(self, other):
+        """Checks whether another announcement of the peer carries the same state."""
+        return self.address == other.address and \
+            self.cpu_strength == other.cpu_strength and \
+            self.cpu_cores == other.cpu_cores and \
+            self.active_tasks == other.active_tasks and \
+            self.net == other.net and \
+            self.calibration == other.calibration
+        
     def __str__(self):
         return '%s, %s:%i, %f (%f, %i, %i) %i'%(self.name, 
                                             self.address[0], 
@@ -73,70 +92,314 @@ class ScavengerPeer(object):
                                             self.active_tasks,
                                             self.net)
         
+class PeerSnapshot(object):
+    """
+    A view of the peers in a context. A new snapshot, with a higher version
+    number, is published whenever the set of peers or the announced state of
+    a peer changes. The snapshot is immutable, except for the liveness of its
+    peers: when a peer is announced again with the same state, its timestamp
+    and expiry time are refreshed in place.
+    """
+    def __init__(self, version, peers):
+        """
+        Constructor.
+        @type version: int
+        @param version: The version number of the snapshot.
+        @type peers: dict
+        @param peers: Maps peer names to ScavengerPeer objects. Neither the dict
+        nor the peers (apart from their liveness) may be modified after the
+        snapshot has been created.
+        """
+        super(PeerSnapshot, self).__init__()
+        self.version = version
+        self.peers = peers
+        
 class Context(object):
+    """
+    The peers currently known to be around. Each peer expires a timeout after
+    its latest announcement. Expiry times are kept in a heap, so expiring 
+    peers costs O(log n) per announcement instead of a scan of every peer.
+    """
     TIMEOUT = 5.0
-    CLEANUP_AT = 100
     
-    def __init__(self):
+    def __init__(self, timeout = TIMEOUT, media_timeouts = None):
+        """
+        Constructor.
+        @type timeout: float
+        @param timeout: The default number of seconds a peer lives after 
+        its latest announcement.
+        @type media_timeouts: dict
+        @param media_timeouts: Maps network speeds (as announced by peers) to
+        the timeout used for peers on that kind of network.
+        """
         super(Context, self).__init__()
-        self.__peers = {}
+        self.__snapshot = PeerSnapshot(0, {})
+        self.__timeout = timeout
+        self.__media_timeouts = media_timeouts if media_timeouts != None else {}
+        self.__expiry_heap = [] # (expiry time, peer name) - may hold outdated entries.
+        self.__listeners = []
+        self.__events = deque() # Events not yet delivered to the listeners, in order.
+        # Writers serialize on the lock. Readers simply grab the current snapshot.
         self._lock = allocate_lock()
+        self.__delivery_lock = allocate_lock()
+
+    def __publish(self, peers):
+        self.__snapshot = PeerSnapshot(self.__snapshot.version + 1, peers)
 
-    def add(self, peer):
+    def add_listener(self, listener):
+        """
+        Registers a function to be called when the context changes. The 
+        function is called as listener(event, peer) where event is one of
+        'added', 'changed' or 'expired'.
+        """
+        self.__listeners.append(listener)
+
+    def __notify(self):
+        # Delivers the queued events. Events are queued while the lock is held,
+        # so they are in the order of the changes, and only one thread at a 
+        # time delivers them, so the listeners see them in that order. A 
+        # thread that finds another one delivering leaves its events to it.
+        while self.__delivery_lock.acquire(False):
+            try:
+                while True:
+                    with self._lock:
+                        if len(self.__events) == 0:
+                            break
+                        event, peer = self.__events.popleft()
+                    for listener in self.__listeners:
+                        try:
+                            listener(event, peer)
+                        except Exception:
+                            logging.getLogger('context').exception('Error in context listener.')
+            finally:
+                self.__delivery_lock.release()
+            # Events queued after the last check, but before the release, 
+            # would otherwise be left behind.
+            with self._lock:
+                if len(self.__events) == 0:
+                    return
+
+    def add(self, peer, timeout = None):
+        """
+        Adds (or refreshes) a peer.
+        @type peer: ScavengerPeer
+        @param peer: The announced peer.
+        @type timeout: float
+        @param timeout: The number of seconds the peer lives without being
+        announced again. Defaults to the timeout of the peer's network media.
+        """
+        if timeout == None:
+            timeout = self.__media_timeouts.get(peer.net, self.__timeout)
+        peer.expires = peer.timestamp + timeout
+        with self._lock:
+            peers = self.__snapshot.peers
+            current = peers.get(peer.name)
+            if current is not None and current.same_state(peer):
+                # Only the liveness of the peer has changed. Refresh it in place 
+                # rather than publishing a new snapshot, so that the version only
+                # changes when there is something new to look at.
+                current.timestamp = peer.timestamp
+                current.expires = peer.expires
+                events = []
+            else:
+                events = [('added' if current is None else 'changed', peer)]
+            expired = [p for p in self.__expired(peers) if p.name != peer.name]
+            # Push the entry only after the sweep, or an announcement that is
+            # already stale would lose it and the peer would never expire.
+            heappush(self.__expiry_heap, (peer.expires, peer.name))
+            if len(events) > 0 or len(expired) > 0:
+                # Apply the changes to a copy of the peers.
+                peers = dict(peers)
+                for p in expired:
+                    peers.pop(p.name)
+                if len(events) > 0:
+                    peers[peer.name] = peer
+                self.__publish(peers)
+            self.__events.extend([('expired', p) for p in expired] + events)
+        self.__notify()
+
+    def expire(self):
+        """Removes the peers that have expired."""
         with self._lock:
-            # Add the peer.
-            self.__peers[peer.name] = peer
-            
-            # Check whether it is time to do some cleaning.
-            if len(self.__peers) > Context.CLEANUP_AT:
-                now = time()
-                for peer in self.__peers.values():
-                    if now - peer.timestamp > Context.TIMEOUT:
-                        self.__peers.pop(peer.name)
+            peers = self.__snapshot.peers
+            expired = self.__expired(peers)
+            if len(expired) > 0:
+                peers = dict(peers)
+                for p in expired:
+                    peers.pop(p.name)
+                self.__publish(peers)
+            self.__events.extend([('expired', p) for p in expired])
+        self.__notify()
+
+    def __expired(self, peers):
+        # Pop expired entries off the heap. An entry is outdated, and simply 
+        # dropped, if the peer has been announced again since it was pushed. 
+        now = time()
+        expired = []
+        heap = self.__expiry_heap
+        while len(heap) > 0 and heap[0][0] < now:
+            expires, name = heappop(heap)
+            peer = peers.get(name)
+            if peer is not None and peer.expires == expires:
+                expired.append(peer)
+        return expired
+    
+    def get_snapshot(self):
+        """
+        Returns the current snapshot of the context. The snapshot may contain
+        expired peers, use get_peers to get the live ones.
+        @rtype: PeerSnapshot
+        """
+        return self.__snapshot
+
+    def get_version(self):
+        return self.__snapshot.version
     
     def get_peer(self, name):
-        with self._lock:
-            return self.__peers[name]
+        return self.__snapshot.peers[name]
                 
     def get_peers(self):
+        """
+        Returns the live peers. The peers are shared with the context and 
+        must not be modified.
+        @rtype: list of ScavengerPeer
+        """
         now = time()
-        peers = []
-        with self._lock:
-            for peer in self.__peers.values():
-                # Cleanout stale entries.
-                if now - peer.timestamp > Context.TIMEOUT:
-                    self.__peers.pop(peer.name)
-                else:
-                    peers.append(deepcopy(peer))
-        return peers
+        return [peer for peer in self.__snapshot.peers.itervalues() if peer.expires >= now]
     
     def has_peer(self, name):
-        with self._lock:
-            return self.__peers.has_key(name)
+        return self.__snapshot.peers.has_key(name)
 
     def resolve(self, name):
+        return self.__snapshot.peers[name].address
+
+    def __change_peer_activity(self, name, increment):
         with self._lock:
-            return self.__peers[name].address
+            peers = self.__snapshot.peers
+            if not peers.has_key(name):
+                return
+            peer = copy(peers[name])
+            # Small sanity check here.
+            peer.active_tasks = max(0, peer.active_tasks + increment)
+            peers = dict(peers)
+            peers[name] = peer
+            self.__publish(peers)
+            self.__events.append(('changed', peer))
+        self.__notify()
 
     def increment_peer_activity(self, name):
-        with self._lock:
-            if self.__peers.has_key(name):
-                self.__peers[name].active_tasks += 1
+        self.__change_peer_activity(name, 1)
         
     def decrement_peer_activity(self, name):
+        self.__change_peer_activity(name, -1)
+
+class PeerIndex(object):
+    """
+    Ranks peers by their estimated completion time for a task:
+    
+        input_bytes / net + complexity * max(cores, active_tasks + 1) / (cores * strength)
+    
+    i.e., the time it takes to send the input plus the time it takes to 
+    perform the task given the current activity on the peer. The two factors
+    are kept in sorted lists that are updated incrementally as the context 
+    changes, and the best peers for a given input size and complexity are 
+    found with the threshold algorithm, which only looks at the heads of the 
+    lists instead of sorting every peer on every query.
+    """
+
+    # Factor used for peers that announce no network speed or CPU strength.
+    # Large but finite, so that multiplying it by zero is harmless.
+    UNUSABLE = 1e30
+
+    def __init__(self):
+        super(PeerIndex, self).__init__()
+        self.__peers = {} # name -> (peer, transfer factor, compute factor)
+        self.__by_transfer = [] # Sorted (transfer factor, name)
+        self.__by_compute = [] # Sorted (compute factor, name)
+        self._lock = allocate_lock()
+
+    @staticmethod
+    def factors(peer):
+        """Returns the per byte transfer time and per complexity unit compute time of a peer."""
+        if peer.net > 0:
+            transfer = 1.0 / peer.net
+        else:
+            transfer = PeerIndex.UNUSABLE
+        if peer.cpu_strength > 0 and peer.cpu_cores > 0:
+            compute = max(peer.cpu_cores, peer.active_tasks + 1) / (float(peer.cpu_cores) * peer.cpu_strength)
+        else:
+            compute = PeerIndex.UNUSABLE
+        return transfer, compute
+
+    def update(self, event, peer):
+        """Context listener keeping the index up to date."""
         with self._lock:
-            if self.__peers.has_key(name):
-                self.__peers[name].active_tasks -= 1
-                # Small sanity check here.
-                if self.__peers[name].active_tasks < 0:
-                    self.__peers[name].active_tasks = 0
+            if self.__peers.has_key(peer.name):
+                _, transfer, compute = self.__peers.pop(peer.name)
+                self.__remove(self.__by_transfer, (transfer, peer.name))
+                self.__remove(self.__by_compute, (compute, peer.name))
+            if event != 'expired':
+                transfer, compute = PeerIndex.factors(peer)
+                self.__peers[peer.name] = (peer, transfer, compute)
+                insort(self.__by_transfer, (transfer, peer.name))
+                insort(self.__by_compute, (compute, peer.name))
+
+    @staticmethod
+    def __remove(lst, item):
+        i = bisect_left(lst, item)
+        if i < len(lst) and lst[i] == item:
+            del lst[i]
+
+    def best_peers(self, k, input_bytes, complexity, exclude = ()):
+        """
+        Finds the peers with the lowest estimated completion time.
+        @type k: int
+        @param k: The (maximum) number of peers to return.
+        @type input_bytes: int
+        @param input_bytes: The size of the task input.
+        @type complexity: float
+        @param complexity: The complexity of the task, as measured by profiling.
+        @type exclude: sequence of str
+        @param exclude: Names of peers that should not be considered.
+        @rtype: list of (float, ScavengerPeer)
+        @return: Up to k (estimated completion time, peer) pairs, best first.
+        """
+        now = time()
+        best = [] # Max-heap (by negated estimate) of the k best peers seen.
+        seen = set()
+        with self._lock:
+            lists = (self.__by_transfer, self.__by_compute)
+            for depth in range(0, len(self.__peers)):
+                # Evaluate the peers found at this depth of both lists.
+                for lst in lists:
+                    name = lst[depth][1]
+                    if name in seen:
+                        continue
+                    seen.add(name)
+                    peer, transfer, compute = self.__peers[name]
+                    if name in exclude or peer.expires < now:
+                        continue
+                    estimate = input_bytes * transfer + complexity * compute
+                    if len(best) < k:
+                        heappush(best, (-estimate, name, peer))
+                    elif -best[0][0] > estimate:
+                        heapreplace(best, (-estimate, name, peer))
+                
+                # No unseen peer can beat the threshold. Stop if the k best do.
+                threshold = input_bytes * lists[0][depth][0] + complexity * lists[1][depth][0]
+                if len(best) == k and -best[0][0] <= threshold:
+                    break
+        best.sort(reverse=True)
+        return [(-estimate, peer) for estimate, _, peer in best]
 
 class ContextMonitor(object):
-    def __init__(self, presence = None):
+    def __init__(self, presence = None, timeout = Context.TIMEOUT, media_timeouts = None):
         super(ContextMonitor, self).__init__()
 
-        # Create the local context.
-        self._context = Context()
+        # Create the local context and the index ranking its peers.
+        self._context = Context(timeout, media_timeouts)
+        self._index = PeerIndex()
+        self._context.add_listener(self._index.update)
         
         # Subscribe to Presence announcements.
         if presence == None:
@@ -148,16 +411,42 @@ class ContextMonitor(object):
         
     def receive_announcement(self, peer_name, peer_address, service):
         peer_name = peer_name.strip('\x00 ')
-        cpu_strength, cpu_cores, active_tasks, network_media = struct.unpack("!fIII", service.data)
+        cpu_strength, cpu_cores, active_tasks, network_media = struct.unpack("!fIII", service.data[:16])
+        # Older surrogates do not announce their calibration.
+        calibration = None
+        if len(service.data) >= 16 + Calibration.SIZE:
+            calibration = Calibration.unpack(service.data[16:])
         peer = ScavengerPeer(peer_name, (peer_address, service.port), 
-                             cpu_strength, cpu_cores, active_tasks, network_media)
+                             cpu_strength, cpu_cores, active_tasks, network_media, calibration)
         self._context.add(peer)
                 
     def get_peers(self):
         return self._context.get_peers()
+
+    def get_snapshot(self):
+        return self._context.get_snapshot()
+
+    def get_version(self):
+        return self._context.get_version()
     
     def has_peer(self, name):
         return self._context.has_peer(name)
+
+    def get_peer(self, name):
+        return self._context.get_peer(name)
+
+    def best_peers(self, k, input_bytes, complexity, exclude = ()):
+        """
+        Returns up to k (estimated completion time, peer) pairs for the peers
+        that are expected to complete a task the fastest. See PeerIndex.
+        """
+        return self._index.best_peers(k, input_bytes, complexity, exclude)
+
+    def add_listener(self, listener):
+        self._context.add_listener(listener)
+
+    def expire_peers(self):
+        self._context.expire()
     
     def increment_peer_activity(self, name):
         self._context.increment_peer_activity(name)
@@ -8,26 +8,72 @@ from pexecenv import Jailor
 from time import sleep, time
 # TODO: Why is the full path for Config needed here!?
 from frontends.daemonconfig import Config
-from datastore import RemoteDataStore, RemoteDataHandle
+from datastore import RemoteDataHandle
+from frontends.surrogatestore import SurrogateDataStore
+from frontends.handlecache import HandleCache, HandleResolver, input_size, input_handles, handle_owner, handle_key
+from frontends.peerrpc import PeerConnection, call_peer, measure_throughput
+from context import PeerIndex
+from frontends.workerpool import WorkerPool
+from frontends.histogram import LatencyStats
+from frontends.tracing import Trace, TraceBuffer
+from frontends.admission import AdmissionControl, Overloaded
+from frontends.detection import process_exists
 from context import ContextMonitor
-import struct
+from announcer import ServiceAnnouncer, pack_service_data
+import hashlib
 import logging
 
+class ForwardingError(Exception):
+    """Raised when a task could not be forwarded to a peer."""
+    def __init__(self, msg, error):
+        Exception.__init__(self, msg, error)
+
+class TaskRedirect(Exception):
+    """Raised to tell a client to perform its task on another surrogate."""
+    def __init__(self, peer_name, peer_address):
+        Exception.__init__(self, 'Redirect', peer_name, peer_address)
+
 class DynamicSurrogate(Thread):
     CALLBACK_TIMEOUT = 5.0
     MAINT_POLL = 1.0
+    DRAIN_POLL = 0.1
+    # Weight of the latest execution in the running averages of task profiles.
+    PROFILE_WEIGHT = 0.2
+    # The activity level announced while draining, so that peers and clients
+    # see the surrogate as fully loaded.
+    DRAIN_ACTIVITY = 0xFFFF
     
-    def __init__(self, debug_jail = False):
+    def __init__(self, debug_jail = False, predecessor = None):
         super(DynamicSurrogate, self).__init__()
         
         # Set member variables.
+        self.__link_measurement = None
         self.pending_tasks = {}
         self.pending_tasks_lock = allocate_lock()
+        self.unclaimed = {} # execid -> results that no client is waiting for.
+        self.detached = {} # execid -> (task name, client id) of detached tasks in progress.
+        self.in_flight = 0 # The number of perform_task calls in progress.
+        self.draining = False
         self.activity_count = 0
+        # The process id of a draining daemon that this one takes over from.
+        self.__predecessor = predecessor
+        self.task_profiles = {} # task name -> (average duration, average complexity)
+        self.stats = {'forwarded' : 0, 'forward_failures' : 0, 'received_forwarded' : 0,
+                      'redirected' : 0, 'forwarded_to_data' : 0, 'tasks_fetched' : 0}
+        self.__stats_lock = allocate_lock()
+        self.__fetch_locks = {} # task name -> lock held while its code is fetched.
+        self.__fetch_locks_lock = allocate_lock()
+        self.latency = LatencyStats()
         self.__shutdown = False
         
         # Get a config handle.
         self._config = Config.get_instance()
+        self.traces = TraceBuffer(self._config.getint('tracing', 'buffer'),
+                                  self._config.getfloat('tracing', 'threshold'),
+                                  self._config.getfloat('tracing', 'sample_rate'))
+        self.admission = AdmissionControl(self._config.getint('cpu', 'cores'),
+                                          self._config.getint('admission', 'queue_depth'),
+                                          self._config.getint('admission', 'client_limit'))
 
         # Get a logger.
         self.__logger = logging.getLogger('scavenger')
@@ -35,7 +81,16 @@ class DynamicSurrogate(Thread):
         # Start the execution environment.
         self._ipc, remote_pipe = EIPC.eipc_pair()
         self._ipc.start()
-        self.__exec_env = Jailor(remote_pipe, self._config.getint('cpu', 'cores'), debug=debug_jail)
+        checkpoint_dir = None
+        if self._config.getboolean('checkpoint', 'enabled'):
+            checkpoint_dir = self._config.get('checkpoint', 'directory')
+        self.__exec_env = Jailor(remote_pipe, self._config.getint('cpu', 'cores'), 
+                                 basedir=self._config.get('tasks', 'basedir'), debug=debug_jail,
+                                 checkpoint_dir=checkpoint_dir, 
+                                 checkpoint_interval=self._config.getfloat('checkpoint', 'interval'),
+                                 preload_modules=self._config.getlist('preload', 'modules'),
+                                 preload_tasks=self._config.getlist('preload', 'tasks'),
+                                 handoff=predecessor != None)
         self.__exec_env.start()
 
         # Register the callback function.
@@ -49,7 +104,12 @@ class DynamicSurrogate(Thread):
             self.rpc_server.register_function(self.perform_task_intent)
             self.rpc_server.register_function(self.install_task)
             self.rpc_server.register_function(self.has_task)
+            self.rpc_server.register_function(self.fetch_task_code)
+            self.rpc_server.register_function(self.task_hash)
             self.rpc_server.register_function(self.ping)
+            self.rpc_server.register_function(self.get_stats)
+            self.rpc_server.register_function(self.dump_traces)
+            self.rpc_server.register_function(self.collect_result)
             self.__logger.info('DynamicSurrogate daemon is listening on port %i'%scavenger_port)
         except Exception, e:
             self.__logger.exception('Error creating RPC server.')
@@ -64,14 +124,17 @@ class DynamicSurrogate(Thread):
             self.presence = Presence()
             self.presence.connect()
             # 2) Register the service.
-            service_data = struct.pack("!fIII", 
-                                       self._config.getfloat('cpu', 'strength'),
-                                       self._config.getint('cpu', 'cores'), 
-                                       0,
-                                       self._config.getint('network', 'speed'))
-            self.service = PresenceService('scavenger', scavenger_port, service_data)
+            self.service = PresenceService('scavenger', scavenger_port, self._pack_service_data(0))
             self.presence.register_service(self.service)
-            self.context_monitor = ContextMonitor(self.presence)
+            # 3) Start the announcer that keeps the service data up to date.
+            self.announcer = ServiceAnnouncer(self.presence, self.service, self._pack_service_data,
+                                              self._config.getint('presence', 'interval') / 1000.0,
+                                              self._config.getint('presence', 'threshold'),
+                                              self._config.getfloat('presence', 'refresh'))
+            self.announcer.start()
+            self.context_monitor = ContextMonitor(self.presence,
+                                                  self._config.getfloat('context', 'timeout'),
+                                                  self._config.get_media_timeouts())
         except Exception, e:
             try:
                 self.__exec_env.shutdown()
@@ -81,41 +144,124 @@ class DynamicSurrogate(Thread):
             raise e
 
         # Create a remote data store.
-        self.remotedatastore = RemoteDataStore(self.presence.get_node_name())
+        self.remotedatastore = SurrogateDataStore(self.presence.get_node_name(),
+                                                  self._config.getint('datastore', 'memory'),
+                                                  self._config.get('datastore', 'directory'))
         self.rpc_server.register_function(self.remotedatastore.fetch_data, 'resolve_data_handle')
-        self.rpc_server.register_function(self.remotedatastore.retain, 'retain_data_handle')
-        self.rpc_server.register_function(self.remotedatastore.expire, 'expire_data_handle')
+        self.rpc_server.register_function(self.retain_data_handle, 'retain_data_handle')
+        self.rpc_server.register_function(self.expire_data_handle, 'expire_data_handle')
         self.rpc_server.register_function(self.remotedatastore.store_data, 'store_data')
+        self.rpc_server.register_function(self.remotedatastore.data_size, 'data_handle_size')
+
+        # Create the resolver (and cache) for data handles in task input.
+        self.handle_resolver = HandleResolver(self._resolve_data_handle,
+                                              HandleCache(self._config.getint('datacache', 'size'),
+                                                          self._config.getfloat('datacache', 'timeout')),
+                                              WorkerPool(self._config.getint('datacache', 'workers'), 'resolver'))
 
         # Start the maintenance thread.
         self.start()
      
-    def shutdown(self):
+    def shutdown(self, handoff = False):
         self.__shutdown = True
         self.__exec_env.shutdown()
         self.rpc_server.stop()
+        self.handle_resolver.shutdown()
+        self.announcer.shutdown()
+        if handoff:
+            # The service is announced by the daemon that took over.
+            return
         try: 
             self.presence.remove_service('scavenger')
         except: 
             pass
     
+    def drain(self, deadline, handoff = False):
+        """
+        Stops taking on new tasks and waits for the perform_task calls in 
+        progress to finish. The surrogate announces itself as fully loaded, 
+        and new tasks are forwarded to peers or rejected.
+        @type deadline: float
+        @param deadline: The maximum number of seconds to wait.
+        @type handoff: bool
+        @param handoff: Whether a new daemon has taken over the service. If so
+        the service is no longer announced by this surrogate.
+        @rtype: bool
+        @return: True if all calls finished before the deadline.
+        """
+        self.draining = True
+        if handoff:
+            self.announcer.shutdown()
+        else:
+            self.announcer.announce()
+        end = time() + deadline
+        while time() < end:
+            with self.pending_tasks_lock:
+                if self.in_flight == 0:
+                    return True
+            sleep(DynamicSurrogate.DRAIN_POLL)
+        self.__logger.warning('%i task(s) still in progress after draining.'%self.in_flight)
+        return False
+    
     def ping(self, flaf):
         """
         Simple rpc function that can be used to check whether the connection is alive.
         """
         return flaf    
 
-    def task_callback(self, rcode, eid, output):
+    def get_stats(self, text = False):
+        """
+        Returns the statistics counters, the latency histograms and the load
+        of the cores of the surrogate.
+        @type text: bool
+        @param text: Whether to return the latency histograms in the Prometheus
+        text format instead.
+        @rtype: dict (or str)
+        """
+        if text:
+            return self.latency.export_text()
+        with self.__stats_lock:
+            stats = dict(self.stats)
+        stats['latency'] = self.latency.snapshot()
+        stats['cores'] = self.latency.core_snapshot()
+        stats['admission'] = self.admission.snapshot()
+        return stats
+
+    def dump_traces(self, limit = None, trace_id = None):
+        """
+        Returns the traces of slow, failed and sampled executions (see TraceBuffer.dump).
+        @type limit: int
+        @param limit: The maximum number of traces to return.
+        @type trace_id: str
+        @param trace_id: If given only the trace with this id is returned.
+        @rtype: dict
+        """
+        return self.traces.dump(limit, trace_id)
+
+    def _count(self, counter):
+        with self.__stats_lock:
+            self.stats[counter] += 1
+
+    def task_callback(self, rcode, eid, output, timings = None):
+        # A detached task releases its admission slot once it is done.
+        with self.pending_tasks_lock:
+            held = self.detached.pop(eid, None)
+        if held != None:
+            self._release_detached(held[0], held[1], timings)
+
         # Find the Condition object that the worker thread is waiting on.  
         with self.pending_tasks_lock:
             try:
                 cond = self.pending_tasks[eid]
             except KeyError:
-                # The execution id was unknown. This means that the operation has timed out.
+                # The execution id was unknown. This means that the operation has 
+                # timed out, was detached, or was resumed after a restart. The 
+                # result is kept for the client to collect.
+                self.unclaimed[eid] = (rcode, output, timings, time())
                 return
             
             # Store the return code and output for the caller to fetch.
-            self.pending_tasks[eid] = (rcode, output)
+            self.pending_tasks[eid] = (rcode, output, timings, time())
                 
         # Now the return code and output has been placed so that the waiting
         # thread can access it. Time to awaken the sleeper...
@@ -123,65 +269,412 @@ class DynamicSurrogate(Thread):
         cond.notify()
         cond.release()
 
-    def _resolve_data_handles_in_input(self, task_input):
-        if type(task_input) == dict:
-            # Keyword arguments.
-            for key, value in task_input.items():
-                if type(value) == RemoteDataHandle:
-                    task_input[key] = self.remotedatastore.resolve_data_handle(value, self.context_monitor._context)
-        elif type(task_input) in (tuple, list):
-            # Positional arguments.
-            new_list = []
-            for value in task_input:
-                if type(value) == RemoteDataHandle:
-                    new_list.append(self.remotedatastore.resolve_data_handle(value, self.context_monitor._context))
-                else:
-                    new_list.append(value)
-            task_input = new_list
-        else:
-            # Single argument.
-            if type(task_input) == RemoteDataHandle:
-                task_input = self.remotedatastore.resolve_data_handle(task_input, self.context_monitor._context)
-        return task_input
+    def _hold_detached(self, eid, task_name, client_id):
+        # Makes a detached task hold on to its admission slot (and count as in
+        # flight) until it is done. Returns False if it is done already.
+        with self.pending_tasks_lock:
+            if self.unclaimed.has_key(eid):
+                return False
+            self.detached[eid] = (task_name, client_id)
+            return True
 
-    def change_activity(self, increment):
-        cpu_strength = self._config.getfloat('cpu', 'strength')
-        cpu_cores = self._config.getint('cpu', 'cores')
-        network_speed = self._config.getint('network', 'speed')
+    def _release_detached(self, task_name, client_id, timings):
+        duration = None
+        if timings:
+            start = timings.get('input', timings.get('started'))
+            if start != None and timings.get('finished') != None:
+                duration = timings['finished'] - start
+        self.admission.release(task_name, client_id, duration)
+        with self.pending_tasks_lock:
+            self.in_flight -= 1
 
+    def _expire_unclaimed(self):
+        # Drop the results that have not been collected in time.
+        expiry = time() - self._config.getfloat('checkpoint', 'keep')
         with self.pending_tasks_lock:
-            self.activity_count += increment
-            self.service.data = struct.pack("!fIII", 
-                                            cpu_strength,
-                                            cpu_cores,
-                                            self.activity_count,
-                                            network_speed)
+            for eid, result in self.unclaimed.items():
+                if result[3] < expiry:
+                    del self.unclaimed[eid]
 
-            self.presence.update_service(self.service)
+    def collect_result(self, execid, timeout = 120):
+        """
+        Returns the result of an execution that nobody waited for, i.e., one
+        that was detached, that timed out, or that was resumed from a 
+        checkpoint after a restart. 
+        @type execid: int
+        @param execid: The execution id returned by perform_task (with detach 
+        set) or given in its timeout error.
+        @type timeout: float
+        @param timeout: The number of seconds to wait for the execution to finish.
+        """
+        with self.pending_tasks_lock:
+            flaf = self.unclaimed.pop(execid, None)
+            if flaf == None:
+                if self.pending_tasks.has_key(execid):
+                    raise Exception('The result of execution %i is already awaited.'%execid)
+                cond = Condition()
+                cond.acquire()
+                self.pending_tasks[execid] = cond
+        if flaf == None:
+            cond.wait(timeout)
+            with self.pending_tasks_lock:
+                flaf = self.pending_tasks.pop(execid)
+            cond.release()
+            if type(flaf) != tuple:
+                raise Exception('Timeout while collecting the result of execution %i.'%execid, execid)
 
+        rcode, output, _, _ = flaf
+        if rcode == 'RESULT':
+            return output
+        elif rcode == 'ERROR':
+            raise Exception('Exception thrown within task: %s'%output)
+        else:
+            raise Exception('Unknown return code: %s'%rcode)
+
+    def _resolve_data_handle(self, handle):
+        return self.remotedatastore.resolve_data_handle(handle, self.context_monitor._context)
+
+    def _pack_service_data(self, activity_count):
+        if self.draining:
+            activity_count = DynamicSurrogate.DRAIN_ACTIVITY
+        return pack_service_data(self._config.getfloat('cpu', 'strength'),
+                                 self._config.getint('cpu', 'cores'),
+                                 activity_count,
+                                 self._config.getint('network', 'speed'),
+                                 self._config.calibration)
+
+    def retain_data_handle(self, data_id, timeout = SurrogateDataStore.DATA_TIMEOUT):
+        # Resolved copies of locally stored data live as long as the data.
+        handle = self.remotedatastore.local_handle(data_id)
+        if handle != None:
+            self.handle_resolver.cache.retain(handle_key(handle), timeout)
+        return self.remotedatastore.retain(data_id, timeout)
 
-    def perform_task_intent(self, failure):
+    def expire_data_handle(self, data_id):
+        handle = self.remotedatastore.local_handle(data_id)
+        if handle != None:
+            self.handle_resolver.cache.expire(handle_key(handle))
+        return self.remotedatastore.expire(data_id)
+
+    def change_activity(self, increment):
+        with self.pending_tasks_lock:
+            self.activity_count += increment
+            activity_count = self.activity_count
+        # The announcer coalesces the changes and talks to Presence in its own
+        # thread, so the lock is never held during a network round trip.
+        self.announcer.set_activity(activity_count)
+
+    def perform_task_intent(self, failure, task_name = None, data_handles = None):
+        """
+        Called by clients that intend to call perform_task.
+        @type failure: bool
+        @param failure: True if the intended call will never be made after all.
+        @type task_name: str
+        @param task_name: The name of the task that will be performed. If given
+        the task is loaded on the cores ahead of the call.
+        @type data_handles: list of RemoteDataHandle
+        @param data_handles: Data handles in the upcoming task input. If given
+        the data is fetched ahead of the call.
+        """
         if failure:
             # There was intent to call the function but it was never in fact called.
             self.change_activity(-1)
         else:
             # Someone has shown intent of calling this funtion.
             self.change_activity(1)
+
+            # Get a head start on the upcoming call.
+            if data_handles:
+                self.handle_resolver.prefetch([handle for handle in data_handles 
+                                               if type(handle) == RemoteDataHandle])
+            if task_name != None:
+                try:
+                    self._ipc.warm_task(task_name)
+                except Exception:
+                    self.__logger.exception('Error warming task %s.'%task_name)
         
-    def perform_task(self, task_name, task_input, timeout = 120, store = False, profile = False):
-        print 'perform %s'%task_name #DEBUG
+    def _record_profile(self, task_name, duration, complexity):
+        # Maintain running averages of the duration and complexity of the task.
+        w = DynamicSurrogate.PROFILE_WEIGHT
+        with self.__stats_lock:
+            try:
+                old_duration, old_complexity = self.task_profiles[task_name]
+                self.task_profiles[task_name] = ((1 - w) * old_duration + w * duration,
+                                                 (1 - w) * old_complexity + w * complexity)
+            except KeyError:
+                self.task_profiles[task_name] = (duration, complexity)
 
-        # Check the task input for data handles that should be resolved.
-        task_input = self._resolve_data_handles_in_input(task_input)
+    def _forwarding_peer(self, task_name, task_input, path):
+        """
+        Decides whether a task should be forwarded to another surrogate.
+        @return: The peer to forward the task to, or None if it should be
+        performed locally.
+        """
+        # Tasks that have not been seen here before are performed locally.
+        try:
+            duration, complexity = self.task_profiles[task_name]
+        except KeyError:
+            return None
+
+        # Predict how long the task will wait for a core.
+        cores = self._config.getint('cpu', 'cores')
+        delay = duration * max(0, self.activity_count - cores) / float(cores)
+        if delay < self._config.getfloat('forwarding', 'threshold'):
+            return None
+
+        # Find the best peer that the request has not already visited, and
+        # check that it is expected to do better than this surrogate.
+        exclude = set(path)
+        exclude.add(self.presence.get_node_name())
+        best = self.context_monitor.best_peers(1, input_size(task_input), complexity, exclude)
+        if len(best) == 0 or best[0][0] >= delay + duration:
+            return None
+        return best[0][1]
+
+    def _draining_peer(self, task_name, task_input, path):
+        """Returns the best peer to take over a task while draining, if any."""
+        try:
+            complexity = self.task_profiles[task_name][1]
+        except KeyError:
+            complexity = 1.0
+        exclude = set(path)
+        exclude.add(self.presence.get_node_name())
+        best = self.context_monitor.best_peers(1, input_size(task_input), complexity, exclude)
+        if len(best) == 0:
+            return None
+        return best[0][1]
+
+    def _data_owner_peer(self, task_name, task_input):
+        """
+        Decides whether a task should be performed by the owner of its input
+        data rather than here, based on the size of the data that would have
+        to be fetched and the announced network speeds.
+        @return: The peer owning the data, or None if the task should be 
+        performed locally.
+        """
+        # Sum up the remote input data per live owner. The sizes are cached
+        # along with the data, so that the owner is only asked once.
+        cache = self.handle_resolver.cache
+        remote_bytes = {}
+        owners = {} # name -> ScavengerPeer
+        for handle in input_handles(task_input):
+            key = handle_key(handle)
+            if self.remotedatastore.has_data(handle) or cache.get(key) is not HandleCache.MISS:
+                continue
+            owner = handle_owner(handle)
+            try:
+                peer = self.context_monitor.get_peer(owner)
+            except KeyError:
+                continue
+            if peer.expires < time():
+                continue
+            size = cache.get_size(key)
+            if size == None:
+                try:
+                    size = call_peer(peer.address, 'data_handle_size', handle.id)
+                except Exception:
+                    self.__logger.exception('Error getting size of data handle from %s.'%owner)
+                    continue
+                if size >= 0:
+                    cache.put_size(key, size)
+            if size > 0:
+                owners[owner] = peer
+                remote_bytes[owner] = remote_bytes.get(owner, 0) + size
+        if len(remote_bytes) == 0:
+            return None
+
+        # Estimate the time it takes to fetch the data of the largest owner.
+        owner, size = max(remote_bytes.items(), key=lambda item: item[1])
+        peer = owners[owner]
+        if peer.expires < time():
+            # The owner went away while it was asked for the sizes.
+            return None
+        speed = min(self._config.getint('network', 'speed'), peer.net)
+        if speed <= 0:
+            return None
+        transfer = size / float(speed)
+        if transfer < self._config.getfloat('locality', 'threshold'):
+            return None
+
+        # Compare fetching and performing the task here with performing it at the owner.
+        try:
+            _, complexity = self.task_profiles[task_name]
+        except KeyError:
+            complexity = 0.0
+        cores = self._config.getint('cpu', 'cores')
+        local = complexity * max(cores, self.activity_count) / (cores * self._config.getfloat('cpu', 'strength'))
+        remote = complexity * PeerIndex.factors(peer)[1]
+        if transfer + local <= remote:
+            return None
+        return peer
+
+    def _forward_task(self, peer, task_name, task_input, timeout, store, profile, contiguous, path, 
+                      trace_id = None):
+        """
+        Forwards a task to a peer and relays its result.
+        @return: The result of the task.
+        @raise ForwardingError: Raised if the task could not be handed to the peer.
+        """
+        try:
+            connection = PeerConnection(peer.address)
+        except Exception, error:
+            raise ForwardingError('Error connecting to %s.'%peer.name, error)
+        try:
+            # Hand the task over. The task code is sent along if the peer lacks it.
+            try:
+                if not connection.call('has_task', task_name):
+                    connection.call('install_task', task_name, self._ipc.fetch_task_code(task_name))
+                connection.call('perform_task_intent', False)
+            except Exception, error:
+                raise ForwardingError('Error preparing %s for the task.'%peer.name, error)
+
+            # Any error from here on is the peer's answer and is relayed as such.
+            self._count('forwarded')
+            self.context_monitor.increment_peer_activity(peer.name)
+            try:
+                return connection.call('perform_task', task_name, task_input, timeout, store, 
+                                       profile, contiguous, tuple(path) + (self.presence.get_node_name(),),
+                                       False, trace_id)
+            finally:
+                self.context_monitor.decrement_peer_activity(peer.name)
+        finally:
+            connection.close()
+
+    def perform_task(self, task_name, task_input, timeout = 120, store = False, profile = False, 
+                     contiguous = False, path = (), allow_redirect = False, trace_id = None, 
+                     detach = False, client_id = None):
+        """
+        Performs a task.
+        @type path: tuple of str
+        @param path: The names of the surrogates that have forwarded this request.
+        This is used to keep forwarded requests from going in loops.
+        @type allow_redirect: bool
+        @param allow_redirect: Whether the client accepts being redirected to 
+        another surrogate, i.e., the owner of large input data. If so, a 
+        TaskRedirect error naming the surrogate may be raised.
+        @type trace_id: str
+        @param trace_id: The id of the trace of the call. Given by peers that 
+        forward a task so that the trace can be followed across surrogates.
+        @type detach: bool
+        @param detach: If True the execution id is returned as soon as the task
+        has been started, and the result is fetched by calling collect_result.
+        Detached tasks are always performed locally.
+        @type client_id: str
+        @param client_id: Identifies the client, so that the number of tasks a 
+        single client may have in progress can be limited.
+        @raise Overloaded: Raised if the task is turned away by the admission 
+        control. The client should retry after the given number of seconds.
+        """
+        try:
+            self.admission.admit(task_name, timeout, client_id)
+        except Overloaded:
+            self.change_activity(-1)
+            raise
+        with self.pending_tasks_lock:
+            self.in_flight += 1
+        trace = Trace(task_name, trace_id)
+        held = False
+        try:
+            result = self._perform_task(trace, task_name, task_input, timeout, store, profile,
+                                        contiguous, path, allow_redirect, detach)
+            if detach:
+                held = self._hold_detached(result, task_name, client_id)
+            return result
+        except Exception, error:
+            trace.error = str(error)
+            raise
+        finally:
+            self.traces.finish(trace)
+            if not held:
+                self.admission.release(task_name, client_id, trace.span_duration('execute'))
+                with self.pending_tasks_lock:
+                    self.in_flight -= 1
+
+    def _perform_task(self, trace, task_name, task_input, timeout, store, profile, 
+                      contiguous, path, allow_redirect, detach):
+        self.__logger.debug('perform %s, trace=%s'%(task_name, trace.trace_id))
+        if len(path) > 0:
+            self._count('received_forwarded')
+
+        # While draining new tasks are passed on to a peer, if there is one.
+        if self.draining:
+            peer = None
+            if not detach and len(path) < self._config.getint('forwarding', 'max_hops'):
+                peer = self._draining_peer(task_name, task_input, path)
+            try:
+                if peer == None:
+                    raise Exception('The surrogate is shutting down.')
+                forward_start = time()
+                try:
+                    result = self._forward_task(peer, task_name, task_input, timeout, store, 
+                                                profile, contiguous, path, trace.trace_id)
+                except ForwardingError, error:
+                    raise Exception('The surrogate is shutting down.', error)
+                trace.span('forward', forward_start)
+                return result
+            finally:
+                self.change_activity(-1)
+        forwarding = self._config.getboolean('forwarding', 'enabled') and \
+                     len(path) < self._config.getint('forwarding', 'max_hops') and not detach
+
+        # Large input data owned by a peer should stay where it is. Either the
+        # client is sent there or the task is forwarded there.
+        peer = None
+        if self._config.getboolean('locality', 'enabled') and not detach and (allow_redirect or forwarding):
+            try:
+                peer = self._data_owner_peer(task_name, task_input)
+            except Exception:
+                # The task is performed here after all.
+                self.__logger.exception('Error locating the owner of the input data.')
+                peer = None
+            if peer != None:
+                if allow_redirect:
+                    self._count('redirected')
+                    self.change_activity(-1)
+                    raise TaskRedirect(peer.name, peer.address)
+                self._count('forwarded_to_data')
+
+        # If this surrogate is saturated the task may be forwarded to a peer.
+        if forwarding:
+            if peer == None:
+                peer = self._forwarding_peer(task_name, task_input, path)
+            if peer != None:
+                forward_start = time()
+                try:
+                    result = self._forward_task(peer, task_name, task_input, timeout, store, 
+                                                profile, contiguous, path, trace.trace_id)
+                except ForwardingError:
+                    trace.span('forward-failed', forward_start)
+                    # Perform the task locally after all.
+                    self._count('forward_failures')
+                    self.__logger.exception('Error forwarding task, performing it locally.')
+                except Exception:
+                    self.change_activity(-1)
+                    raise
+                else:
+                    trace.span('forward', forward_start)
+                    self.change_activity(-1)
+                    return result
+
+        # Start resolving the data handles in the task input. The handles are 
+        # fetched concurrently while the task is dispatched to a core.
+        resolve_start = time()
+        pending_input = self.handle_resolver.resolve_input(task_input)
         
         # Start performing the task.
+        lock_start = time()
         with self.pending_tasks_lock:
-            if profile:
-                start = time()
-                start_activity = self.activity_count
+            trace.span('lock', lock_start)
+            start = time()
+            start_activity = self.activity_count
             try:
                 # Send the message to the execution env.
-                eid = self._ipc.perform_task(task_name, task_input)
+                dispatched = time()
+                if pending_input == None:
+                    eid = self._ipc.perform_task(task_name, task_input, False, trace.context(dispatched))
+                else:
+                    eid = self._ipc.perform_task(task_name, None, True, trace.context(dispatched))
+                trace.execid = eid
                 # Create a Condition object that this worker thread can wait on until 
                 # the execution of the task is done.
                 cond = Condition()
@@ -191,12 +684,35 @@ class DynamicSurrogate(Thread):
             except Exception, error:
                 err_msg = 'Error registering task with execution environment.'
                 raise Exception(err_msg, error)
+
+        # Hand the resolved input over to the waiting task.
+        if pending_input != None:
+            try:
+                task_input, error = pending_input.wait(timeout), None
+            except Exception, excep:
+                task_input, error = None, 'Error resolving data handles: %s'%excep
+            self.latency.record(task_name, 'resolve', time() - resolve_start)
+            trace.span('resolve', resolve_start)
+            self._ipc.supply_input(eid, task_input, error)
+
+        if detach:
+            # The client collects the result with collect_result.
+            self.change_activity(-1)
+            with self.pending_tasks_lock:
+                flaf = self.pending_tasks.pop(eid)
+                if type(flaf) == tuple:
+                    self.unclaimed[eid] = flaf
+            cond.release()
+            return eid
         
-        # Wait for the task to finish -- or for the timer to expire...
-        cond.wait(timeout)
-        if profile:
-            stop = time()
-            stop_activity = self.activity_count
+        # Wait for the task to finish -- or for the timer to expire... The
+        # time spent resolving the input counts against the timeout.
+        if timeout == None:
+            cond.wait()
+        else:
+            cond.wait(max(0.0, resolve_start + timeout - time()))
+        stop = time()
+        stop_activity = self.activity_count
 
         # Check whether the result has been stored in pending_tasks.
         # If not this means that the timeout was reached.
@@ -213,33 +729,33 @@ class DynamicSurrogate(Thread):
             # The result (or an error message is there).
             cond.release()
             del cond
-            rcode, output = flaf
+            rcode, output, timings, delivered = flaf
+            self.latency.record_execution(task_name, dispatched, timings, delivered)
+            trace.add_execution(timings, delivered)
             if rcode == 'RESULT':
+                cores = self._config.getint('cpu', 'cores')
+                activity_level = float(start_activity/cores + stop_activity/cores) / 2
+                if activity_level < 1: activity_level = 1.0
+                complexity = ((stop - start) * self._config.getfloat('cpu', 'strength')) / activity_level
+                self._record_profile(task_name, stop - start, complexity)
                 if store:
                     # We have been asked to store the result here.
+                    store_start = time()
                     if type(output) == tuple:
-                        # Store the output values as individual remote data handles. 
-                        new_output = []
-                        for item in output:
-                            new_output.append(self.remotedatastore.store_data(item))
-                        new_output = tuple(new_output)
+                        # Store the output values as individual remote data handles.
+                        # If asked to, string outputs are kept in one contiguous blob.
+                        new_output = self.remotedatastore.store_many(output, contiguous)
                     else:
                         new_output = self.remotedatastore.store_data(output)
+                    self.latency.record(task_name, 'store', time() - store_start)
+                    trace.span('store', store_start)
 
                     if profile:
-                        cores = self._config.getint('cpu', 'cores')
-                        activity_level = float(start_activity/cores + stop_activity/cores) / 2
-                        if activity_level < 1: activity_level = 1.0
-                        complexity = ((stop - start) * self._config.getfloat('cpu', 'strength')) / activity_level
                         return (new_output, complexity)
                     else:
                         return new_output
                 else:
                     if profile:
-                        cores = self._config.getint('cpu', 'cores')
-                        activity_level = float(start_activity/cores + stop_activity/cores) / 2
-                        if activity_level < 1: activity_level = 1.0
-                        complexity = ((stop - start) * self._config.getfloat('cpu', 'strength')) / activity_level
                         return (output, complexity)
                     else:
                         return output
@@ -253,8 +769,8 @@ class DynamicSurrogate(Thread):
             # The condition object is still there... a timeout must have occurred.
             cond.release()
             del cond
-            err_msg = 'Timeout while performing task.'
-            raise Exception(err_msg)
+            err_msg = 'Timeout while performing task. The result of execution %i may be collected later.'%eid
+            raise Exception(err_msg, eid)
 
     def install_task(self, task_name, task_code):
         try:
@@ -263,34 +779,143 @@ class DynamicSurrogate(Thread):
             err_msg = 'Error installing task. %s'%error.message
             raise Exception(err_msg, error)
 
-    def has_task(self, task_name):
+    def has_task(self, task_name, code_hash = None):
+        """
+        Checks whether a task is installed.
+        @type task_name: str
+        @param task_name: The name of the task.
+        @type code_hash: str
+        @param code_hash: The SHA-1 digest (in hex) of the task code. If given 
+        and the task is not installed, the code is fetched from a peer that has
+        it and installed before answering.
+        @rtype: bool
+        """
         try:
-            return self._ipc.task_exists(task_name)
+            if self._ipc.task_exists(task_name):
+                return True
         except Exception, error:
             raise Exception('Error checking for task. %s'%error.message, error)
+        if code_hash != None:
+            return self._install_task_from_peers(task_name, code_hash)
+        return False
+
+    def fetch_task_code(self, task_name):
+        try:
+            return self._ipc.fetch_task_code(task_name)
+        except Exception, error:
+            raise Exception('Error fetching task code. %s'%error.message, error)
+
+    def task_hash(self, task_name):
+        try:
+            return self._ipc.task_hash(task_name)
+        except Exception, error:
+            raise Exception('Error hashing task code. %s'%error.message, error)
+
+    def _install_task_from_peers(self, task_name, code_hash):
+        """
+        Fetches the code of a task from a peer, verifies it against its hash
+        and installs it. 
+        @rtype: bool
+        @return: Whether the task was installed.
+        """
+        # Concurrent requests for the same task wait for a single fetch.
+        with self.__fetch_locks_lock:
+            lock = self.__fetch_locks.setdefault(task_name, allocate_lock())
+        with lock:
+            if self._ipc.task_exists(task_name):
+                return True
+            return self.__fetch_task(task_name, code_hash)
+
+    def __fetch_task(self, task_name, code_hash):
+        # Try the peers with the fastest network first.
+        peers = sorted(self.context_monitor.get_peers(), key=lambda peer: peer.net, reverse=True)
+        own_name = self.presence.get_node_name()
+        for peer in peers:
+            if peer.name == own_name:
+                continue
+            try:
+                connection = PeerConnection(peer.address)
+                try:
+                    if connection.call('task_hash', task_name) != code_hash:
+                        continue
+                    task_code = connection.call('fetch_task_code', task_name)
+                finally:
+                    connection.close()
+            except Exception:
+                self.__logger.exception('Error fetching task code from %s.'%peer.name)
+                continue
+
+            # Never trust the peer, check the code against the hash. The code
+            # is validated as usual when it is installed.
+            if hashlib.sha1(task_code).hexdigest() != code_hash:
+                self.__logger.error('Task code from %s does not match its hash.'%peer.name)
+                continue
+            try:
+                self.install_task(task_name, task_code)
+            except Exception:
+                self.__logger.exception('Error installing task code from %s.'%peer.name)
+                # The task may have been installed by a client in the meantime.
+                try:
+                    return self._ipc.task_exists(task_name)
+                except Exception:
+                    return False
+            self._count('tasks_fetched')
+            return True
+        return False
+
+    def _measure_link(self, peer):
+        """Replaces the detected network speed with the throughput measured against a peer."""
+        try:
+            speed = measure_throughput(peer.address)
+        except Exception:
+            self.__logger.exception('Error measuring the link speed to %s.'%peer.name)
+            # Try again with another peer later.
+            sleep(60)
+            self.__link_measurement = None
+            return
+        self.__logger.info('Measured link speed to %s: %i bytes/s'%(peer.name, speed))
+        self._config.set_runtime('network', 'speed', str(speed))
+        self.announcer.announce()
 
     def serve(self):
         self.rpc_server.run()
 
     def run(self):
         # Thread body - this is used for any periodic maintenance etc.
-        cpu_strength = self._config.getfloat('cpu', 'strength')
-        cpu_cores = self._config.getint('cpu', 'cores')
-        network_speed = self._config.getint('network', 'speed')
+        # (The Presence service is refreshed by the announcer.)
         period_count = 0
         while not self.__shutdown:
-            # Update the Presence service every period.
-            with self.pending_tasks_lock:
-                self.service.data = struct.pack("!fIII", 
-                                                cpu_strength,
-                                                cpu_cores,
-                                                self.activity_count,
-                                                network_speed)
-                self.presence.update_service(self.service)
-            
-            # Cleanup the data store every 10th period.
+            # Drop peers that have not been announced for a while.
+            self.context_monitor.expire_peers()
+
+            # Let the data store clean up if its memory budget is exceeded or
+            # stored data has expired.
+            self.remotedatastore.maintain()
+
+            # Cleanup the data handle cache every 10th period.
             if period_count % 10 == 0:
-                self.remotedatastore.cleanup()
+                self.handle_resolver.cache.cleanup()
+                self._expire_unclaimed()
+
+            # The executions checkpointed by the daemon this one took over 
+            # from are resumed once it has exited.
+            if self.__predecessor != None and not process_exists(self.__predecessor):
+                self.__predecessor = None
+                try:
+                    self._ipc.resume_checkpoints()
+                except Exception:
+                    self.__logger.exception('Error resuming checkpointed executions.')
+
+            # Measure the link speed once a peer is known, if asked to.
+            if self.__link_measurement == None and \
+                    self._config.getboolean('network', 'measure') and \
+                    self._config.is_runtime('network', 'speed'):
+                own_name = self.presence.get_node_name()
+                peers = [peer for peer in self.context_monitor.get_peers() if peer.name != own_name]
+                if len(peers) > 0:
+                    self.__link_measurement = Thread(target=self._measure_link, args=(peers[0],))
+                    self.__link_measurement.daemon = True
+                    self.__link_measurement.start()
 
             # Wait for another second...
             period_count += 1
@@ -0,0 +1,319 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the local cache of resolved RemoteDataHandles and the
+resolver that the surrogates use to fetch the data handles found in task
+input.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from collections import OrderedDict
+from time import time
+from datastore import RemoteDataHandle
+from workerpool import PendingResult
+import sys
+
+def handle_key(handle):
+    """
+    Returns a hashable key identifying the data that a handle points to.
+    Two handle objects pointing to the same data (e.g., the same handle
+    unpickled twice) have the same key.
+    """
+    return tuple(sorted(handle.__dict__.items()))
+
+def handle_owner(handle):
+    """Returns the name (or address) of the node owning the data of a handle."""
+    return handle.address
+
+def input_values(task_input):
+    """Returns the argument values of a task input."""
+    if type(task_input) == dict:
+        return task_input.values()
+    elif type(task_input) in (tuple, list):
+        return task_input
+    else:
+        return (task_input,)
+
+def input_handles(task_input):
+    """Returns the data handles in a task input."""
+    return [value for value in input_values(task_input) if type(value) == RemoteDataHandle]
+
+def data_size(data, depth = 4):
+    """
+    Returns the (approximate) number of bytes used by a piece of data,
+    including the values it contains down to the given depth.
+    """
+    if type(data) in (str, unicode, buffer, bytearray):
+        return len(data)
+    size = sys.getsizeof(data)
+    if depth > 0:
+        if type(data) == dict:
+            for key, value in data.iteritems():
+                size += data_size(key, depth - 1) + data_size(value, depth - 1)
+        elif type(data) in (list, tuple, set, frozenset):
+            for value in data:
+                size += data_size(value, depth - 1)
+        elif type(getattr(data, '__dict__', None)) == dict:
+            size += data_size(data.__dict__, depth - 1)
+    return size
+
+def input_size(task_input):
+    """
+    Returns the (approximate) number of bytes used by a task input. Data
+    handles are not counted, as they are small until resolved.
+    """
+    return sum([data_size(value) for value in input_values(task_input) if type(value) != RemoteDataHandle])
+
+class HandleCache(object):
+    """
+    A size-bounded cache of resolved data. Entries are evicted in least
+    recently used order when the cache is full, and each entry lives for
+    a limited amount of time unless it is retained - just like the entries
+    of the data store itself.
+    """
+
+    DEFAULT_TIMEOUT = 300.0
+    # The maximum number of data sizes kept, see put_size.
+    MAX_SIZES = 10000
+    MISS = object()
+
+    def __init__(self, max_size, timeout = DEFAULT_TIMEOUT):
+        """
+        Constructor.
+        @type max_size: int
+        @param max_size: The maximum number of bytes to keep in the cache.
+        @type timeout: float
+        @param timeout: The number of seconds an entry lives after it was
+        stored or last retained.
+        """
+        super(HandleCache, self).__init__()
+        self.__entries = OrderedDict() # key -> [data, size, expiry time]
+        self.__size = 0
+        self.__max_size = max_size
+        self.__timeout = timeout
+        self.__sizes = OrderedDict() # key -> size of the data, in LRU order.
+        self._lock = allocate_lock()
+
+    def get(self, key):
+        """
+        Looks up a cache entry.
+        @return: The cached data, or HandleCache.MISS if it is not in the cache.
+        """
+        with self._lock:
+            try:
+                entry = self.__entries.pop(key)
+            except KeyError:
+                return HandleCache.MISS
+            if entry[2] < time():
+                self.__size -= entry[1]
+                return HandleCache.MISS
+            # Re-insert the entry to mark it as most recently used.
+            self.__entries[key] = entry
+            return entry[0]
+
+    def put(self, key, data):
+        size = data_size(data)
+        if size > self.__max_size:
+            # The data would evict everything else. Do not cache it.
+            return
+        with self._lock:
+            if self.__entries.has_key(key):
+                self.__size -= self.__entries.pop(key)[1]
+            self.__entries[key] = [data, size, time() + self.__timeout]
+            self.__size += size
+            # Evict the least recently used entries until there is room.
+            while self.__size > self.__max_size:
+                _, entry = self.__entries.popitem(last=False)
+                self.__size -= entry[1]
+
+    def retain(self, key, timeout = None):
+        """Extends the lifetime of an entry."""
+        if timeout == None:
+            timeout = self.__timeout
+        with self._lock:
+            if self.__entries.has_key(key):
+                self.__entries[key][2] = time() + timeout
+
+    def expire(self, key):
+        """Removes an entry from the cache."""
+        with self._lock:
+            self.__sizes.pop(key, None)
+            if self.__entries.has_key(key):
+                self.__size -= self.__entries.pop(key)[1]
+
+    def get_size(self, key):
+        """
+        Returns the size of the data of a handle, as given to put_size.
+        @rtype: int
+        @return: The size in bytes, or None if it is not known.
+        """
+        with self._lock:
+            try:
+                size = self.__sizes.pop(key)
+            except KeyError:
+                return None
+            self.__sizes[key] = size
+            return size
+
+    def put_size(self, key, size):
+        """
+        Records the size of the data of a handle, e.g., as told by its owner.
+        The data of a handle never changes, so the size is kept whether or
+        not the data is cached.
+        """
+        with self._lock:
+            self.__sizes.pop(key, None)
+            self.__sizes[key] = size
+            while len(self.__sizes) > HandleCache.MAX_SIZES:
+                self.__sizes.popitem(last=False)
+
+    def cleanup(self):
+        """Removes all entries whose lifetime has run out."""
+        now = time()
+        with self._lock:
+            for key, entry in self.__entries.items():
+                if entry[2] < now:
+                    self.__size -= self.__entries.pop(key)[1]
+
+    def size(self):
+        return self.__size
+
+    def __len__(self):
+        return len(self.__entries)
+
+class PendingInput(object):
+    """Task input whose data handles are being resolved."""
+
+    def __init__(self, task_input, pending):
+        super(PendingInput, self).__init__()
+        self.__task_input = task_input
+        self.__pending = pending
+
+    def wait(self, timeout = None):
+        """
+        Waits for all handles to be resolved.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait in total.
+        @return: The task input with all handles replaced by their data.
+        @raise Exception: Raised if a handle could not be resolved in time.
+        """
+        if timeout != None:
+            deadline = time() + timeout
+        resolved = {}
+        for key, result in self.__pending.items():
+            if timeout == None:
+                resolved[key] = result.wait()
+            else:
+                resolved[key] = result.wait(max(0.0, deadline - time()))
+
+        # Plug the data into (a copy of) the input.
+        if type(self.__task_input) == dict:
+            task_input = dict(self.__task_input)
+        elif type(self.__task_input) in (tuple, list):
+            task_input = list(self.__task_input)
+        else:
+            return resolved[None]
+        for key, data in resolved.items():
+            task_input[key] = data
+        return task_input
+
+class HandleResolver(object):
+    """
+    Resolves the data handles found in task input. All handles in a single
+    input are fetched concurrently by a worker pool, resolved data is kept
+    in a HandleCache, and concurrent requests for the same handle share a
+    single fetch.
+    """
+
+    def __init__(self, resolve_function, cache, pool):
+        """
+        Constructor.
+        @type resolve_function: callable
+        @param resolve_function: Function that fetches the data of a handle.
+        @type cache: HandleCache
+        @param cache: The cache that resolved data is stored in.
+        @type pool: WorkerPool
+        @param pool: The worker pool performing the fetches.
+        """
+        super(HandleResolver, self).__init__()
+        self._resolve_function = resolve_function
+        self.cache = cache
+        self._pool = pool
+        self.__in_flight = {} # key -> PendingResult
+        self._lock = allocate_lock()
+
+    def resolve(self, handle):
+        """
+        Starts resolving a single handle.
+        @type handle: RemoteDataHandle
+        @param handle: The handle to resolve.
+        @rtype: PendingResult
+        @return: The pending data.
+        """
+        key = handle_key(handle)
+        with self._lock:
+            data = self.cache.get(key)
+            if data is not HandleCache.MISS:
+                result = PendingResult()
+                result.set_result(data)
+                return result
+            try:
+                return self.__in_flight[key]
+            except KeyError:
+                result = self._pool.submit(self.__fetch, key, handle)
+                self.__in_flight[key] = result
+                return result
+
+    def prefetch(self, handles):
+        """Starts resolving the given handles without waiting for them."""
+        for handle in handles:
+            self.resolve(handle)
+
+    def resolve_input(self, task_input):
+        """
+        Starts resolving all data handles in the given task input.
+        @type task_input: dict (kwargs), tuple (pos args), or any (single argument).
+        @param task_input: The task input.
+        @rtype: PendingInput
+        @return: The pending task input, or None if the input does not
+        contain any data handles.
+        """
+        if type(task_input) == dict:
+            pending = dict([(key, self.resolve(value)) for key, value in task_input.items()
+                            if type(value) == RemoteDataHandle])
+        elif type(task_input) in (tuple, list):
+            pending = dict([(index, self.resolve(value)) for index, value in enumerate(task_input)
+                            if type(value) == RemoteDataHandle])
+        elif type(task_input) == RemoteDataHandle:
+            pending = {None : self.resolve(task_input)}
+        else:
+            pending = {}
+        if len(pending) == 0:
+            return None
+        return PendingInput(task_input, pending)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def __fetch(self, key, handle):
+        try:
+            data = self._resolve_function(handle)
+            self.cache.put(key, data)
+            return data
+        finally:
+            with self._lock:
+                self.__in_flight.pop(key, None)
@@ -0,0 +1,199 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the latency histograms that record where the time goes
+in the life of a task.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from math import frexp
+
+class Histogram(object):
+    """
+    A histogram of durations with exponentially growing buckets. Bucket i
+    holds the durations up to 2**(MIN_EXPONENT + i) seconds (the last one
+    holds everything longer as well), so recording a value is a frexp call
+    and a list increment.
+    """
+
+    MIN_EXPONENT = -20 # ~1 microsecond
+    MAX_EXPONENT = 8 # 256 seconds
+
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.buckets = [0] * (Histogram.MAX_EXPONENT - Histogram.MIN_EXPONENT + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Records a duration.
+        @type value: float
+        @param value: The duration in seconds.
+        """
+        if value <= 0:
+            # Clocks of different processes may disagree slightly.
+            value = 0.0
+            index = 0
+        else:
+            exponent = frexp(value)[1]
+            index = min(max(exponent, Histogram.MIN_EXPONENT), Histogram.MAX_EXPONENT) - Histogram.MIN_EXPONENT
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+    @staticmethod
+    def bound(index):
+        """Returns the upper bound (in seconds) of a bucket."""
+        return 2.0 ** (Histogram.MIN_EXPONENT + index)
+
+    def percentile(self, percent):
+        """
+        Returns an upper bound of the given percentile of the recorded durations.
+        @type percent: float
+        @param percent: The percentile, e.g., 99.0.
+        """
+        if self.count == 0:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                if index == len(self.buckets) - 1:
+                    return self.max
+                return min(Histogram.bound(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count' : self.count, 'sum' : self.sum, 'min' : self.min, 'max' : self.max,
+                'p50' : self.percentile(50.0), 'p90' : self.percentile(90.0),
+                'p99' : self.percentile(99.0),
+                'buckets' : dict([(Histogram.bound(index), count) for index, count in enumerate(self.buckets)
+                                  if count > 0])}
+
+class LatencyStats(object):
+    """Latency histograms per task name and stage."""
+
+    # The stages of a task's life, in order.
+    STAGES = ('resolve', 'dispatch', 'queue', 'execute', 'callback', 'store')
+
+    def __init__(self):
+        super(LatencyStats, self).__init__()
+        self.__histograms = {} # (task name, stage) -> Histogram
+        self.__cores = {} # core name -> [executions, seconds spent executing]
+        self._lock = allocate_lock()
+
+    def record(self, task_name, stage, value):
+        """
+        Records the duration of a stage.
+        @type task_name: str
+        @param task_name: The name of the task.
+        @type stage: str
+        @param stage: The stage, see LatencyStats.STAGES.
+        @type value: float
+        @param value: The duration in seconds.
+        """
+        with self._lock:
+            try:
+                histogram = self.__histograms[(task_name, stage)]
+            except KeyError:
+                histogram = self.__histograms[(task_name, stage)] = Histogram()
+            histogram.add(value)
+
+    def record_execution(self, task_name, dispatched, timings, delivered):
+        """
+        Records the stages of an execution that are timed by the execution
+        environment.
+        @type dispatched: float
+        @param dispatched: The time the task was handed to the execution environment.
+        @type timings: dict
+        @param timings: The timestamps recorded by the core performing the task
+        ('received', 'started', 'finished' and 'sent', plus 'input' if the
+        input was deferred) and the name of the core ('core').
+        @type delivered: float
+        @param delivered: The time the result reached the surrogate.
+        """
+        if not timings:
+            return
+        try:
+            self.record(task_name, 'dispatch', timings['received'] - dispatched)
+            self.record(task_name, 'queue', timings['started'] - timings['received'])
+            executing = timings['finished'] - timings.get('input', timings['started'])
+            self.record(task_name, 'execute', executing)
+            self.record(task_name, 'callback', delivered - timings['sent'])
+        except KeyError:
+            # The task did not get all the way.
+            return
+        name = timings.get('core')
+        with self._lock:
+            try:
+                core = self.__cores[name]
+            except KeyError:
+                core = self.__cores[name] = [0, 0.0]
+            core[0] += 1
+            core[1] += executing
+
+    def core_snapshot(self):
+        """
+        Returns the load of the cores.
+        @rtype: dict
+        @return: Maps core names to (executions, seconds spent executing) tuples.
+        """
+        with self._lock:
+            return dict([(name, tuple(core)) for name, core in self.__cores.items()])
+
+    def snapshot(self):
+        """
+        Returns the histograms.
+        @rtype: dict
+        @return: Maps task names to dicts mapping stages to histograms (see Histogram.to_dict).
+        """
+        stats = {}
+        with self._lock:
+            for (task_name, stage), histogram in self.__histograms.items():
+                stats.setdefault(task_name, {})[stage] = histogram.to_dict()
+        return stats
+
+    def export_text(self, prefix = 'scavenger'):
+        """
+        Returns the histograms in the Prometheus text exposition format.
+        @rtype: str
+        """
+        name = '%s_stage_seconds'%prefix
+        lines = ['# HELP %s Time spent in each stage of a task.'%name,
+                 '# TYPE %s histogram'%name]
+        with self._lock:
+            items = sorted(self.__histograms.items())
+            for (task_name, stage), histogram in items:
+                labels = 'task="%s",stage="%s"'%(task_name, stage)
+                cumulative = 0
+                # The last bucket also holds everything longer, so it is only
+                # exported as +Inf.
+                for index, count in enumerate(histogram.buckets[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%g"} %i'%(name, labels, Histogram.bound(index), cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %i'%(name, labels, histogram.count))
+                lines.append('%s_sum{%s} %r'%(name, labels, histogram.sum))
+                lines.append('%s_count{%s} %i'%(name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
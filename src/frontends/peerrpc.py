@@ -0,0 +1,82 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers for calling the RPC functions of other surrogates.
+"""
+
+from scrpc import SCRPCProxy
+from time import time
+
+class PeerConnection(object):
+    """A connection to the RPC server of another surrogate."""
+
+    def __init__(self, address):
+        """
+        Constructor.
+        @type address: (str, int)
+        @param address: The RPC address of the peer.
+        """
+        super(PeerConnection, self).__init__()
+        self.address = address
+        self.__proxy = SCRPCProxy(address[0], address[1])
+
+    def call(self, function, *args):
+        """
+        Calls an RPC function on the peer.
+        @type function: str
+        @param function: The name of the function.
+        @return: The return value of the function.
+        """
+        return getattr(self.__proxy, function)(*args)
+
+    def close(self):
+        self.__proxy.close()
+
+def call_peer(address, function, *args):
+    """Calls a single RPC function on the peer at the given address."""
+    connection = PeerConnection(address)
+    try:
+        return connection.call(function, *args)
+    finally:
+        connection.close()
+
+def measure_throughput(address, size = 256 * 1024, rounds = 3):
+    """
+    Measures the throughput of the link to a peer by echoing data off its
+    ping function.
+    @type size: int
+    @param size: The number of bytes sent in each round.
+    @type rounds: int
+    @param rounds: The number of rounds. The fastest round counts.
+    @rtype: int
+    @return: The throughput in bytes/second.
+    """
+    payload = '\x00' * size
+    connection = PeerConnection(address)
+    try:
+        # Make sure that the connection is established before timing.
+        connection.call('ping', '')
+        best = None
+        for _ in range(0, rounds):
+            start = time()
+            connection.call('ping', payload)
+            elapsed = time() - start
+            if best == None or elapsed < best:
+                best = elapsed
+    finally:
+        connection.close()
+    # The payload travels both ways.
+    return int(2 * size / max(best, 1e-6))
@@ -7,20 +7,35 @@ from pexecenv import Jailor
 from time import sleep, time
 # TODO: Why is the full path for Config needed here!?
 from frontends.daemonconfig import Config
-from datastore import RemoteDataStore, RemoteDataHandle
+from datastore import RemoteDataHandle
+from frontends.surrogatestore import SurrogateDataStore
+from frontends.handlecache import HandleCache, HandleResolver, handle_key
+from frontends.workerpool import WorkerPool
+from frontends.histogram import LatencyStats
+from frontends.tracing import Trace, TraceBuffer
+from frontends.admission import AdmissionControl, Overloaded
+from frontends.detection import process_exists
 import logging
 
 class StaticSurrogate(Thread):
     CALLBACK_TIMEOUT = 5.0
     MAINT_POLL = 1.0
+    DRAIN_POLL = 0.1
     
-    def __init__(self, debug_jail = False):
+    def __init__(self, debug_jail = False, predecessor = None):
         super(StaticSurrogate, self).__init__()
         
         # Set member variables.
         self.pending_tasks = {}
         self.pending_tasks_lock = allocate_lock()
+        self.unclaimed = {} # execid -> results that no client is waiting for.
+        self.detached = {} # execid -> (task name, client id) of detached tasks in progress.
+        self.in_flight = 0 # The number of perform_task calls in progress.
+        self.draining = False
         self.activity_count = 0
+        # The process id of a draining daemon that this one takes over from.
+        self.__predecessor = predecessor
+        self.latency = LatencyStats()
         self.__shutdown = False
         
         # Get a logger.
@@ -28,6 +43,12 @@ class StaticSurrogate(Thread):
 
         # Get a config handle.
         self._config = Config.get_instance()
+        self.traces = TraceBuffer(self._config.getint('tracing', 'buffer'),
+                                  self._config.getfloat('tracing', 'threshold'),
+                                  self._config.getfloat('tracing', 'sample_rate'))
+        self.admission = AdmissionControl(self._config.getint('cpu', 'cores'),
+                                          self._config.getint('admission', 'queue_depth'),
+                                          self._config.getint('admission', 'client_limit'))
         # Check that the "static" section contains a node name.
         if not self._config.has_section('static') or not self._config.has_option('static', 'name'):
             self.__logger.error("Static surrogate name is missing in the config file.")
@@ -36,7 +57,16 @@ class StaticSurrogate(Thread):
         # Start the execution environment.
         self._ipc, remote_pipe = EIPC.eipc_pair()
         self._ipc.start()
-        self.__exec_env = Jailor(remote_pipe, self._config.getint('cpu', 'cores'), debug=debug_jail)
+        checkpoint_dir = None
+        if self._config.getboolean('checkpoint', 'enabled'):
+            checkpoint_dir = self._config.get('checkpoint', 'directory')
+        self.__exec_env = Jailor(remote_pipe, self._config.getint('cpu', 'cores'), 
+                                 basedir=self._config.get('tasks', 'basedir'), debug=debug_jail,
+                                 checkpoint_dir=checkpoint_dir, 
+                                 checkpoint_interval=self._config.getfloat('checkpoint', 'interval'),
+                                 preload_modules=self._config.getlist('preload', 'modules'),
+                                 preload_tasks=self._config.getlist('preload', 'tasks'),
+                                 handoff=predecessor != None)
         self.__exec_env.start()
 
         # Register the callback function.
@@ -51,6 +81,9 @@ class StaticSurrogate(Thread):
             self.rpc_server.register_function(self.install_task)
             self.rpc_server.register_function(self.has_task)
             self.rpc_server.register_function(self.ping)
+            self.rpc_server.register_function(self.get_stats)
+            self.rpc_server.register_function(self.dump_traces)
+            self.rpc_server.register_function(self.collect_result)
             self.__logger.info('StaticSurrogate daemon is listening on port %i'%scavenger_port)
         except Exception, e:
             self.__logger.exception('Error creating RPC server.')
@@ -65,19 +98,51 @@ class StaticSurrogate(Thread):
         address = address.split(', ')
         address[1] = int(address[1])
         address = tuple(address)
-        self.remotedatastore = RemoteDataStore(address)
+        self.remotedatastore = SurrogateDataStore(address,
+                                                  self._config.getint('datastore', 'memory'),
+                                                  self._config.get('datastore', 'directory'))
         self.rpc_server.register_function(self.remotedatastore.fetch_data, 'resolve_data_handle')
-        self.rpc_server.register_function(self.remotedatastore.retain, 'retain_data_handle')
-        self.rpc_server.register_function(self.remotedatastore.expire, 'expire_data_handle')
+        self.rpc_server.register_function(self.retain_data_handle, 'retain_data_handle')
+        self.rpc_server.register_function(self.expire_data_handle, 'expire_data_handle')
         self.rpc_server.register_function(self.remotedatastore.store_data, 'store_data')
+        self.rpc_server.register_function(self.remotedatastore.data_size, 'data_handle_size')
+
+        # Create the resolver (and cache) for data handles in task input.
+        self.handle_resolver = HandleResolver(self._resolve_data_handle,
+                                              HandleCache(self._config.getint('datacache', 'size'),
+                                                          self._config.getfloat('datacache', 'timeout')),
+                                              WorkerPool(self._config.getint('datacache', 'workers'), 'resolver'))
 
         # Start the maintenance thread.
         self.start()
      
-    def shutdown(self):
+    def shutdown(self, handoff = False):
         self.__shutdown = True
         self.__exec_env.shutdown()
         self.rpc_server.stop()
+        self.handle_resolver.shutdown()
+    
+    def drain(self, deadline, handoff = False):
+        """
+        Stops taking on new tasks and waits for the perform_task calls in 
+        progress to finish. New tasks are rejected.
+        @type deadline: float
+        @param deadline: The maximum number of seconds to wait.
+        @type handoff: bool
+        @param handoff: Whether a new daemon has taken over. This makes no 
+        difference to a static surrogate.
+        @rtype: bool
+        @return: True if all calls finished before the deadline.
+        """
+        self.draining = True
+        end = time() + deadline
+        while time() < end:
+            with self.pending_tasks_lock:
+                if self.in_flight == 0:
+                    return True
+            sleep(StaticSurrogate.DRAIN_POLL)
+        self.__logger.warning('%i task(s) still in progress after draining.'%self.in_flight)
+        return False
     
     def ping(self, flaf):
         """
@@ -85,17 +150,50 @@ class StaticSurrogate(Thread):
         """
         return flaf    
 
-    def task_callback(self, rcode, eid, output):
+    def get_stats(self, text = False):
+        """
+        Returns the latency histograms and the load of the cores of the surrogate.
+        @type text: bool
+        @param text: Whether to return the histograms in the Prometheus text 
+        format instead.
+        @rtype: dict (or str)
+        """
+        if text:
+            return self.latency.export_text()
+        return {'latency' : self.latency.snapshot(), 'cores' : self.latency.core_snapshot(),
+                'admission' : self.admission.snapshot()}
+
+    def dump_traces(self, limit = None, trace_id = None):
+        """
+        Returns the traces of slow, failed and sampled executions (see TraceBuffer.dump).
+        @type limit: int
+        @param limit: The maximum number of traces to return.
+        @type trace_id: str
+        @param trace_id: If given only the trace with this id is returned.
+        @rtype: dict
+        """
+        return self.traces.dump(limit, trace_id)
+
+    def task_callback(self, rcode, eid, output, timings = None):
+        # A detached task releases its admission slot once it is done.
+        with self.pending_tasks_lock:
+            held = self.detached.pop(eid, None)
+        if held != None:
+            self._release_detached(held[0], held[1], timings)
+
         # Find the Condition object that the worker thread is waiting on.  
         with self.pending_tasks_lock:
             try:
                 cond = self.pending_tasks[eid]
             except KeyError:
-                # The execution id was unknown. This means that the operation has timed out.
+                # The execution id was unknown. This means that the operation has 
+                # timed out, was detached, or was resumed after a restart. The 
+                # result is kept for the client to collect.
+                self.unclaimed[eid] = (rcode, output, timings, time())
                 return
             
             # Store the return code and output for the caller to fetch.
-            self.pending_tasks[eid] = (rcode, output)
+            self.pending_tasks[eid] = (rcode, output, timings, time())
                 
         # Now the return code and output has been placed so that the waiting
         # thread can access it. Time to awaken the sleeper...
@@ -103,53 +201,182 @@ class StaticSurrogate(Thread):
         cond.notify()
         cond.release()
 
-    def _resolve_data_handles_in_input(self, task_input):
-        if type(task_input) == dict:
-            # Keyword arguments.
-            for key, value in task_input.items():
-                if type(value) == RemoteDataHandle:
-                    task_input[key] = self.remotedatastore.resolve_data_handle(value)
-        elif type(task_input) in (tuple, list):
-            # Positional arguments.
-            new_list = []
-            for value in task_input:
-                if type(value) == RemoteDataHandle:
-                    new_list.append(self.remotedatastore.resolve_data_handle(value))
-                else:
-                    new_list.append(value)
-            task_input = new_list
+    def _hold_detached(self, eid, task_name, client_id):
+        # Makes a detached task hold on to its admission slot (and count as in
+        # flight) until it is done. Returns False if it is done already.
+        with self.pending_tasks_lock:
+            if self.unclaimed.has_key(eid):
+                return False
+            self.detached[eid] = (task_name, client_id)
+            return True
+
+    def _release_detached(self, task_name, client_id, timings):
+        duration = None
+        if timings:
+            start = timings.get('input', timings.get('started'))
+            if start != None and timings.get('finished') != None:
+                duration = timings['finished'] - start
+        self.admission.release(task_name, client_id, duration)
+        with self.pending_tasks_lock:
+            self.in_flight -= 1
+
+    def _expire_unclaimed(self):
+        # Drop the results that have not been collected in time.
+        expiry = time() - self._config.getfloat('checkpoint', 'keep')
+        with self.pending_tasks_lock:
+            for eid, result in self.unclaimed.items():
+                if result[3] < expiry:
+                    del self.unclaimed[eid]
+
+    def collect_result(self, execid, timeout = 120):
+        """
+        Returns the result of an execution that nobody waited for, i.e., one
+        that was detached, that timed out, or that was resumed from a 
+        checkpoint after a restart. 
+        @type execid: int
+        @param execid: The execution id returned by perform_task (with detach 
+        set) or given in its timeout error.
+        @type timeout: float
+        @param timeout: The number of seconds to wait for the execution to finish.
+        """
+        with self.pending_tasks_lock:
+            flaf = self.unclaimed.pop(execid, None)
+            if flaf == None:
+                if self.pending_tasks.has_key(execid):
+                    raise Exception('The result of execution %i is already awaited.'%execid)
+                cond = Condition()
+                cond.acquire()
+                self.pending_tasks[execid] = cond
+        if flaf == None:
+            cond.wait(timeout)
+            with self.pending_tasks_lock:
+                flaf = self.pending_tasks.pop(execid)
+            cond.release()
+            if type(flaf) != tuple:
+                raise Exception('Timeout while collecting the result of execution %i.'%execid, execid)
+
+        rcode, output, _, _ = flaf
+        if rcode == 'RESULT':
+            return output
+        elif rcode == 'ERROR':
+            raise Exception('Exception thrown within task: %s'%output)
         else:
-            # Single argument.
-            if type(task_input) == RemoteDataHandle:
-                task_input = self.remotedatastore.resolve_data_handle(task_input)
-        return task_input
+            raise Exception('Unknown return code: %s'%rcode)
+
+    def _resolve_data_handle(self, handle):
+        return self.remotedatastore.resolve_data_handle(handle)
+
+    def retain_data_handle(self, data_id, timeout = SurrogateDataStore.DATA_TIMEOUT):
+        # Resolved copies of locally stored data live as long as the data.
+        handle = self.remotedatastore.local_handle(data_id)
+        if handle != None:
+            self.handle_resolver.cache.retain(handle_key(handle), timeout)
+        return self.remotedatastore.retain(data_id, timeout)
+
+    def expire_data_handle(self, data_id):
+        handle = self.remotedatastore.local_handle(data_id)
+        if handle != None:
+            self.handle_resolver.cache.expire(handle_key(handle))
+        return self.remotedatastore.expire(data_id)
 
     def change_activity(self, increment):
         with self.pending_tasks_lock:
             self.activity_count += increment
 
-    def perform_task_intent(self, failure):
+    def perform_task_intent(self, failure, task_name = None, data_handles = None):
+        """
+        Called by clients that intend to call perform_task.
+        @type failure: bool
+        @param failure: True if the intended call will never be made after all.
+        @type task_name: str
+        @param task_name: The name of the task that will be performed. If given
+        the task is loaded on the cores ahead of the call.
+        @type data_handles: list of RemoteDataHandle
+        @param data_handles: Data handles in the upcoming task input. If given
+        the data is fetched ahead of the call.
+        """
         if failure:
             # There was intent to call the function but it was never in fact called.
             self.change_activity(-1)
         else:
             # Someone has shown intent of calling this funtion.
             self.change_activity(1)
+
+            # Get a head start on the upcoming call.
+            if data_handles:
+                self.handle_resolver.prefetch([handle for handle in data_handles 
+                                               if type(handle) == RemoteDataHandle])
+            if task_name != None:
+                try:
+                    self._ipc.warm_task(task_name)
+                except Exception:
+                    self.__logger.exception('Error warming task %s.'%task_name)
         
-    def perform_task(self, task_name, task_input, timeout = 120, store = False, profile = False):
-        print 'perform %s'%task_name #DEBUG
+    def perform_task(self, task_name, task_input, timeout = 120, store = False, profile = False, contiguous = False,
+                     detach = False, client_id = None):
+        """
+        Performs a task.
+        @type detach: bool
+        @param detach: If True the execution id is returned as soon as the task
+        has been started, and the result is fetched by calling collect_result.
+        @type client_id: str
+        @param client_id: Identifies the client, so that the number of tasks a 
+        single client may have in progress can be limited.
+        @raise Overloaded: Raised if the task is turned away by the admission 
+        control. The client should retry after the given number of seconds.
+        """
+        try:
+            self.admission.admit(task_name, timeout, client_id)
+        except Overloaded:
+            self.change_activity(-1)
+            raise
+        with self.pending_tasks_lock:
+            if self.draining:
+                self.activity_count -= 1
+                self.admission.release(task_name, client_id)
+                raise Exception('The surrogate is shutting down.')
+            self.in_flight += 1
+        trace = Trace(task_name)
+        held = False
+        try:
+            result = self._perform_task(trace, task_name, task_input, timeout, store, profile, contiguous,
+                                        detach)
+            if detach:
+                held = self._hold_detached(result, task_name, client_id)
+            return result
+        except Exception, error:
+            trace.error = str(error)
+            raise
+        finally:
+            self.traces.finish(trace)
+            if not held:
+                self.admission.release(task_name, client_id, trace.span_duration('execute'))
+                with self.pending_tasks_lock:
+                    self.in_flight -= 1
 
-        # Check the task input for data handles that should be resolved.
-        task_input = self._resolve_data_handles_in_input(task_input)
+    def _perform_task(self, trace, task_name, task_input, timeout, store, profile, contiguous, detach):
+        self.__logger.debug('perform %s, trace=%s'%(task_name, trace.trace_id))
+
+        # Start resolving the data handles in the task input. The handles are 
+        # fetched concurrently while the task is dispatched to a core.
+        resolve_start = time()
+        pending_input = self.handle_resolver.resolve_input(task_input)
         
         # Start performing the task.
+        lock_start = time()
         with self.pending_tasks_lock:
+            trace.span('lock', lock_start)
             if profile:
                 start = time()
                 start_activity = self.activity_count
             try:
                 # Send the message to the execution env.
-                eid = self._ipc.perform_task(task_name, task_input)
+                dispatched = time()
+                if pending_input == None:
+                    eid = self._ipc.perform_task(task_name, task_input, False, trace.context(dispatched))
+                else:
+                    eid = self._ipc.perform_task(task_name, None, True, trace.context(dispatched))
+                trace.execid = eid
                 # Create a Condition object that this worker thread can wait on until 
                 # the execution of the task is done.
                 cond = Condition()
@@ -159,9 +386,33 @@ class StaticSurrogate(Thread):
             except Exception, error:
                 err_msg = 'Error registering task with execution environment.'
                 raise Exception(err_msg, error)
+
+        # Hand the resolved input over to the waiting task.
+        if pending_input != None:
+            try:
+                task_input, error = pending_input.wait(timeout), None
+            except Exception, excep:
+                task_input, error = None, 'Error resolving data handles: %s'%excep
+            self.latency.record(task_name, 'resolve', time() - resolve_start)
+            trace.span('resolve', resolve_start)
+            self._ipc.supply_input(eid, task_input, error)
+
+        if detach:
+            # The client collects the result with collect_result.
+            self.change_activity(-1)
+            with self.pending_tasks_lock:
+                flaf = self.pending_tasks.pop(eid)
+                if type(flaf) == tuple:
+                    self.unclaimed[eid] = flaf
+            cond.release()
+            return eid
         
-        # Wait for the task to finish -- or for the timer to expire...
-        cond.wait(timeout)
+        # Wait for the task to finish -- or for the timer to expire... The
+        # time spent resolving the input counts against the timeout.
+        if timeout == None:
+            cond.wait()
+        else:
+            cond.wait(max(0.0, resolve_start + timeout - time()))
         if profile:
             stop = time()
             stop_activity = self.activity_count
@@ -181,18 +432,21 @@ class StaticSurrogate(Thread):
             # The result (or an error message is there).
             cond.release()
             del cond
-            rcode, output = flaf
+            rcode, output, timings, delivered = flaf
+            self.latency.record_execution(task_name, dispatched, timings, delivered)
+            trace.add_execution(timings, delivered)
             if rcode == 'RESULT':
                 if store:
                     # We have been asked to store the result here.
+                    store_start = time()
                     if type(output) == tuple:
-                        # Store the output values as individual remote data handles. 
-                        new_output = []
-                        for item in output:
-                            new_output.append(self.remotedatastore.store_data(item))
-                        new_output = tuple(new_output)
+                        # Store the output values as individual remote data handles.
+                        # If asked to, string outputs are kept in one contiguous blob.
+                        new_output = self.remotedatastore.store_many(output, contiguous)
                     else:
                         new_output = self.remotedatastore.store_data(output)
+                    self.latency.record(task_name, 'store', time() - store_start)
+                    trace.span('store', store_start)
 
                     if profile:
                         cores = self._config.getint('cpu', 'cores')
@@ -221,8 +475,8 @@ class StaticSurrogate(Thread):
             # The condition object is still there... a timeout must have occurred.
             cond.release()
             del cond
-            err_msg = 'Timeout while performing task.'
-            raise Exception(err_msg)
+            err_msg = 'Timeout while performing task. The result of execution %i may be collected later.'%eid
+            raise Exception(err_msg, eid)
 
     def install_task(self, task_name, task_code):
         try:
@@ -231,7 +485,12 @@ class StaticSurrogate(Thread):
             err_msg = 'Error installing task. %s'%error.message
             raise Exception(err_msg, error)
 
-    def has_task(self, task_name):
+    def has_task(self, task_name, code_hash = None):
+        """
+        Checks whether a task is installed. The code hash is accepted for 
+        compatibility with the dynamic surrogate, but a static surrogate has 
+        no peers to fetch the code from.
+        """
         try:
             return self._ipc.task_exists(task_name)
         except Exception, error:
@@ -247,9 +506,23 @@ class StaticSurrogate(Thread):
 #        network_speed = self._config.getint('network', 'speed')
         period_count = 0
         while not self.__shutdown:            
-            # Cleanup the data store every 10th period.
+            # Let the data store clean up if its memory budget is exceeded or
+            # stored data has expired.
+            self.remotedatastore.maintain()
+
+            # Cleanup the data handle cache every 10th period.
             if period_count % 10 == 0:
-                self.remotedatastore.cleanup()
+                self.handle_resolver.cache.cleanup()
+                self._expire_unclaimed()
+
+            # The executions checkpointed by the daemon this one took over 
+            # from are resumed once it has exited.
+            if self.__predecessor != None and not process_exists(self.__predecessor):
+                self.__predecessor = None
+                try:
+                    self._ipc.resume_checkpoints()
+                except Exception:
+                    self.__logger.exception('Error resuming checkpointed executions.')
 
             # Wait for another second...
             period_count += 1
@@ -0,0 +1,433 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the data store used by the surrogates. It extends the
+RemoteDataStore with bookkeeping of its own for the data that is stored
+locally, so that many items can be registered in a single operation, so
+that identical data is only stored once, and so that the memory used by 
+stored data stays within a budget.
+"""
+
+from __future__ import with_statement
+from datastore import RemoteDataStore
+from thread import allocate_lock
+from collections import OrderedDict
+from copy import copy
+from time import time
+from uuid import uuid4
+from handlecache import data_size
+from detection import process_exists
+import cPickle
+import hashlib
+import mmap
+import shutil
+import os
+import logging
+
+def serialized(data):
+    """
+    Returns a piece of data as a string: the data itself if it is a string,
+    or else its pickled form, or None if it can not be pickled.
+    """
+    if type(data) == str:
+        return data
+    try:
+        return cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+
+def content_digest(data):
+    """
+    Returns the content address of a piece of data, i.e., the SHA-1 digest
+    of the data (or of its pickled form if it is not a string), or None if
+    the data can not be addressed by content.
+    """
+    data = serialized(data)
+    if data == None:
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+def data_id_digest(data_id):
+    """
+    Returns the content digest embedded in a data id issued by a
+    SurrogateDataStore, or None if the id does not contain one.
+    """
+    if type(data_id) != str or data_id.find('.') != 40:
+        return None
+    return data_id[:40]
+
+class Chunk(object):
+    """
+    A unit of stored data: either a single item or a contiguous blob of
+    several string items. A chunk is either held in memory or spilled to
+    a memory-mapped file.
+    """
+    __slots__ = ('data', 'size', 'refs', 'digests', 'pickled', 'mapping', 'spillable')
+
+    def __init__(self, data, size = None):
+        self.data = data
+        if size == None:
+            size = data_size(data)
+        self.size = size
+        self.refs = 0
+        self.digests = []
+        self.pickled = False
+        self.mapping = None
+        # Empty strings cannot be mapped, so they are never spilled.
+        self.spillable = type(data) != str or len(data) > 0
+
+    def read(self, offset = None, length = None):
+        if self.mapping == None:
+            if offset == None:
+                return self.data
+            return self.data[offset:offset+length]
+        if self.pickled:
+            return cPickle.loads(self.mapping[:])
+        if offset == None:
+            return self.mapping[:]
+        return self.mapping[offset:offset+length]
+
+class SurrogateDataStore(RemoteDataStore):
+    """
+    The data store of a surrogate. Data stored locally is kept in a table of
+    its own, keyed by data ids from a namespace private to this store, while
+    handles owned by other stores are resolved by the RemoteDataStore.
+    Handles for local data are copies of a handle minted by the
+    RemoteDataStore with the data id replaced.
+
+    Stored data is addressed by content: identical items share one
+    reference-counted chunk, and the content digest is embedded in the data
+    ids so that any surrogate holding the same content can resolve the
+    handle without going to the network.
+
+    When the data held in memory exceeds the memory budget the least recently
+    used chunks are spilled to memory-mapped files in the store directory.
+    """
+
+    DATA_TIMEOUT = 300.0
+
+    def __init__(self, address, memory_budget = None, directory = 'datastore'):
+        """
+        Constructor.
+        @type address: str or (str, int)
+        @param address: The name (or address) of the node owning the store.
+        @type memory_budget: int
+        @param memory_budget: The maximum number of bytes of stored data to
+        keep in memory. None means no limit.
+        @type directory: str
+        @param directory: The directory where spilled data is kept.
+        """
+        RemoteDataStore.__init__(self, address)
+        self.__prototype = None
+        self.__namespace = uuid4().hex
+        self.__next_id = 0
+        self.__entries = {} # data id -> [chunk id, offset, length, expiry time]
+        self.__chunks = {} # chunk id -> Chunk
+        self.__contents = {} # content digest -> (chunk id, offset, length)
+        self.__resident = OrderedDict() # chunk id -> None, in LRU order.
+        self.__memory = 0
+        self.__memory_budget = memory_budget
+        self.__next_expiry = None
+        self.__lock = allocate_lock()
+        self.__spill_lock = allocate_lock()
+        self.__logger = logging.getLogger('datastore')
+        # Every store spills into a directory of its own, named by its process
+        # and namespace, as a daemon taking over from another one runs next to
+        # it for a while. The directories of processes that are gone are removed.
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        for name in os.listdir(directory):
+            try:
+                pid = int(name.split('-')[0])
+            except ValueError:
+                continue
+            if not process_exists(pid):
+                shutil.rmtree(os.path.join(directory, name), True)
+        self.__directory = os.path.join(directory, '%i-%s'%(os.getpid(), self.__namespace))
+        os.mkdir(self.__directory)
+
+    def store_data(self, data):
+        """
+        Stores a single piece of data.
+        @return: The handle of the data.
+        @rtype: RemoteDataHandle
+        """
+        return self.store_many((data,))[0]
+
+    def store_many(self, items, contiguous = False):
+        """
+        Stores a number of data items in one operation.
+        @type items: tuple
+        @param items: The items to store.
+        @type contiguous: bool
+        @param contiguous: If True and all items are strings, the items are
+        stored as one contiguous blob that each handle holds a view into.
+        @rtype: tuple of RemoteDataHandle
+        @return: The handles of the items, in order.
+        """
+        if self.__prototype == None:
+            self.__prototype = RemoteDataStore.store_data(self, None)
+        expiry = time() + SurrogateDataStore.DATA_TIMEOUT
+        handles = []
+
+        # Hash and measure the items before taking the lock. Items that are
+        # not strings are measured by their pickled form, as the size of the
+        # object itself does not include the objects it refers to.
+        digests = []
+        sizes = []
+        for item in items:
+            form = serialized(item)
+            if form == None:
+                digests.append(None)
+                sizes.append(data_size(item))
+            else:
+                digests.append(hashlib.sha1(form).hexdigest())
+                sizes.append(len(form))
+        if contiguous and len(items) > 1 and all([type(item) == str for item in items]):
+            blob = ''.join(items)
+            # Blob chunks are named apart from single item chunks, whose ids
+            # are the bare digests, as a blob may have the same content as
+            # an item.
+            blob_id = content_digest(blob) + '.blob'
+        else:
+            blob = None
+
+        with self.__lock:
+            if blob != None:
+                if not self.__chunks.has_key(blob_id):
+                    self.__add_chunk(blob_id, blob)
+                offset = 0
+                for item, digest in zip(items, digests):
+                    self.__add_content(digest, blob_id, offset, len(item))
+                    handles.append(self.__register(digest, blob_id, offset, len(item), expiry))
+                    offset += len(item)
+            else:
+                for item, digest, size in zip(items, digests, sizes):
+                    if digest == None:
+                        chunk_id, offset, length = self.__new_id(), None, None
+                        self.__add_chunk(chunk_id, item, size)
+                    elif self.__contents.has_key(digest):
+                        # Identical data is stored already. Share it.
+                        chunk_id, offset, length = self.__contents[digest]
+                    else:
+                        chunk_id, offset, length = digest, None, None
+                        self.__add_chunk(chunk_id, item, size)
+                        self.__add_content(digest, chunk_id, offset, length)
+                    handles.append(self.__register(digest, chunk_id, offset, length, expiry))
+            if self.__next_expiry == None or expiry < self.__next_expiry:
+                self.__next_expiry = expiry
+        if self.over_budget():
+            self.__spill()
+        return tuple(handles)
+
+    def fetch_data(self, data_id):
+        with self.__lock:
+            if self.__entries.has_key(data_id):
+                return self.__read(*self.__entries[data_id][:3])
+        return RemoteDataStore.fetch_data(self, data_id)
+
+    def resolve_data_handle(self, handle, *args):
+        with self.__lock:
+            if self.__entries.has_key(handle.id):
+                return self.__read(*self.__entries[handle.id][:3])
+            # The handle may be owned by another store, but if the content is
+            # present here there is no need to fetch it.
+            digest = data_id_digest(handle.id)
+            if digest != None and self.__contents.has_key(digest):
+                return self.__read(*self.__contents[digest])
+        return RemoteDataStore.resolve_data_handle(self, handle, *args)
+
+    def has_data(self, handle):
+        """Checks whether the data of a handle can be resolved without going to the network."""
+        with self.__lock:
+            if self.__entries.has_key(handle.id):
+                return True
+            digest = data_id_digest(handle.id)
+            return digest != None and self.__contents.has_key(digest)
+
+    def local_handle(self, data_id):
+        """
+        Returns a handle of locally stored data.
+        @rtype: RemoteDataHandle
+        @return: The handle, or None if the data is not stored here.
+        """
+        with self.__lock:
+            if not self.__entries.has_key(data_id):
+                return None
+            handle = copy(self.__prototype)
+            handle.id = data_id
+            return handle
+
+    def data_size(self, data_id):
+        """
+        Returns the size of a piece of locally stored data.
+        @type data_id: str
+        @param data_id: The id of the data.
+        @rtype: int
+        @return: The size in bytes, or -1 if the data is not stored here.
+        """
+        with self.__lock:
+            try:
+                chunk_id, _, length, _ = self.__entries[data_id]
+            except KeyError:
+                return -1
+            if length != None:
+                return length
+            return self.__chunks[chunk_id].size
+
+    def retain(self, data_id, timeout = DATA_TIMEOUT):
+        with self.__lock:
+            if self.__entries.has_key(data_id):
+                expiry = time() + timeout
+                self.__entries[data_id][3] = expiry
+                if self.__next_expiry == None or expiry < self.__next_expiry:
+                    self.__next_expiry = expiry
+                return
+        return RemoteDataStore.retain(self, data_id, timeout)
+
+    def expire(self, data_id, *args):
+        with self.__lock:
+            if self.__entries.has_key(data_id):
+                self.__drop(data_id)
+                return
+        return RemoteDataStore.expire(self, data_id, *args)
+
+    def over_budget(self):
+        return self.__memory_budget != None and self.__memory > self.__memory_budget
+
+    def maintain(self):
+        """
+        Performs cleanup if it is needed, i.e., if the memory budget is
+        exceeded or if stored data has expired. This is cheap to call often.
+        """
+        if self.over_budget() or (self.__next_expiry != None and self.__next_expiry < time()):
+            self.cleanup()
+
+    def cleanup(self):
+        RemoteDataStore.cleanup(self)
+        now = time()
+        with self.__lock:
+            self.__next_expiry = None
+            for data_id, entry in self.__entries.items():
+                if entry[3] < now:
+                    self.__drop(data_id)
+                elif self.__next_expiry == None or entry[3] < self.__next_expiry:
+                    self.__next_expiry = entry[3]
+        if self.over_budget():
+            self.__spill()
+
+    def __new_id(self):
+        self.__next_id += 1
+        return '%s-%i'%(self.__namespace, self.__next_id)
+
+    def __add_chunk(self, chunk_id, data, size = None):
+        chunk = Chunk(data, size)
+        self.__chunks[chunk_id] = chunk
+        self.__resident[chunk_id] = None
+        self.__memory += chunk.size
+
+    def __add_content(self, digest, chunk_id, offset, length):
+        if digest != None and not self.__contents.has_key(digest):
+            self.__contents[digest] = (chunk_id, offset, length)
+            self.__chunks[chunk_id].digests.append(digest)
+
+    def __register(self, digest, chunk_id, offset, length, expiry):
+        if digest == None:
+            data_id = self.__new_id()
+        else:
+            data_id = '%s.%s'%(digest, self.__new_id())
+        self.__entries[data_id] = [chunk_id, offset, length, expiry]
+        self.__chunks[chunk_id].refs += 1
+        handle = copy(self.__prototype)
+        handle.id = data_id
+        return handle
+
+    def __read(self, chunk_id, offset, length):
+        # Mark resident chunks as recently used.
+        if self.__resident.has_key(chunk_id):
+            self.__resident[chunk_id] = self.__resident.pop(chunk_id)
+        return self.__chunks[chunk_id].read(offset, length)
+
+    def __drop(self, data_id):
+        chunk_id = self.__entries.pop(data_id)[0]
+        chunk = self.__chunks[chunk_id]
+        chunk.refs -= 1
+        if chunk.refs == 0:
+            self.__chunks.pop(chunk_id)
+            for digest in chunk.digests:
+                self.__contents.pop(digest)
+            if self.__resident.has_key(chunk_id):
+                self.__resident.pop(chunk_id)
+                self.__memory -= chunk.size
+            else:
+                chunk.mapping.close()
+                try:
+                    os.remove(os.path.join(self.__directory, chunk_id))
+                except OSError:
+                    self.__logger.exception('Error removing spilled chunk.')
+
+    def __spill(self):
+        """Spills least recently used chunks to disk until the budget is met."""
+        # Only one thread spills at a time.
+        if not self.__spill_lock.acquire(False):
+            return
+        try:
+            self.__spill_chunks()
+        finally:
+            self.__spill_lock.release()
+
+    def __spill_chunks(self):
+        while self.over_budget():
+            # Pick the least recently used chunk that can be spilled.
+            with self.__lock:
+                for chunk_id in self.__resident:
+                    chunk = self.__chunks[chunk_id]
+                    if chunk.spillable:
+                        break
+                else:
+                    return
+                data = chunk.data
+
+            # Write it to disk without holding the lock.
+            pickled = type(data) != str
+            path = os.path.join(self.__directory, chunk_id)
+            try:
+                if pickled:
+                    data = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+            except (TypeError, cPickle.PicklingError):
+                # The data can only be kept in memory. Move on to the next chunk.
+                self.__logger.exception('Error pickling chunk.')
+                chunk.spillable = False
+                continue
+            try:
+                with open(path, 'wb') as outfile:
+                    outfile.write(data)
+            except IOError:
+                self.__logger.exception('Error spilling chunk to disk.')
+                return
+
+            # Swap the in-memory data for the mapping.
+            with self.__lock:
+                if not self.__resident.has_key(chunk_id):
+                    # The chunk was dropped while it was being written.
+                    os.remove(path)
+                    continue
+                with open(path, 'rb') as infile:
+                    chunk.mapping = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+                chunk.pickled = pickled
+                chunk.data = None
+                self.__resident.pop(chunk_id)
+                self.__memory -= chunk.size
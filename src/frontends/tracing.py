@@ -0,0 +1,172 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the traces of task executions. A trace is created when a
+perform_task call enters the surrogate, its id travels with the execution
+through the Jailor, the Scheduler and the core, and the timestamps recorded
+on the way are turned into spans when the result comes back.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from collections import deque
+from time import time
+from uuid import uuid4
+import random
+
+def new_trace_id():
+    return uuid4().hex[:16]
+
+class Trace(object):
+    """The spans of a single perform_task call."""
+
+    # The spans derived from the timestamps of the execution environment:
+    # (span name, start timestamp, end timestamp).
+    EXECUTION_SPANS = (('eipc', 'dispatched', 'jailor'),
+                       ('scheduler', 'jailor', 'received'),
+                       ('queue', 'received', 'started'),
+                       ('input', 'started', 'input'),
+                       ('execute', 'input', 'finished'),
+                       ('callback', 'sent', 'returned'),
+                       ('eipc-return', 'returned', 'delivered'))
+
+    def __init__(self, task_name, trace_id = None):
+        """
+        Constructor.
+        @type task_name: str
+        @param task_name: The name of the task.
+        @type trace_id: str
+        @param trace_id: The id of the trace. A new id is made if it is not given,
+        e.g., by a peer forwarding the task.
+        """
+        super(Trace, self).__init__()
+        if trace_id == None:
+            trace_id = new_trace_id()
+        self.trace_id = trace_id
+        self.task_name = task_name
+        self.start = time()
+        self.end = None
+        self.spans = [] # (name, start, end)
+        self.execid = None
+        self.core = None
+        self.error = None
+
+    def span(self, name, start, end = None):
+        """Records a span. The span ends now if no end is given."""
+        if end == None:
+            end = time()
+        self.spans.append((name, start, end))
+
+    def context(self, dispatched):
+        """Returns the trace context that is passed to the execution environment."""
+        return {'trace' : self.trace_id, 'dispatched' : dispatched}
+
+    def add_execution(self, timings, delivered):
+        """
+        Records the spans of the execution environment.
+        @type timings: dict
+        @param timings: The trace context returned by the execution environment.
+        @type delivered: float
+        @param delivered: The time the result reached the surrogate.
+        """
+        if not timings:
+            return
+        timings = dict(timings)
+        timings['delivered'] = delivered
+        deferred = timings.has_key('input')
+        if not deferred:
+            # The input was given right away. The task module is imported
+            # before the execution starts, so that time is counted as well.
+            timings['input'] = timings.get('started')
+        self.core = timings.get('core')
+        for name, start, end in Trace.EXECUTION_SPANS:
+            if name == 'input' and not deferred:
+                continue
+            if timings.get(start) != None and timings.get(end) != None:
+                self.spans.append((name, timings[start], timings[end]))
+
+    def span_duration(self, name):
+        """Returns the duration of the named span, or None if it was not recorded."""
+        for span_name, start, end in self.spans:
+            if span_name == name:
+                return end - start
+        return None
+
+    def duration(self):
+        return (self.end or time()) - self.start
+
+    def to_dict(self):
+        return {'trace' : self.trace_id, 'task' : self.task_name, 'start' : self.start,
+                'duration' : self.duration(), 'execid' : self.execid, 'core' : self.core,
+                'error' : self.error,
+                'spans' : [{'name' : name, 'offset' : start - self.start, 'duration' : end - start}
+                           for name, start, end in sorted(self.spans, key=lambda span: span[1])]}
+
+class TraceBuffer(object):
+    """
+    A ring buffer of finished traces. The decision to keep a trace is made
+    when it is finished (tail-based sampling): slow and failed executions are
+    always kept, and a fraction of the rest is kept for comparison.
+    """
+
+    def __init__(self, capacity = 256, threshold = 1.0, sample_rate = 0.0):
+        """
+        Constructor.
+        @type capacity: int
+        @param capacity: The maximum number of traces kept.
+        @type threshold: float
+        @param threshold: Executions taking at least this many seconds are kept.
+        @type sample_rate: float
+        @param sample_rate: The fraction of the faster executions that is kept.
+        """
+        super(TraceBuffer, self).__init__()
+        self.__traces = deque(maxlen=capacity)
+        self.__threshold = threshold
+        self.__sample_rate = sample_rate
+        self.__finished = 0
+        self.__kept = 0
+        self._lock = allocate_lock()
+
+    def finish(self, trace):
+        """Ends a trace and keeps it if it is sampled."""
+        trace.end = time()
+        keep = trace.error != None or trace.duration() >= self.__threshold or \
+               (self.__sample_rate > 0 and random.random() < self.__sample_rate)
+        with self._lock:
+            self.__finished += 1
+            if keep:
+                self.__kept += 1
+                self.__traces.append(trace)
+        return keep
+
+    def dump(self, limit = None, trace_id = None):
+        """
+        Returns the kept traces, most recent last.
+        @type limit: int
+        @param limit: The maximum number of traces to return.
+        @type trace_id: str
+        @param trace_id: If given only the trace with this id is returned.
+        @rtype: dict
+        """
+        with self._lock:
+            traces = list(self.__traces)
+            finished, kept = self.__finished, self.__kept
+        if trace_id != None:
+            traces = [trace for trace in traces if trace.trace_id == trace_id]
+        if limit != None:
+            traces = traces[-limit:]
+        return {'finished' : finished, 'kept' : kept,
+                'traces' : [trace.to_dict() for trace in traces]}
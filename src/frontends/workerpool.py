@@ -0,0 +1,107 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A small pool of worker threads used by the surrogates for work that
+should run in the background, e.g., fetching remote data.
+"""
+
+from threading import Thread, Event
+from Queue import Queue
+import logging
+
+class PendingResult(object):
+    """The result of a job that may not have finished yet."""
+
+    def __init__(self):
+        super(PendingResult, self).__init__()
+        self.__event = Event()
+        self.__value = None
+        self.__error = None
+
+    def set_result(self, value):
+        self.__value = value
+        self.__event.set()
+
+    def set_error(self, error):
+        self.__error = error
+        self.__event.set()
+
+    def done(self):
+        return self.__event.isSet()
+
+    def wait(self, timeout = None):
+        """
+        Waits for the result to become available.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait.
+        @return: The result of the job.
+        @raise Exception: Raised if the job failed or if the timeout expired.
+        """
+        self.__event.wait(timeout)
+        if not self.__event.isSet():
+            raise Exception('Timeout while waiting for result.')
+        if self.__error != None:
+            raise self.__error
+        return self.__value
+
+class WorkerPool(object):
+    """A fixed number of daemon threads that perform submitted jobs in order."""
+
+    def __init__(self, workers, name = 'worker'):
+        """
+        Constructor.
+        @type workers: int
+        @param workers: The number of worker threads.
+        @type name: str
+        @param name: Name prefix of the worker threads.
+        """
+        super(WorkerPool, self).__init__()
+        if workers <= 0:
+            raise ValueError('Invalid number of workers (%i)'%workers)
+        self.__jobs = Queue()
+        self.__logger = logging.getLogger('workerpool')
+        self.__threads = []
+        for i in range(0, workers):
+            thread = Thread(target=self.__work, name='%s-%i'%(name, i))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, function, *args):
+        """
+        Schedules function(*args) to be run by one of the workers.
+        @rtype: PendingResult
+        @return: A handle for the result of the call.
+        """
+        result = PendingResult()
+        self.__jobs.put((function, args, result))
+        return result
+
+    def shutdown(self):
+        for _ in self.__threads:
+            self.__jobs.put(None)
+
+    def __work(self):
+        while True:
+            job = self.__jobs.get()
+            if job == None:
+                return
+            function, args, result = job
+            try:
+                result.set_result(function(*args))
+            except Exception, error:
+                self.__logger.debug('Job failed: %s'%error)
+                result.set_error(error)
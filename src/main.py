@@ -15,13 +15,56 @@
 
 """
 This executable script starts the Scavenger daemon.
+
+The daemon drains on SIGTERM: it stops taking on new tasks and lets the tasks
+in progress finish before it exits. On SIGUSR2 it starts a new daemon and 
+drains once the new daemon has taken over, which allows restarts without
+failing any tasks.
 """
 
-import sys
+from threading import Thread
 from frontends.dynamic import DynamicSurrogate
 from frontends.static import StaticSurrogate
 from frontends import Config
+import subprocess
 import logging
+import select
+import signal
+import errno
+import sys
+import os
+
+# Names the process id of the daemon that a new daemon takes over from.
+HANDOFF_VARIABLE = 'SCAVENGER_HANDOFF_PID'
+
+def start_successor(logger):
+    """Starts a new daemon that takes over from this one."""
+    environment = dict(os.environ)
+    environment[HANDOFF_VARIABLE] = str(os.getpid())
+    try:
+        subprocess.Popen([sys.executable] + sys.argv, env=environment)
+    except OSError:
+        logger.exception('Error starting a new daemon.')
+
+def predecessor_pid():
+    """Returns the process id of the daemon that this one takes over from, if any."""
+    try:
+        return int(os.environ.pop(HANDOFF_VARIABLE))
+    except (KeyError, ValueError):
+        return None
+
+def notify_predecessor(logger, pid):
+    """Tells the daemon that started this one that it has been taken over."""
+    if pid == None:
+        return
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except OSError:
+        logger.exception('Error notifying the previous daemon.')
+
+def drain_and_shutdown(scavenger, deadline, handoff):
+    scavenger.drain(deadline, handoff)
+    scavenger.shutdown(handoff)
 
 def main():
     # Read in the configuration file.
@@ -47,30 +90,56 @@ def main():
     if '-c' in sys.argv:
         index = sys.argv.index('-c')
         try:
-            config.set('cpu', 'cores', sys.argv[index+1])
+            config.set_runtime('cpu', 'cores', str(int(sys.argv[index+1])))
         except:
             logger.fatal('Invalid command line argument, cores', exc_info=True)
             sys.exit(1)
         
-    # Create a Scavenger instance.
+    # Create a Scavenger instance. When taking over from a daemon, the 
+    # executions it checkpoints are resumed once it has exited.
+    predecessor = predecessor_pid()
     try:
         if '-s' in sys.argv:
-            scavenger = StaticSurrogate(debug_jail=debug)
+            scavenger = StaticSurrogate(debug_jail=debug, predecessor=predecessor)
         else:
-            scavenger = DynamicSurrogate(debug_jail=debug)
+            scavenger = DynamicSurrogate(debug_jail=debug, predecessor=predecessor)
     except:
         logger.exception('Error creating Scavenger instance.')
         sys.exit(1)
 
+    # Drain the surrogate on SIGTERM, and when a new daemon has taken over.
+    stopping = []
+    def stop(handoff):
+        if len(stopping) > 0:
+            return
+        thread = Thread(target=drain_and_shutdown, 
+                        args=(scavenger, config.getfloat('drain', 'deadline'), handoff))
+        stopping.append(thread)
+        thread.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop(False))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: stop(True))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: start_successor(logger))
+    notify_predecessor(logger, predecessor)
+
     try:               
         # Serve the RPC thingy...
         cores = config.getint('cpu', 'cores')
         print 'Scavenger daemon started (using %i core%s)'%(cores, "" if cores == 1 else "s")
-        scavenger.serve()
+        while True:
+            try:
+                scavenger.serve()
+                break
+            except (select.error, IOError, OSError), error:
+                # A signal interrupted the RPC server.
+                if error.args[0] != errno.EINTR:
+                    raise
     except KeyboardInterrupt:
         print 'Interrupted by user.'
     finally:
-        scavenger.shutdown()
+        if len(stopping) > 0:
+            stopping[0].join()
+        else:
+            scavenger.shutdown()
     
     sys.exit(0)
 
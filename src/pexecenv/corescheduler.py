@@ -1,7 +1,46 @@
-from multiprocessing import Process, Queue
-from time import sleep
+from multiprocessing import Process, Queue, Event
+from time import time
 from Queue import Empty as QueueEmptyException
+from cStringIO import StringIO
+from types import ModuleType
+import cPickle
 import stackless
+import taskstate
+import iopool
+import sys
+import os
+
+def checkpoint_path(directory, execid):
+    """Returns the path of the checkpoint of the given execution."""
+    return os.path.join(directory, '%i.tasklet'%execid)
+
+def checkpoint_execid(filename):
+    """
+    Returns the id of the execution checkpointed in the named file, or None
+    if the file is not a checkpoint.
+    """
+    if not filename.endswith('.tasklet'):
+        return None
+    try:
+        return int(filename[:-len('.tasklet')])
+    except ValueError:
+        return None
+
+def movable_tasklets(sinners, executions, pinned, pending_input):
+    """
+    Returns the tasklets that may be migrated or checkpointed, i.e., live
+    tasklets performing an execution that have been pre-empted, as they are
+    known to be long-running. Tasklets blocked on a channel, e.g., waiting
+    for the I/O pool, cannot be moved, tasklets that could not be pickled
+    before are not tried again, and tasklets that may still be given input
+    stay where the input is sent.
+    @rtype: list of (int, tasklet)
+    @return: The tasklets and the number of times they have been pre-empted.
+    """
+    return [(sins, tasklet) for tasklet, sins in sinners.items()
+            if sins > 0 and tasklet.alive and not tasklet.blocked and 
+            tasklet not in pinned and executions.has_key(tasklet) and 
+            executions[tasklet] not in pending_input]
 
 class CoreScheduler(Process):
     """A CoreScheduler schedules stackless tasks within a single thread, 
@@ -10,8 +49,9 @@ class CoreScheduler(Process):
     STEP_SIZE = 1000000
     SLEEP_TIME = 0.01
     MAX_SINS = 1000
+    CHECKPOINT_TIMEOUT = 10.0
     
-    def __init__(self, eipc_handle, basedir):
+    def __init__(self, eipc_handle, basedir, checkpoint_dir = None, checkpoint_interval = 60.0):
         """
         Constructor.
         @type eipc_handle: eipc.EIPC
@@ -19,19 +59,58 @@ class CoreScheduler(Process):
         with the scheduler.
         @type basedir: str
         @param basedir: The base directory where task code is stored.
+        @type checkpoint_dir: str
+        @param checkpoint_dir: The directory where long-running tasklets are
+        checkpointed. If None no checkpoints are made.
+        @type checkpoint_interval: float
+        @param checkpoint_interval: The number of seconds between checkpoints.
         """
         super(CoreScheduler, self).__init__()
         self.__ipc = eipc_handle
         self._basedir = basedir
-        self.__ipc.register_function(self.schedule)
-        self.__ipc.start()
+        self.__checkpoint_dir = checkpoint_dir
+        self.__checkpoint_interval = checkpoint_interval
         self.__scheduling_queue = Queue()
+        self.__input_queue = Queue()
+        self.__warmup_queue = Queue()
+        self.__migration_queue = Queue()
+        self.__checkpoint_queue = Queue()
+        self.__checkpointed = Event()
+        self.__input_channels = {} # execid -> channel of tasklets awaiting input.
+        self.__early_inputs = {} # execid -> input that arrived before it was awaited.
         self.__sinners = {} # Sinners are tasklets that use too many resources :-)
+        self.__executions = {} # tasklet -> execid of the task it performs.
+        self.__pending_input = set() # execids of tasklets that may still be given input.
+        self.__discarded_inputs = set() # execids whose input is dropped when it arrives.
+        self.__migrated = [] # Local copies of tasklets that now live on another core.
+        self.__pinned = set() # Tasklets that could not be pickled.
+        # The IPC handlers run in the process creating the core scheduler, so
+        # they are only registered once the queues to the core are in place.
+        self.__ipc.register_function(self.schedule)
+        self.__ipc.register_function(self.supply_input)
+        self.__ipc.register_function(self.warm)
+        self.__ipc.register_function(self.migrate)
+        self.__ipc.register_function(self.resume)
+        self.__ipc.register_function(self.checkpoint)
+        self.__ipc.start()
 
-    def perform_task(self, task_name, task_input, execid):
+    def perform_task(self, task_name, task_input, execid, deferred = False, trace = None):
+        # Timestamps of the stages of the execution are added to the trace
+        # context, which is returned along with the result so that the 
+        # surrogate can tell where the time went.
+        timings = trace
+        timings['core'] = self.name
+        timings['started'] = time()
         try:
             # Load the task if necessary.
             task_module = __import__(self._basedir + '.tasks.' + task_name, {}, {}, ['perform'], 0)
+            # Set up the state of the task the first time it is performed on
+            # this core, or after its code has changed.
+            task_module = taskstate.get_store().prepare(task_name, task_module)
+            # Wait for the input if it is still being resolved by the surrogate.
+            if deferred:
+                task_input = self.__await_input(execid)
+                timings['input'] = time()
             # Perform the task.
             if type(task_input) == dict:
                 output = task_module.perform(**task_input)
@@ -39,13 +118,13 @@ class CoreScheduler(Process):
                 output = task_module.perform(*task_input)
             else:
                 output = task_module.perform(task_input)
+            timings['finished'] = time()
         except TaskletExit:
             # The tasklet has been killed.
             try:
                 t = stackless.getcurrent()
                 atomic = t.set_atomic(True)
-                if t in self.__sinners: 
-                    self.__sinners.pop(t)
+                self.__forget(t)
                 try:
                     self.__ipc.callback(execid, 'ERROR', {'error':'task was killed.'})
                 finally:
@@ -61,10 +140,10 @@ class CoreScheduler(Process):
             try:
                 t = stackless.getcurrent()
                 atomic = t.set_atomic(True)
-                if t in self.__sinners: 
-                    self.__sinners.pop(t)
+                self.__forget(t)
                 try:
-                    self.__ipc.callback(execid, 'ERROR', {'error':excep.message})
+                    timings['sent'] = time()
+                    self.__ipc.callback(execid, 'ERROR', {'error':excep.message, 'timings':timings})
                 finally:
                     t.set_atomic(atomic)
                     try: del task_module 
@@ -76,11 +155,11 @@ class CoreScheduler(Process):
         # The task has been successfully performed.
         try:
             t = stackless.getcurrent()
-            if t in self.__sinners: 
-                self.__sinners.pop(t)
+            self.__forget(t)
             atomic = t.set_atomic(True)
             try:
-                self.__ipc.callback(execid, 'DONE', {'output':output})
+                timings['sent'] = time()
+                self.__ipc.callback(execid, 'DONE', {'output':output, 'timings':timings})
             finally:
                 t.set_atomic(atomic)
                 try: del task_module 
@@ -88,22 +167,251 @@ class CoreScheduler(Process):
         except: #IGNORE:W0704
             pass
                 
+    def __await_input(self, execid):
+        # The input may have arrived before the tasklet got this far.
+        try:
+            task_input, error = self.__early_inputs.pop(execid)
+        except KeyError:
+            channel = stackless.channel()
+            self.__input_channels[execid] = channel
+            task_input, error = channel.receive()
+        self.__pending_input.discard(execid)
+        if error != None:
+            raise Exception(error)
+        return task_input
+
+    def __deliver_input(self, execid, task_input, error):
+        try:
+            channel = self.__input_channels.pop(execid)
+        except KeyError:
+            if execid in self.__discarded_inputs:
+                # The tasklet failed before it awaited its input.
+                self.__discarded_inputs.discard(execid)
+            else:
+                self.__early_inputs[execid] = (task_input, error)
+            return
+        # Wake up the waiting tasklet without blocking the scheduling loop.
+        channel.preference = 1
+        channel.send((task_input, error))
+
+    def __forget(self, tasklet):
+        self.__sinners.pop(tasklet, None)
+        execid = self.__executions.pop(tasklet, None)
+        if execid in self.__pending_input:
+            # The input will never be awaited, so drop it - or drop it when
+            # it arrives.
+            self.__pending_input.discard(execid)
+            self.__input_channels.pop(execid, None)
+            if self.__early_inputs.pop(execid, None) == None:
+                self.__discarded_inputs.add(execid)
+        self.__pinned.discard(tasklet)
+        if self.__checkpoint_dir != None and execid != None:
+            try:
+                os.remove(checkpoint_path(self.__checkpoint_dir, execid))
+            except OSError:
+                pass
+
+    def __checkpoint(self):
+        # Like migration, checkpoints are made of pre-empted tasklets only.
+        # Short tasks finish before it is worth saving them, and tasklets 
+        # blocked on a channel are saved once they are runnable again.
+        for sins, tasklet in movable_tasklets(self.__sinners, self.__executions, 
+                                              self.__pinned, self.__pending_input):
+            execid = self.__executions[tasklet]
+            try:
+                data = self.__pickle_tasklet(tasklet)
+            except (cPickle.PicklingError, TypeError, RuntimeError, ValueError):
+                self.__pinned.add(tasklet)
+                continue
+            # Write the checkpoint to a temporary file first, so that a crash
+            # never leaves a partial checkpoint behind.
+            path = checkpoint_path(self.__checkpoint_dir, execid)
+            try:
+                f = open(path + '.tmp', 'wb')
+                try:
+                    cPickle.dump((execid, sins, data), f, 2)
+                finally:
+                    f.close()
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError):
+                pass
+
+    def __pickle_tasklet(self, tasklet):
+        # Modules, module globals and the core scheduler itself are referenced
+        # by name, as they exist in the receiving core scheduler as well.
+        globals_names = dict([(id(m.__dict__), name) for name, m in sys.modules.items() 
+                              if m != None])
+        def persistent_id(obj):
+            if obj is self:
+                return 'core'
+            if type(obj) == ModuleType:
+                return 'module:' + obj.__name__
+            if type(obj) == dict and globals_names.has_key(id(obj)):
+                return 'globals:' + globals_names[id(obj)]
+            return None
+        f = StringIO()
+        pickler = cPickle.Pickler(f, 2)
+        pickler.persistent_id = persistent_id
+        pickler.dump(tasklet)
+        return f.getvalue()
+
+    def __unpickle_tasklet(self, data):
+        def persistent_load(pid):
+            if pid == 'core':
+                return self
+            kind, name = pid.split(':', 1)
+            __import__(name, {}, {}, [], 0)
+            module = sys.modules[name]
+            if kind == 'module':
+                return module
+            return module.__dict__
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    def __migrate_tasklet(self, target):
+        # The longest-running movable tasklet is migrated.
+        candidates = movable_tasklets(self.__sinners, self.__executions, 
+                                      self.__pinned, self.__pending_input)
+        if len(candidates) == 0:
+            self.__ipc.migrated(None, target, None, 0)
+            return
+        sins, tasklet = max(candidates)
+        execid = self.__executions[tasklet]
+        try:
+            tasklet.remove()
+        except RuntimeError:
+            # The tasklet cannot be taken off the run queue after all.
+            self.__ipc.migrated(None, target, None, 0)
+            return
+        try:
+            data = self.__pickle_tasklet(tasklet)
+        except (cPickle.PicklingError, TypeError, RuntimeError, ValueError):
+            # The task holds something that cannot be moved, e.g., a file. 
+            # It is left where it is and not tried again.
+            tasklet.insert()
+            self.__pinned.add(tasklet)
+            self.__ipc.migrated(execid, target, None, sins)
+            return
+        # Discard the local copy of the tasklet - along with its checkpoint,
+        # before the target core may write one. Killing the tasklet would 
+        # unwind it through the code of the task, which may catch TaskletExit
+        # and go on, so its frames are dropped without running them. If that
+        # is not possible it is left off the run queue for good.
+        self.__forget(tasklet)
+        try:
+            tasklet.bind(None)
+        except (RuntimeError, TypeError, ValueError):
+            self.__migrated.append(tasklet)
+        self.__ipc.migrated(execid, target, data, sins)
+
+    def __resume_tasklet(self, execid, data, sins):
+        try:
+            tasklet = self.__unpickle_tasklet(data)
+        except Exception, excep: #IGNORE:W0703
+            self.__ipc.callback(execid, 'ERROR', {'error':'resuming migrated task failed: %s'%excep})
+            return
+        self.__executions[tasklet] = execid
+        self.__sinners[tasklet] = sins
+        tasklet.insert()
+
+    def warm_task(self, task_name):
+        try:
+            # Importing the module is all it takes.
+            __import__(self._basedir + '.tasks.' + task_name, {}, {}, ['perform'], 0)
+        except: #IGNORE:W0704
+            pass
+
     def kill_tasklet(self, tasklet):
         tasklet.kill()
                       
-    def schedule(self, task_module, task_input, execid):
-        self.__scheduling_queue.put((task_module, task_input, execid))
+    def schedule(self, task_module, task_input, execid, deferred = False, trace = None):
+        trace = dict(trace or {})
+        trace['received'] = time()
+        self.__scheduling_queue.put((task_module, task_input, execid, deferred, trace))
+
+    def supply_input(self, execid, task_input, error):
+        self.__input_queue.put((execid, task_input, error))
+
+    def warm(self, task_name):
+        self.__warmup_queue.put(task_name)
+
+    def migrate(self, target):
+        self.__migration_queue.put(('migrate', (target,)))
+
+    def resume(self, execid, data, sins):
+        self.__migration_queue.put(('resume', (execid, data, sins)))
+
+    def checkpoint(self):
+        # Blocks until the checkpoints have been written.
+        self.__checkpointed.clear()
+        self.__checkpoint_queue.put(None)
+        self.__checkpointed.wait(CoreScheduler.CHECKPOINT_TIMEOUT)
           
     def run(self):
         """Main process function."""
+        next_checkpoint = time() + self.__checkpoint_interval
+        checkpoint_requested = False
+        # File operations of the tasks are performed by the I/O pool.
+        iopool.enable()
         while True:
             # Check whether any new tasks should be scheduled.
             while not self.__scheduling_queue.empty():
                 try:
-                    task_module, task_input, execid = self.__scheduling_queue.get_nowait()
-                    stackless.tasklet(self.perform_task)(task_module, task_input, execid)
+                    task_module, task_input, execid, deferred, trace = self.__scheduling_queue.get_nowait()
+                    tasklet = stackless.tasklet(self.perform_task)(task_module, task_input, execid, deferred, trace)
+                    self.__executions[tasklet] = execid
+                    if deferred:
+                        self.__pending_input.add(execid)
+                except QueueEmptyException:
+                    break
+
+            # Load task modules that are expected to be performed soon. The import
+            # runs in a tasklet of its own as it executes untrusted module code.
+            while not self.__warmup_queue.empty():
+                try:
+                    task_name = self.__warmup_queue.get_nowait()
+                    stackless.tasklet(self.warm_task)(task_name)
+                except QueueEmptyException:
+                    break
+
+            # Hand over input to tasklets whose input was deferred.
+            while not self.__input_queue.empty():
+                try:
+                    execid, task_input, error = self.__input_queue.get_nowait()
+                    self.__deliver_input(execid, task_input, error)
+                except QueueEmptyException:
+                    break
+
+            # Wake up tasklets whose file operations have completed.
+            iopool.deliver()
+
+            # Move tasklets to and from other core schedulers.
+            while not self.__migration_queue.empty():
+                try:
+                    request, args = self.__migration_queue.get_nowait()
+                    if request == 'migrate':
+                        self.__migrate_tasklet(*args)
+                    else:
+                        self.__resume_tasklet(*args)
+                except QueueEmptyException:
+                    break
+
+            # Checkpoint long-running tasklets.
+            while not self.__checkpoint_queue.empty():
+                try:
+                    self.__checkpoint_queue.get_nowait()
+                    checkpoint_requested = True
                 except QueueEmptyException:
                     break
+            if checkpoint_requested or \
+                    (self.__checkpoint_dir != None and time() >= next_checkpoint):
+                if self.__checkpoint_dir != None:
+                    self.__checkpoint()
+                next_checkpoint = time() + self.__checkpoint_interval
+                if checkpoint_requested:
+                    checkpoint_requested = False
+                    self.__checkpointed.set()
                                 
             # Schedule currently active tasklets - if any.
             if stackless.getruncount() != 1:
@@ -131,6 +439,7 @@ class CoreScheduler(Process):
                         self.__sinners[tasklet] = 1
                         tasklet.insert()
             else:
-                # Otherwise sleep for a little while.
-                sleep(CoreScheduler.SLEEP_TIME)
+                # Otherwise sleep for a little while, or until a file operation
+                # completes.
+                iopool.deliver(CoreScheduler.SLEEP_TIME)
                 
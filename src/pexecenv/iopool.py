@@ -0,0 +1,134 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the I/O thread pool of a core scheduler. A tasklet hands
+its blocking file operations to the pool and waits on a channel, so that the
+other tasklets of the core keep running while it waits for the disk. The
+results are handed back to the tasklets by the scheduling loop of the core,
+as channels must not be used across threads.
+"""
+
+from threading import Thread
+from Queue import Queue, Empty
+from time import sleep
+import stackless
+import os
+
+IO_THREADS = 4
+
+class IOPool(object):
+    """A pool of threads performing blocking calls on behalf of tasklets."""
+
+    def __init__(self, threads = IO_THREADS):
+        super(IOPool, self).__init__()
+        self.__requests = Queue()
+        self.__completions = Queue()
+        for _ in range(0, threads):
+            thread = Thread(target=self.__work)
+            thread.daemon = True
+            thread.start()
+
+    def __work(self):
+        while True:
+            channel, function, args = self.__requests.get()
+            try:
+                result = (function(*args), None)
+            except Exception, error: #IGNORE:W0703
+                result = (None, error)
+            self.__completions.put((channel, result))
+
+    def call(self, function, *args):
+        """
+        Performs a call in the pool. The current tasklet is blocked until the
+        call has completed.
+        @return: The return value of the call.
+        """
+        channel = stackless.channel()
+        # The tasklet must not be pre-empted before it waits on the channel,
+        # or the scheduling loop could block sending the result.
+        current = stackless.getcurrent()
+        atomic = current.set_atomic(True)
+        try:
+            self.__requests.put((channel, function, args))
+            result, error = channel.receive()
+        finally:
+            current.set_atomic(atomic)
+        if error != None:
+            raise error
+        return result
+
+    def deliver(self, timeout = 0):
+        """
+        Wakes up the tasklets whose calls have completed.
+        @type timeout: float
+        @param timeout: If no call has completed, wait this many seconds for one.
+        @rtype: int
+        @return: The number of tasklets woken up.
+        """
+        delivered = 0
+        try:
+            if timeout > 0:
+                completion = self.__completions.get(True, timeout)
+            else:
+                completion = self.__completions.get_nowait()
+            while True:
+                channel, result = completion
+                # Sending on a channel that nobody waits on would block the
+                # scheduling loop, e.g., if the waiting tasklet has been killed.
+                if channel.balance < 0:
+                    # Make the tasklet runnable without leaving the scheduling loop.
+                    channel.preference = 1
+                    channel.send(result)
+                    delivered += 1
+                completion = self.__completions.get_nowait()
+        except Empty:
+            pass
+        return delivered
+
+# The pool of the current process. Core schedulers are forked, so a pool is
+# only used in the process that created it.
+_pool = None
+_pool_pid = None
+_enabled = False
+
+def enable():
+    """Makes file operations cooperative. Called by the scheduling loop of a core."""
+    global _enabled
+    _enabled = True
+
+def call(function, *args):
+    """
+    Performs a blocking call without blocking the other tasklets of the core.
+    Outside a core scheduler, or from its main tasklet, the call is simply made.
+    """
+    global _pool, _pool_pid
+    if not _enabled or stackless.getcurrent() is stackless.getmain():
+        return function(*args)
+    if _pool == None or _pool_pid != os.getpid():
+        _pool = IOPool()
+        _pool_pid = os.getpid()
+    return _pool.call(function, *args)
+
+def deliver(timeout = 0):
+    """
+    Wakes up the tasklets whose calls have completed (see IOPool.deliver).
+    If no pool is in use, this sleeps for the given timeout.
+    """
+    if _pool == None or _pool_pid != os.getpid():
+        if timeout > 0:
+            sleep(timeout)
+        return 0
+    return _pool.deliver(timeout)
@@ -21,6 +21,8 @@ from registry import TaskRegistry
 from validator import Validator, ValidationError
 from monkey import monkey_header
 from eipc import EIPCProcess
+from time import time
+import hashlib
 import logging
 
 class Jailor(EIPCProcess):
@@ -29,7 +31,8 @@ class Jailor(EIPCProcess):
     and the outside world.
     """
     
-    def __init__(self, pipe, cores, basedir = 'pexecenv', debug = False):
+    def __init__(self, pipe, cores, basedir = 'pexecenv', debug = False, checkpoint_dir = None, 
+                 checkpoint_interval = 60.0, preload_modules = (), preload_tasks = (), handoff = False):
         """
         Constructor.
         @type pipe: EIPC
@@ -38,6 +41,20 @@ class Jailor(EIPCProcess):
         @param cores: The number of cores/cpu to utilize when scheduling.
         @type basedir: str
         @param basedir: The base directory where task code is stored. 
+        @type checkpoint_dir: str
+        @param checkpoint_dir: The directory where long-running executions are
+        checkpointed so that they survive a restart. If None no checkpoints are made.
+        @type checkpoint_interval: float
+        @param checkpoint_interval: The number of seconds between checkpoints.
+        @type preload_modules: list of str
+        @param preload_modules: Modules loaded before the cores are forked. Only
+        modules that tasks are allowed to import are loaded.
+        @type preload_tasks: list of str
+        @param preload_tasks: Installed tasks loaded before the cores are forked.
+        @type handoff: bool
+        @param handoff: If True the environment takes over from a daemon that
+        is still draining. Checkpoints are not resumed until resume_checkpoints
+        is called.
         """
         # Initialize super class.
         super(Jailor, self).__init__(pipe)
@@ -59,23 +76,43 @@ class Jailor(EIPCProcess):
 
         # Create the scheduler and registry.
         self.registry = TaskRegistry(basedir)
-        self.scheduler = Scheduler(self, cores, basedir)
+        for name in preload_modules:
+            if name not in Validator.LEGAL_IMPORTS:
+                self.__logger.warning('Not preloading %s - tasks may not import it.'%name)
+        for task_name in preload_tasks:
+            if not self.registry.has_task(task_name):
+                self.__logger.warning('Not preloading %s - the task is not installed.'%task_name)
+        self.scheduler = Scheduler(self, cores, basedir, checkpoint_dir, checkpoint_interval,
+                                   [name for name in preload_modules if name in Validator.LEGAL_IMPORTS],
+                                   [name for name in preload_tasks if self.registry.has_task(name)],
+                                   handoff)
 
         # Register functions for IPC.
         self.register_function(self.perform_task)
+        self.register_function(self.supply_input)
+        self.register_function(self.warm_task)
         self.register_function(self.task_exists)
         self.register_function(self.install_task)
         self.register_function(self.fetch_task_code)
+        self.register_function(self.task_hash)
+        self.register_function(self.resume_checkpoints)
 
         self.__logger.info('Jailor initialized.')
     
-    def perform_task(self, task_name, task_input):
+    def perform_task(self, task_name, task_input, deferred = False, trace = None):
         """
         Starts performing a named task on behalf of the client.
         @type task_name: str
         @param task_name: The task identifier.
         @type task_input: dict (kwargs), tuple (pos args), or any (single argument).
         @param task_input: The input for the given task.
+        @type deferred: bool
+        @param deferred: If True the input is not ready yet. The task is 
+        scheduled right away but does not start until supply_input is called.
+        @type trace: dict
+        @param trace: The trace context of the execution, i.e., the trace id 
+        ('trace') and the timestamps recorded so far. The context is passed
+        on to the core and comes back with the timings of the execution.
         @rtype: int
         @return: The execution id of the scheduled task.
         """        
@@ -85,10 +122,37 @@ class Jailor(EIPCProcess):
             raise Exception('The named task does not exist.')
         
         # Now start performing the task.
-        execid = self.scheduler.schedule(task_name, task_input)
-        self.__logger.info('%s scheduled with execid=%i.'%(task_name, execid))
+        if trace == None:
+            trace = {}
+        trace['jailor'] = time()
+        execid = self.scheduler.schedule(task_name, task_input, deferred, trace)
+        self.__logger.info('%s scheduled with execid=%i, trace=%s.'%(task_name, execid, trace.get('trace')))
         return execid
+
+    def supply_input(self, execid, task_input, error = None):
+        """
+        Supplies the input of a task that was performed with deferred input.
+        @type execid: int
+        @param execid: The execution id returned by perform_task.
+        @type task_input: dict (kwargs), tuple (pos args), or any (single argument).
+        @param task_input: The input for the given task.
+        @type error: str
+        @param error: Error message used to fail the execution if the input 
+        could not be obtained.
+        """
+        self.scheduler.supply_input(execid, task_input, error)
     
+    def warm_task(self, task_name):
+        """
+        Prepares the execution of a task that is about to be performed, 
+        i.e., loads the task code on the cores.
+        @type task_name: str
+        @param task_name: The task identifier.
+        """
+        # Unknown tasks are silently ignored - the client may install it later.
+        if self.registry.has_task(task_name):
+            self.scheduler.warm(task_name)
+
     def task_exists(self, task_name):
         """
         Checks whether a given task exists.
@@ -111,10 +175,16 @@ class Jailor(EIPCProcess):
         the task is simply returning some status information about its execution.
         @type args: dict
         @param args: Keyword-based arguments. Depending on the value of the 
-        status parameter different keyword arguments are expected. 
+        status parameter different keyword arguments are expected. The 'DONE'
+        and 'ERROR' statuses may carry the 'timings' of the execution.
         """
         # Log the event.
-        self.__logger.info('Callback: execid=%i, status=%s'%(execution_id, status))
+        timings = args.get('timings')
+        if timings:
+            timings['returned'] = time()
+            self.__logger.info('Callback: execid=%i, status=%s, trace=%s'%(execution_id, status, timings.get('trace')))
+        else:
+            self.__logger.info('Callback: execid=%i, status=%s'%(execution_id, status))
     
         # Handle the callback.    
         try:
@@ -123,14 +193,14 @@ class Jailor(EIPCProcess):
                 # The task has finished its execution. Return its output to 
                 # the client.
                 try:
-                    self._ipc.task_callback('RESULT', execution_id, args['output'])
+                    self._ipc.task_callback('RESULT', execution_id, args['output'], timings)
                 except Exception, excep:
                     self.__logger.exception('Error returning result.')
                     self._ipc.task_callback('ERROR', execution_id, 'Error returning result: %s'%excep.message)
             elif status == 'ERROR':
                 # The task has encountered an error. Return the 
                 # error message to the client.
-                self._ipc.task_callback('ERROR', execution_id, args['error'])
+                self._ipc.task_callback('ERROR', execution_id, args['error'], timings)
             elif status == 'STATUS':
                 # The task is relaying status information about its
                 # execution.
@@ -200,6 +270,24 @@ class Jailor(EIPCProcess):
         # Fetch the code.
         return self.registry.fetch_task_code(task_name)
         
+    def task_hash(self, task_name):
+        """
+        Computes the content hash of a task, i.e., the SHA-1 digest (in hex) of 
+        the code that was given when the task was installed.
+        @type task_name: str
+        @param task_name: The name of the task.
+        @rtype: str
+        @return: The hash, or None if the task is not installed.
+        """
+        if not self.registry.has_task(task_name):
+            return None
+        return hashlib.sha1(self.registry.fetch_task_code(task_name)).hexdigest()
+        
+    def resume_checkpoints(self):
+        """Resumes the checkpointed executions left behind by a previous daemon."""
+        if self.scheduler.checkpointing():
+            self.scheduler.resume_checkpoints()
+
     def shutdown(self):
         self.scheduler.stop()
         self.terminate()
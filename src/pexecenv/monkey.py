@@ -1,21 +1,133 @@
+from collections import deque
+import taskstate
+import iopool
+import mmap
 import os
 
-# Re-implementation of the open() function.
-def monkey_open(name, mode = 'r', buffering = -1):
+def storage_path(name):
+    """Returns the path of a file in the storage directory."""
     # Validate the path.
     if name.find('..') != -1 or name.find('~') != -1:
         raise IOError('Backtracking is not allowed when opening files.')
     
     # Append 'storage' to the path.
-    name = 'storage' + os.path.sep + name
+    return 'storage' + os.path.sep + name
+
+class CooperativeFile(object):
+    """
+    A file whose blocking operations are performed by the I/O pool of the 
+    core, so that the other tasklets keep running while the disk is busy.
+    """
+
+    # The number of bytes read at a time when iterating over the lines.
+    CHUNK_SIZE = 65536
+
+    def __init__(self, f):
+        super(CooperativeFile, self).__init__()
+        self.__file = f
+        self.__lines = deque() # Lines read ahead when iterating.
+        self.__partial = ''
+
+    name = property(lambda self: self.__file.name)
+    mode = property(lambda self: self.__file.mode)
+    closed = property(lambda self: self.__file.closed)
+
+    def read(self, size = -1):
+        return iopool.call(self.__file.read, size)
+
+    def readline(self, size = -1):
+        return iopool.call(self.__file.readline, size)
+
+    def readlines(self, sizehint = 0):
+        return iopool.call(self.__file.readlines, sizehint)
+
+    def write(self, data):
+        return iopool.call(self.__file.write, data)
+
+    def writelines(self, lines):
+        return iopool.call(self.__file.writelines, lines)
+
+    def flush(self):
+        return iopool.call(self.__file.flush)
+
+    def seek(self, offset, whence = 0):
+        return iopool.call(self.__file.seek, offset, whence)
+
+    def tell(self):
+        return self.__file.tell()
+
+    def truncate(self, *size):
+        return iopool.call(self.__file.truncate, *size)
+
+    def close(self):
+        return iopool.call(self.__file.close)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        # As with the built-in file, the lines are read ahead in chunks, so 
+        # iteration should not be mixed with the other read operations.
+        while len(self.__lines) == 0:
+            chunk = self.read(CooperativeFile.CHUNK_SIZE)
+            if chunk == '':
+                if self.__partial == '':
+                    raise StopIteration
+                line, self.__partial = self.__partial, ''
+                return line
+            data = self.__partial + chunk
+            end = data.rfind('\n') + 1
+            self.__partial = data[end:]
+            self.__lines.extend([line + '\n' for line in data[:end].split('\n')[:-1]])
+        return self.__lines.popleft()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Re-implementation of the open() function.
+def monkey_open(name, mode = 'r', buffering = -1):
+    name = storage_path(name)
+
+    # Return the opened file object. Opening may block as well.
+    return CooperativeFile(iopool.call(open, name, mode, buffering))
+
+def monkey_mmap(name, length = 0, offset = 0):
+    """
+    Maps a file in the storage directory into memory, read-only. Slicing the
+    map copies the data, but buffer(map, start, size) gives a view without 
+    copying. The pages are shared with every process mapping the file.
+    @type name: str
+    @param name: The name of the file within the storage directory.
+    @type length: int
+    @param length: The number of bytes to map. Zero maps the rest of the file.
+    @type offset: int
+    @param offset: The offset of the mapping. It must be a multiple of 
+    mmap.ALLOCATIONGRANULARITY.
+    @rtype: mmap.mmap
+    """
+    name = storage_path(name)
+    f = iopool.call(open, name, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise IOError('Empty files cannot be mapped: %s'%name)
+        # The mapping stays valid when the file is closed.
+        return mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+    finally:
+        f.close()
 
-    # Return the opened file object.
-    return open(name, mode, buffering)
+def task_state(module_name):
+    """Returns the state kept by a task between its executions on this core."""
+    return taskstate.get_store().state(module_name.split('.tasks.', 1)[-1])
    
 # The standard header that can be prefixed onto untrusted task code.
 monkey_header = """# ---MONKEY_START---
 import pexecenv.monkey as monkey
 open = monkey.monkey_open
+mmap = monkey.monkey_mmap
+state = monkey.task_state(__name__)
 def raise_error(e): raise Exception(e)
 file = lambda *_: raise_error('Initialization of file objects is prohibited.')
 type = lambda *_: raise_error('Usage of the type() function is prohibited.')
@@ -133,10 +133,12 @@ class TaskRegistry:
         code = infile.read()
         infile.close()
         
-        # Remove the monkey patching header - if any...
+        # Remove the monkey patching header - if any... The newline ending the
+        # header belongs to it, so that the code is returned exactly as it was
+        # installed.
         if code[:20] == '# ---MONKEY_START---':
-            mheader_end = code.find('# ---MONKEY_END---') + 18
-            if mheader_end != 17: # The header was actually found.
+            mheader_end = code.find('# ---MONKEY_END---\n') + 19
+            if mheader_end != 18: # The header was actually found.
                 code = code[mheader_end:]
         
         # Return the code to the caller.
@@ -21,9 +21,13 @@ utilized.
 """
 
 from __future__ import with_statement
-from corescheduler import CoreScheduler
+from corescheduler import CoreScheduler, checkpoint_path, checkpoint_execid
+from zygote import Zygote, ForkedCore
 from eipc import EIPC
+from thread import allocate_lock
+import cPickle
 import logging
+import os
 
 class SchedulerException(Exception):
     """Exception raised by the scheduler."""
@@ -38,8 +42,20 @@ class Scheduler(object):
     """
     
     PIPE_CHECK_INTERVAL = 0.01
+    # A tasklet is migrated when the busiest core has this many more
+    # executions than the least busy one.
+    MIGRATION_THRESHOLD = 2
+    # Execution ids are reserved in blocks of this size when checkpointing, 
+    # so that ids are never reused after a restart.
+    EXECID_BLOCK = 1000
+    # The number of seconds the zygote may spend preloading before the cores
+    # are started without it.
+    PRELOAD_TIMEOUT = 30.0
+    # The number of seconds the zygote may spend forking a replacement core.
+    FORK_TIMEOUT = 5.0
 
-    def __init__(self, jailor, cores, basedir):
+    def __init__(self, jailor, cores, basedir, checkpoint_dir = None, checkpoint_interval = 60.0,
+                 preload_modules = (), preload_tasks = (), handoff = False):
         """
         Constructor.
         @type jailor: Jailor
@@ -48,6 +64,23 @@ class Scheduler(object):
         @param cores: The number of cores/CPUs to use.
         @type basedir: str
         @param basedir: The base directory where task code is stored.
+        @type checkpoint_dir: str
+        @param checkpoint_dir: The directory where long-running tasklets are 
+        checkpointed. Executions checkpointed before a restart are resumed.
+        If None no checkpoints are made.
+        @type checkpoint_interval: float
+        @param checkpoint_interval: The number of seconds between checkpoints.
+        @type preload_modules: list of str
+        @param preload_modules: Modules that are imported before the core 
+        schedulers are forked, so that they share the memory of the modules.
+        @type preload_tasks: list of str
+        @param preload_tasks: Tasks that are loaded before the core schedulers
+        are forked.
+        @type handoff: bool
+        @param handoff: If True this scheduler takes over from a daemon that
+        is still draining, and shares the checkpoint directory with it. The 
+        checkpoints are then not resumed until resume_checkpoints is called,
+        i.e., once the other daemon has exited.
         """
         super(Scheduler, self).__init__()
 
@@ -59,31 +92,242 @@ class Scheduler(object):
         self.__cores = cores
         self.__jailor = jailor
         self.__shutdown = False
+        self.__basedir = basedir
+        self.__checkpoint_dir = checkpoint_dir
+        self.__checkpoint_interval = checkpoint_interval
+        
+        # Get a logger.
+        self.__logger = logging.getLogger('scheduler')
         
-        # Spawn a thread for each core/cpu.
-        self.__schedulers = []
-        for i in range(0, cores):
-            local_ipc, remote_ipc = EIPC.eipc_pair()
-            self.__schedulers.append((CoreScheduler(remote_ipc, basedir), local_ipc))
-            local_ipc.register_function(self.corescheduler_callback, "callback")
-            local_ipc.start()
-            self.__schedulers[i][0].start()
-            
         # Set state variables.
         self.__execution_id = 0
+        self.__reserved_ids = None
         self.__next_scheduler = 0
-        
-        # Get a logger.
-        self.__logger = logging.getLogger('scheduler')
+        self.__deferred = {} # execid -> index of the core awaiting its input.
+        self.__executions = {} # execid -> index of the core performing it.
+        self.__load = [0] * cores # The number of executions on each core.
+        self.__migrating = set() # Indices of the cores asked to give up a tasklet.
+        self.__lock = allocate_lock()
+
+        # Spawn a process for each core/cpu. If modules or tasks are to be
+        # preloaded the cores are forked from a zygote process that has loaded
+        # them, so that their memory is shared copy-on-write and the cores 
+        # start out warm - without running task code in this process. The
+        # zygote also forks the replacements of cores that die, using IPC 
+        # handles set aside for them, as it can only be given handles when 
+        # it is forked itself.
+        self.__zygote = None
+        self.__spares = [] # (index, local IPC handle, remote IPC handle) of unused handles.
+        if len(preload_modules) > 0 or len(preload_tasks) > 0:
+            self.__schedulers = self.__spawn_from_zygote(preload_modules, preload_tasks)
+        else:
+            self.__schedulers = [self.__spawn(i) for i in range(0, cores)]
         self.__logger.info('%i core scheduler(s) spawned'%cores)
+
+        # Resume the executions that were checkpointed before a restart.
+        if checkpoint_dir != None:
+            self.__restore_ids(handoff)
+            if not handoff:
+                self.resume_checkpoints()
+
+    def __spawn_from_zygote(self, modules, tasks):
+        pairs = [EIPC.eipc_pair() for _ in range(0, self.__cores)]
+        spares = [EIPC.eipc_pair() for _ in range(0, self.__cores)]
+        zygote = Zygote([remote_ipc for _, remote_ipc in pairs], self.__basedir, 
+                        self.__checkpoint_dir, self.__checkpoint_interval, modules, tasks,
+                        [remote_ipc for _, remote_ipc in spares])
+        zygote.start()
+        self.__spares = [(spare, local_ipc, remote_ipc) 
+                         for spare, (local_ipc, remote_ipc) in enumerate(spares)]
+        cores = zygote.wait_for_cores(Scheduler.PRELOAD_TIMEOUT)
+        if cores == None:
+            # The zygote and the cores it forked are gone, so the handles are
+            # unused and serve the cores forked from this process instead.
+            self.__logger.error('Preloading did not finish in time - starting the cores without it.')
+            return [self.__spawn(index, pair) for index, pair in enumerate(pairs)]
+        self.__zygote = zygote
+        return [self.__start_ipc(index, core, local_ipc) 
+                for index, (core, (local_ipc, _)) in enumerate(zip(cores, pairs))]
+
+    def __spawn(self, index, pair = None):
+        if pair == None:
+            pair = EIPC.eipc_pair()
+        local_ipc, remote_ipc = pair
+        scheduler = CoreScheduler(remote_ipc, self.__basedir, self.__checkpoint_dir, 
+                                  self.__checkpoint_interval)
+        entry = self.__start_ipc(index, scheduler, local_ipc)
+        scheduler.start()
+        return entry
+
+    def __start_ipc(self, index, scheduler, local_ipc):
+        local_ipc.register_function(self.corescheduler_callback, "callback")
+        local_ipc.register_function(self.__migrated_handler(index), "migrated")
+        local_ipc.start()
+        return (scheduler, local_ipc)
+
+    def __replace(self, index):
+        # Replacements are forked by the zygote while it has spare handles,
+        # so that they start out warm as well.
+        if len(self.__spares) == 0:
+            return self.__spawn(index)
+        spare, local_ipc, remote_ipc = self.__spares.pop(0)
+        if self.__zygote == None or not Scheduler.__process_alive(self.__zygote.pid):
+            return self.__spawn(index, (local_ipc, remote_ipc))
+        core = self.__zygote.fork_core(spare, Scheduler.FORK_TIMEOUT)
+        if core == None:
+            # The zygote may still answer, so it is not asked again.
+            self.__logger.error('The zygote did not fork a core in time - forking it from this process.')
+            self.__spares = []
+            return self.__spawn(index)
+        return self.__start_ipc(index, core, local_ipc)
+
+    @staticmethod
+    def __process_alive(pid):
+        # The cores are not necessarily children of this process, so their 
+        # state is read from /proc. A process that has exited but not been 
+        # reaped is a zombie.
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        try:
+            f = open('/proc/%i/stat'%pid)
+            try:
+                return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+            finally:
+                f.close()
+        except (IOError, IndexError):
+            return True
+
+    @staticmethod
+    def __alive(scheduler):
+        # The zygote serves the IPC of the cores it has forked, so they are
+        # lost along with it.
+        if isinstance(scheduler, ForkedCore) and not Scheduler.__process_alive(scheduler.zygote_pid):
+            return False
+        return Scheduler.__process_alive(scheduler.pid)
+
+    def __respawn(self, index):
+        # Replace a core that has died. Its executions are resumed from their
+        # checkpoints, if any, or else they fail.
+        self.__logger.error('Core scheduler %i has died - respawning it.'%index)
+        # A core forked by a zygote that has died may still be running.
+        self.__schedulers[index][0].terminate()
+        self.__schedulers[index] = self.__replace(index)
+        lost = [execid for execid, core_scheduler in self.__executions.items() 
+                if core_scheduler == index]
+        self.__load[index] = 0
+        self.__migrating.discard(index)
+        failed = []
+        for execid in lost:
+            checkpoint = None
+            if self.__checkpoint_dir != None:
+                checkpoint = self.__load_checkpoint(checkpoint_path(self.__checkpoint_dir, execid))
+            if checkpoint == None or execid in self.__deferred:
+                del self.__executions[execid]
+                self.__deferred.pop(execid, None)
+                failed.append(execid)
+            else:
+                _, sins, data = checkpoint
+                self.__load[index] += 1
+                self.__schedulers[index][1].resume(execid, data, sins)
+        return failed
+
+    def __load_checkpoint(self, path):
+        try:
+            f = open(path, 'rb')
+            try:
+                return cPickle.load(f)
+            finally:
+                f.close()
+        except IOError:
+            return None
+        except Exception: #IGNORE:W0703
+            self.__logger.exception('Discarding unreadable checkpoint %s'%path)
+            os.remove(path)
+            return None
+
+    def __reserve_ids(self):
+        # Record the end of the next block of execution ids before any id in 
+        # it is handed out.
+        self.__reserved_ids = self.__execution_id + Scheduler.EXECID_BLOCK
+        path = os.path.join(self.__checkpoint_dir, 'execid')
+        try:
+            f = open(path + '.tmp', 'w')
+            try:
+                f.write('%i\n'%self.__reserved_ids)
+            finally:
+                f.close()
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            self.__logger.exception('Error reserving execution ids.')
+
+    def __restore_ids(self, handoff):
+        if not os.path.isdir(self.__checkpoint_dir):
+            os.makedirs(self.__checkpoint_dir)
+        try:
+            f = open(os.path.join(self.__checkpoint_dir, 'execid'))
+            try:
+                self.__execution_id = int(f.read().strip())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+        if handoff:
+            # The draining daemon may still reserve one more block of ids.
+            self.__execution_id += Scheduler.EXECID_BLOCK
+        self.__reserve_ids()
+
+    def checkpointing(self):
+        return self.__checkpoint_dir != None
+
+    def resume_checkpoints(self):
+        """
+        Resumes the executions that have been checkpointed, apart from those
+        already performed by this scheduler.
+        """
+        resumed = []
+        with self.__lock:
+            for filename in os.listdir(self.__checkpoint_dir):
+                execid = checkpoint_execid(filename)
+                if execid == None or self.__executions.has_key(execid):
+                    continue
+                checkpoint = self.__load_checkpoint(os.path.join(self.__checkpoint_dir, filename))
+                if checkpoint == None:
+                    continue
+                execid, sins, data = checkpoint
+                core_scheduler = self.__load.index(min(self.__load))
+                self.__executions[execid] = core_scheduler
+                self.__load[core_scheduler] += 1
+                if execid >= self.__execution_id:
+                    self.__execution_id = execid + 1
+                    if self.__execution_id >= self.__reserved_ids:
+                        self.__reserve_ids()
+                resumed.append((core_scheduler, execid, data, sins))
+        for core_scheduler, execid, data, sins in resumed:
+            self.__schedulers[core_scheduler][1].resume(execid, data, sins)
+        if len(resumed) > 0:
+            self.__logger.info('%i checkpointed execution(s) resumed'%len(resumed))
     
     def stop(self):
-        """Terminates the core schedulers and discards all tasklets."""
+        """
+        Terminates the core schedulers and discards all tasklets. When 
+        checkpointing, the long-running tasklets are checkpointed first so 
+        that they are resumed on the next start.
+        """
         self.__shutdown = True
+        if self.__checkpoint_dir != None:
+            for _, ipc in self.__schedulers:
+                try:
+                    ipc.checkpoint()
+                except Exception: #IGNORE:W0703
+                    self.__logger.exception('Error checkpointing before shutdown.')
         for scheduler, _ in self.__schedulers:
             scheduler.terminate()
+        if self.__zygote != None:
+            self.__zygote.terminate()
     
-    def schedule(self, task_name, task_input):
+    def schedule(self, task_name, task_input, deferred = False, trace = None):
         """
         Add the given task to the scheduler.
         This means that the task will be performed a.s.a.p. on one of the
@@ -92,20 +336,132 @@ class Scheduler(object):
         @param task_name: The id of the task that is to be performed.
         @type task_input: dict
         @param task_input: The task input.
+        @type deferred: bool
+        @param deferred: If True the task input is ignored and the task waits 
+        until its input is given by a call to supply_input.
+        @type trace: dict
+        @param trace: The trace context of the execution (see Jailor.perform_task).
         @rtype: int
         @return: The id of the task execution.
         """
         # Register the execution with one of the core schedulers.
-        execid = self.__execution_id
-        self.__execution_id += 1
-        core_scheduler = self.__next_scheduler
-        self.__next_scheduler += 1
-        self.__next_scheduler %= self.__cores
-        self.__schedulers[core_scheduler][1].schedule(task_name, task_input, execid)
+        with self.__lock:
+            execid = self.__execution_id
+            self.__execution_id += 1
+            if self.__reserved_ids != None and self.__execution_id >= self.__reserved_ids:
+                self.__reserve_ids()
+            core_scheduler = self.__next_scheduler
+            self.__next_scheduler += 1
+            self.__next_scheduler %= self.__cores
+            failed = []
+            if not Scheduler.__alive(self.__schedulers[core_scheduler][0]):
+                failed = self.__respawn(core_scheduler)
+            if deferred:
+                self.__deferred[execid] = core_scheduler
+            self.__executions[execid] = core_scheduler
+            self.__load[core_scheduler] += 1
+        self.__schedulers[core_scheduler][1].schedule(task_name, task_input, execid, deferred, trace)
+        for lost in failed:
+            self.__jailor.task_callback(lost, 'ERROR', {'error':'The core performing the task died.'})
 
         # Return the execution id to the client.
         return execid
+
+    def supply_input(self, execid, task_input, error = None):
+        """
+        Supplies the input of a task that was scheduled with deferred input.
+        @type execid: int
+        @param execid: The id of the task execution.
+        @type task_input: dict
+        @param task_input: The task input.
+        @type error: str
+        @param error: If not None the input could not be obtained and the 
+        execution fails with this error message.
+        """
+        try:
+            with self.__lock:
+                core_scheduler = self.__deferred.pop(execid)
+        except KeyError:
+            raise SchedulerException('No execution awaits input with execid=%i'%execid)
+        self.__schedulers[core_scheduler][1].supply_input(execid, task_input, error)
+    
+    def warm(self, task_name):
+        """
+        Makes every core scheduler load the given task so that it is ready 
+        by the time it is performed.
+        @type task_name: str
+        @param task_name: The id of the task.
+        """
+        for _, ipc in self.__schedulers:
+            ipc.warm(task_name)
+    
+    def __rebalance(self):
+        # Ask the busiest core to hand a tasklet over to the least busy one.
+        with self.__lock:
+            if self.__shutdown or self.__cores < 2:
+                return
+            target = self.__load.index(min(self.__load))
+            source = self.__load.index(max(self.__load))
+            if self.__load[source] - self.__load[target] < Scheduler.MIGRATION_THRESHOLD or \
+               source in self.__migrating:
+                return
+            self.__migrating.add(source)
+        self.__schedulers[source][1].migrate(target)
+
+    def __migrated_handler(self, source):
+        def migrated(execid, target, data, sins):
+            self.corescheduler_migrated(source, execid, target, data, sins)
+        return migrated
+
+    def corescheduler_migrated(self, source, execid, target, data, sins):
+        """
+        Called when a core scheduler has handled a request to migrate a tasklet.
+        @type source: int
+        @param source: The index of the core giving up the tasklet.
+        @type execid: int
+        @param execid: The id of the migrated execution or None if no tasklet
+        could be migrated.
+        @type target: int
+        @param target: The index of the core that should resume the tasklet.
+        @type data: str
+        @param data: The pickled tasklet or None if it could not be pickled.
+        @type sins: int
+        @param sins: The number of times the tasklet has been pre-empted.
+        """
+        with self.__lock:
+            self.__migrating.discard(source)
+            if data == None:
+                # Nothing was migrated. An execution that could not be pickled
+                # goes on on the source core.
+                return
+            current = self.__executions.get(execid)
+            if current == source:
+                self.__executions[execid] = target
+                self.__load[source] -= 1
+                self.__load[target] += 1
+                if self.__deferred.has_key(execid):
+                    self.__deferred[execid] = target
+        if current == None:
+            # The execution is not known to be in progress, e.g., it was failed
+            # while the tasklet was in transit. Make sure that the client is 
+            # told, rather than leaving it waiting for a result.
+            self.__logger.warning('Execution %i is no longer in progress - discarding it.'%execid)
+            self.__jailor.task_callback(execid, 'ERROR', {'error':'execution lost while migrating between cores.'})
+            return
+        if current != source:
+            # Another core has taken over the execution in the meantime. 
+            # Performing it twice would deliver two results.
+            self.__logger.warning('Execution %i is performed by core %i - discarding the migrated copy.'%(execid, current))
+            return
+        self.__logger.debug('Execution %i migrated from core %i to core %i'%(execid, source, target))
+        self.__schedulers[target][1].resume(execid, data, sins)
     
     def corescheduler_callback(self, execid, rcode, opt):
+        if rcode in ('DONE', 'ERROR'):
+            with self.__lock:
+                core_scheduler = self.__executions.pop(execid, None)
+                if core_scheduler != None:
+                    self.__load[core_scheduler] -= 1
+            self.__rebalance()
         self.__jailor.task_callback(execid, rcode, opt)
                     
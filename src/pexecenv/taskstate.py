@@ -0,0 +1,215 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the state that tasks keep between their executions on a
+core, e.g., a loaded model or a lookup table. The task code reaches its state
+through the global 'state' defined by the monkey header, and may fill it in
+a setup() function that is run once per core before the first execution.
+"""
+
+import stackless
+import sys
+import os
+
+# The maximum number of bytes of state kept by a single task and by all the
+# tasks of a core. The least recently used values are evicted beyond that.
+TASK_LIMIT = 64 * 1024 * 1024
+CORE_LIMIT = 256 * 1024 * 1024
+
+def estimate_size(value, depth = 3):
+    """Estimates the memory used by a value, including the values it contains."""
+    size = sys.getsizeof(value)
+    if depth > 0:
+        if type(value) == dict:
+            for key, item in value.iteritems():
+                size += estimate_size(key, depth - 1) + estimate_size(item, depth - 1)
+        elif type(value) in (list, tuple, set, frozenset):
+            for item in value:
+                size += estimate_size(item, depth - 1)
+    return size
+
+def source_mtime(module):
+    """Returns the modification time of the source of a module, if it is known."""
+    path = getattr(module, '__file__', None)
+    if path == None:
+        return None
+    if path[-4:] in ('.pyc', '.pyo'):
+        path = path[:-1]
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class TaskState(object):
+    """The state of a single task, as seen by the task code."""
+
+    def __init__(self, task_name, store):
+        super(TaskState, self).__init__()
+        self.__task_name = task_name
+        self.__store = store
+
+    def get(self, key, default = None):
+        return self.__store.get(self.__task_name, key, default)
+
+    def set(self, key, value, size = None):
+        """
+        Stores a value.
+        @type size: int
+        @param size: The number of bytes used by the value. It is estimated if
+        it is not given.
+        """
+        self.__store.set(self.__task_name, key, value, size)
+
+    def delete(self, key):
+        self.__store.delete(self.__task_name, key)
+
+    def clear(self):
+        self.__store.invalidate(self.__task_name)
+
+    def __getitem__(self, key):
+        value = self.__store.get(self.__task_name, key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def __contains__(self, key):
+        return self.__store.get(self.__task_name, key, KeyError) is not KeyError
+
+class StateStore(object):
+    """The state of all the tasks of a core."""
+
+    def __init__(self, task_limit = TASK_LIMIT, core_limit = CORE_LIMIT):
+        super(StateStore, self).__init__()
+        self.__task_limit = task_limit
+        self.__core_limit = core_limit
+        self.__states = {} # task name -> TaskState
+        self.__entries = {} # (task name, key) -> [value, size, last use]
+        self.__task_sizes = {} # task name -> bytes of state
+        self.__size = 0
+        self.__clock = 0
+        self.__versions = {} # task name -> mtime of the code that the state belongs to.
+        self.__ready = set() # Tasks whose setup has been run.
+        self.__setting_up = {} # task name -> channel of tasklets awaiting the setup.
+
+    def state(self, task_name):
+        """Returns the state of the named task."""
+        try:
+            return self.__states[task_name]
+        except KeyError:
+            state = TaskState(task_name, self)
+            self.__states[task_name] = state
+            return state
+
+    def get(self, task_name, key, default = None):
+        try:
+            entry = self.__entries[(task_name, key)]
+        except KeyError:
+            return default
+        self.__clock += 1
+        entry[2] = self.__clock
+        return entry[0]
+
+    def set(self, task_name, key, value, size = None):
+        if size == None:
+            size = estimate_size(value)
+        if size > self.__task_limit or size > self.__core_limit:
+            raise MemoryError('The value of %s is too large to keep (%i bytes).'%(key, size))
+        self.delete(task_name, key)
+        self.__clock += 1
+        self.__entries[(task_name, key)] = [value, size, self.__clock]
+        self.__task_sizes[task_name] = self.__task_sizes.get(task_name, 0) + size
+        self.__size += size
+        self.__evict(task_name)
+
+    def delete(self, task_name, key):
+        try:
+            _, size, _ = self.__entries.pop((task_name, key))
+        except KeyError:
+            return
+        self.__task_sizes[task_name] -= size
+        self.__size -= size
+
+    def __evict(self, task_name):
+        # Evict the least recently used values of the task, and then of all tasks.
+        while self.__task_sizes[task_name] > self.__task_limit:
+            self.delete(*self.__least_recently_used(task_name))
+        while self.__size > self.__core_limit:
+            self.delete(*self.__least_recently_used())
+
+    def __least_recently_used(self, task_name = None):
+        oldest = None
+        for entry_key, entry in self.__entries.iteritems():
+            if task_name != None and entry_key[0] != task_name:
+                continue
+            if oldest == None or entry[2] < oldest[1]:
+                oldest = (entry_key, entry[2])
+        return oldest[0]
+
+    def invalidate(self, task_name):
+        """Drops the state of a task. Its setup is run again before the next execution."""
+        for entry_key in [entry_key for entry_key in self.__entries if entry_key[0] == task_name]:
+            self.delete(*entry_key)
+        self.__ready.discard(task_name)
+
+    def prepare(self, task_name, module):
+        """
+        Prepares a task module for an execution. If the code of the task has
+        changed the module is reloaded and the state is dropped. The setup()
+        function of the module, if any, is run once.
+        @rtype: module
+        @return: The task module.
+        """
+        mtime = source_mtime(module)
+        if self.__versions.get(task_name, mtime) != mtime:
+            self.__versions[task_name] = mtime
+            self.invalidate(task_name)
+            module = reload(module)
+        self.__versions[task_name] = mtime
+
+        while task_name not in self.__ready:
+            # Only one tasklet runs the setup. The others wait for it.
+            if self.__setting_up.has_key(task_name):
+                self.__setting_up[task_name].receive()
+                continue
+            setup = module.__dict__.get('setup')
+            if setup == None:
+                self.__ready.add(task_name)
+                break
+            channel = stackless.channel()
+            self.__setting_up[task_name] = channel
+            try:
+                setup()
+                self.__ready.add(task_name)
+            finally:
+                del self.__setting_up[task_name]
+                while channel.balance < 0:
+                    channel.send(None)
+        return module
+
+# The state of the tasks of the current process.
+_store = None
+
+def get_store():
+    global _store
+    if _store == None:
+        _store = StateStore()
+    return _store
@@ -0,0 +1,166 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This file contains the zygote: a process that loads the preloaded modules
+and tasks and then forks the core schedulers. The cores share the memory of
+the modules copy-on-write and start out warm, while the code of the tasks is
+never run in the daemon itself.
+"""
+
+from multiprocessing import Process, Queue, active_children
+from Queue import Empty
+from corescheduler import CoreScheduler
+from time import time
+import logging
+import signal
+import os
+
+def preload(modules, tasks, basedir):
+    """Imports the given modules and tasks into the current process."""
+    logger = logging.getLogger('zygote')
+    for name in modules:
+        try:
+            __import__(name)
+        except ImportError:
+            logger.warning('Error preloading module %s.'%name)
+    for task_name in tasks:
+        try:
+            __import__(basedir + '.tasks.' + task_name, {}, {}, ['perform'], 0)
+        except Exception: #IGNORE:W0703
+            logger.exception('Error preloading task %s.'%task_name)
+
+class ForkedCore(object):
+    """Stands in for a core scheduler process forked by the zygote."""
+
+    def __init__(self, pid, zygote_pid):
+        super(ForkedCore, self).__init__()
+        self.pid = pid
+        self.zygote_pid = zygote_pid
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+class Zygote(Process):
+    """
+    Loads the preloaded modules and tasks, and forks a core scheduler for
+    each of the given IPC handles. The zygote stays around as the parent of
+    the cores, and forks replacements of cores that die on request.
+    """
+
+    # The number of seconds between checks for cores that have exited.
+    REAP_INTERVAL = 1.0
+
+    def __init__(self, eipc_handles, basedir, checkpoint_dir = None, checkpoint_interval = 60.0,
+                 modules = (), tasks = (), spare_handles = ()):
+        """
+        Constructor.
+        @type eipc_handles: list of eipc.EIPC
+        @param eipc_handles: The IPC handles of the cores, one per core.
+        @type spare_handles: list of eipc.EIPC
+        @param spare_handles: IPC handles for cores forked later on, see fork_core.
+        @type modules: list of str
+        @param modules: The modules to load.
+        @type tasks: list of str
+        @param tasks: The installed tasks to load.
+        See CoreScheduler for the other parameters.
+        """
+        super(Zygote, self).__init__()
+        self.__eipc_handles = eipc_handles
+        self.__basedir = basedir
+        self.__checkpoint_dir = checkpoint_dir
+        self.__checkpoint_interval = checkpoint_interval
+        self.__modules = modules
+        self.__tasks = tasks
+        self.__spare_handles = spare_handles
+        self.__requests = Queue()
+        self.__reports = Queue()
+
+    def run(self):
+        preload(self.__modules, self.__tasks, self.__basedir)
+        self.__reports.put('preloaded')
+        for eipc_handle in self.__eipc_handles:
+            self.__reports.put(self.__fork(eipc_handle))
+        while True:
+            try:
+                spare = self.__requests.get(True, Zygote.REAP_INTERVAL)
+                self.__reports.put(self.__fork(self.__spare_handles[spare]))
+            except Empty:
+                pass
+            # Reap the cores that have exited.
+            active_children()
+
+    def __fork(self, eipc_handle):
+        core = CoreScheduler(eipc_handle, self.__basedir, self.__checkpoint_dir,
+                             self.__checkpoint_interval)
+        core.start()
+        return core.pid
+
+    def fork_core(self, spare, timeout):
+        """
+        Forks a core scheduler, e.g., to replace one that has died.
+        @type spare: int
+        @param spare: The index of the spare IPC handle that the core uses.
+        Each spare handle may only be used once.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait for the core.
+        @rtype: ForkedCore
+        @return: The core, or None if the zygote did not fork it in time.
+        """
+        self.__requests.put(spare)
+        try:
+            return ForkedCore(self.__reports.get(True, timeout), self.pid)
+        except Empty:
+            return None
+
+    def wait_for_cores(self, timeout):
+        """
+        Waits for the zygote to load the modules and fork the cores. If it
+        takes too long, e.g., because the code of a task never returns, the
+        zygote is killed along with the cores it has forked.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait.
+        @rtype: list of ForkedCore
+        @return: The cores, or None if the zygote was killed.
+        """
+        deadline = time() + timeout
+        cores = []
+        try:
+            if self.__reports.get(True, timeout) == 'preloaded':
+                for _ in self.__eipc_handles:
+                    pid = self.__reports.get(True, max(0.0, deadline - time()))
+                    cores.append(ForkedCore(pid, self.pid))
+                return cores
+        except Empty:
+            pass
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.join()
+        # Cores forked just before the zygote was killed are killed as well.
+        while True:
+            try:
+                report = self.__reports.get_nowait()
+            except Empty:
+                break
+            if report != 'preloaded':
+                cores.append(ForkedCore(report, self.pid))
+        for core in cores:
+            core.terminate()
+        return None
@@ -0,0 +1,89 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the admission control of the surrogates."""
+
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontends'))
+from admission import AdmissionControl, Overloaded
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def assertOverloaded(self, admission, task_name, timeout = None, client_id = None):
+        try:
+            admission.admit(task_name, timeout, client_id)
+        except Overloaded, error:
+            self.assertTrue(error.retry_after >= AdmissionControl.MIN_RETRY)
+            return error.reason
+        self.fail('The task was admitted.')
+
+    def test_unlimited(self):
+        admission = AdmissionControl(2)
+        for _ in range(0, 100):
+            admission.admit('t', client_id = 'c')
+        self.assertEqual(admission.snapshot()['running'], 100)
+
+    def test_queue_depth(self):
+        admission = AdmissionControl(2, queue_depth = 2)
+        for _ in range(0, 4):
+            admission.admit('t')
+        self.assertEqual(self.assertOverloaded(admission, 't'), 'queue full')
+        admission.release('t')
+        admission.admit('t')
+        self.assertEqual(admission.snapshot()['rejected']['queue'], 1)
+
+    def test_client_limit(self):
+        admission = AdmissionControl(2, client_limit = 1)
+        admission.admit('t', client_id = 'a')
+        self.assertEqual(self.assertOverloaded(admission, 't', client_id = 'a'), 'client limit reached')
+        admission.admit('t', client_id = 'b')
+        # Clients that do not identify themselves are not limited.
+        admission.admit('t')
+        admission.admit('t')
+        admission.release('t', 'a')
+        admission.admit('t', client_id = 'a')
+        self.assertEqual(admission.snapshot()['clients'], 2)
+
+    def test_deadline(self):
+        admission = AdmissionControl(1)
+        admission.admit('slow')
+        admission.release('slow', duration = 10.0)
+        # The core is idle, but the task takes longer than the client waits.
+        self.assertTrue(self.assertOverloaded(admission, 'slow', timeout = 5.0).startswith('not expected'))
+        admission.admit('slow', timeout = 15.0)
+        # Now the task would have to wait for the running one as well.
+        self.assertOverloaded(admission, 'slow', timeout = 15.0)
+        admission.admit('unknown', timeout = 15.0)
+
+    def test_running_averages(self):
+        admission = AdmissionControl(1)
+        admission.admit('t')
+        admission.release('t', duration = 1.0)
+        admission.admit('t')
+        admission.release('t', duration = 2.0)
+        self.assertAlmostEqual(admission.snapshot()['mean_duration'], 1.2)
+        admission.admit('t')
+        admission.admit('t')
+        self.assertAlmostEqual(admission.predicted_wait(), 2.4)
+        admission.release('t')
+        admission.release('t')
+        self.assertEqual(admission.snapshot()['running'], 0)
+        self.assertAlmostEqual(admission.snapshot()['mean_duration'], 1.2)
+
+if __name__ == '__main__':
+    unittest.main()
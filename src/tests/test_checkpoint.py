@@ -0,0 +1,122 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the checkpointing of long-running executions."""
+
+from __future__ import with_statement
+from tempfile import mkdtemp
+from threading import Event
+from time import time, sleep
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pexecenv'))
+try:
+    from corescheduler import CoreScheduler, checkpoint_path, checkpoint_execid
+except ImportError:
+    # Stackless is not installed.
+    CoreScheduler = None
+try:
+    from scheduler import Scheduler
+except ImportError:
+    # Stackless or eipc is not installed.
+    Scheduler = None
+
+# A task that runs until it is stopped.
+LONG_TASK = """
+def perform():
+    i = 0
+    while True:
+        i += 1
+"""
+
+def install_task(directory, basedir, task_name, code):
+    """Installs a task in a task tree of its own below the given directory."""
+    tasks = os.path.join(directory, basedir, 'tasks')
+    if not os.path.isdir(tasks):
+        os.makedirs(tasks)
+        for package in (os.path.join(directory, basedir), tasks):
+            open(os.path.join(package, '__init__.py'), 'w').close()
+    with open(os.path.join(tasks, task_name + '.py'), 'w') as f:
+        f.write(code)
+
+class Jailor(object):
+    """Collects the results that the scheduler hands to the Jailor."""
+
+    def __init__(self):
+        super(Jailor, self).__init__()
+        self.results = {}
+        self.done = Event()
+
+    def task_callback(self, execid, rcode, opt):
+        self.results[execid] = (rcode, opt)
+        self.done.set()
+
+@unittest.skipIf(CoreScheduler == None, 'stackless is not installed')
+class CheckpointPathTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        path = checkpoint_path('checkpoints', 42)
+        self.assertEqual(os.path.dirname(path), 'checkpoints')
+        self.assertEqual(checkpoint_execid(os.path.basename(path)), 42)
+
+    def test_other_files(self):
+        self.assertEqual(checkpoint_execid('execid'), None)
+        self.assertEqual(checkpoint_execid('execid.tmp'), None)
+        self.assertEqual(checkpoint_execid('42.tasklet.tmp'), None)
+        self.assertEqual(checkpoint_execid('x.tasklet'), None)
+
+@unittest.skipIf(Scheduler == None, 'stackless or eipc is not installed')
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.checkpoints = os.path.join(self.directory, 'checkpoints')
+        install_task(self.directory, 'checkpointtasks', 'longtask', LONG_TASK)
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory, True)
+
+    def test_stop_writes_checkpoints(self):
+        scheduler = Scheduler(Jailor(), 1, 'checkpointtasks', self.checkpoints, 3600.0)
+        execid = scheduler.schedule('longtask', ())
+        # Let the task be pre-empted, which makes it a candidate.
+        sleep(1.0)
+        start = time()
+        scheduler.stop()
+        self.assertTrue(time() - start < CoreScheduler.CHECKPOINT_TIMEOUT)
+        self.assertTrue(os.path.exists(checkpoint_path(self.checkpoints, execid)))
+
+    def test_checkpoints_are_resumed(self):
+        scheduler = Scheduler(Jailor(), 1, 'checkpointtasks', self.checkpoints, 3600.0)
+        execid = scheduler.schedule('longtask', ())
+        sleep(1.0)
+        scheduler.stop()
+        jailor = Jailor()
+        scheduler = Scheduler(jailor, 1, 'checkpointtasks', self.checkpoints, 3600.0)
+        try:
+            # The resumed execution is not given the id of a new one.
+            self.assertNotEqual(scheduler.schedule('longtask', ()), execid)
+        finally:
+            scheduler.stop()
+        self.assertTrue(os.path.exists(checkpoint_path(self.checkpoints, execid)))
+        self.assertEqual(jailor.results, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the copy-on-write peer snapshots of the context."""
+
+from threading import Thread
+from time import time
+import unittest
+import sys
+import os
+
+_src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(_src)
+sys.path.append(os.path.join(_src, 'frontends', 'dynamic'))
+try:
+    from context import Context, ScavengerPeer
+except ImportError:
+    # The presence and eipc packages are not installed.
+    Context = None
+
+def peer(name, active_tasks = 0, age = 0.0):
+    peer = ScavengerPeer(name, ('127.0.0.1', 1000), 1.0, 2, active_tasks, 1000)
+    peer.timestamp -= age
+    return peer
+
+@unittest.skipIf(Context == None, 'presence or eipc is not installed')
+class ContextTest(unittest.TestCase):
+
+    def test_snapshots_are_not_modified(self):
+        context = Context()
+        context.add(peer('a'))
+        snapshot = context.get_snapshot()
+        context.add(peer('b'))
+        context.add(peer('a', active_tasks = 1))
+        self.assertEqual(snapshot.peers.keys(), ['a'])
+        self.assertEqual(snapshot.peers['a'].active_tasks, 0)
+        self.assertEqual(sorted(context.get_snapshot().peers.keys()), ['a', 'b'])
+        self.assertEqual(context.get_peer('a').active_tasks, 1)
+
+    def test_versions(self):
+        context = Context()
+        self.assertEqual(context.get_version(), 0)
+        context.add(peer('a'))
+        self.assertEqual(context.get_version(), 1)
+        context.add(peer('a', active_tasks = 1))
+        self.assertEqual(context.get_version(), 2)
+        # Announcing the same state again only refreshes the liveness.
+        snapshot = context.get_snapshot()
+        refreshed = peer('a', active_tasks = 1)
+        context.add(refreshed)
+        self.assertEqual(context.get_version(), 2)
+        self.assertEqual(snapshot.peers['a'].expires, refreshed.expires)
+
+    def test_activity_changes_publish_a_copy(self):
+        context = Context()
+        context.add(peer('a'))
+        snapshot = context.get_snapshot()
+        context.increment_peer_activity('a')
+        self.assertEqual(snapshot.peers['a'].active_tasks, 0)
+        self.assertEqual(context.get_peer('a').active_tasks, 1)
+        context.decrement_peer_activity('a')
+        context.decrement_peer_activity('a')
+        self.assertEqual(context.get_peer('a').active_tasks, 0)
+
+    def test_expiry(self):
+        context = Context(timeout = 1.0)
+        context.add(peer('a', age = 2.0))
+        context.add(peer('b'))
+        self.assertEqual([p.name for p in context.get_peers()], ['b'])
+        context.expire()
+        self.assertFalse(context.has_peer('a'))
+        self.assertTrue(context.has_peer('b'))
+
+    def test_events_are_delivered_in_order(self):
+        context = Context(timeout = 1.0)
+        events = []
+        context.add_listener(lambda event, p: events.append((event, p.name)))
+        context.add(peer('a', age = 2.0))
+        context.add(peer('b'))
+        context.add(peer('b', active_tasks = 1))
+        self.assertEqual(events, [('added', 'a'), ('expired', 'a'), ('added', 'b'), ('changed', 'b')])
+
+    def test_readers_do_not_take_the_lock(self):
+        context = Context()
+        context.add(peer('a'))
+        results = []
+        context._lock.acquire()
+        try:
+            reader = Thread(target=lambda: results.append((context.get_peers(), context.get_peer('a'),
+                                                          context.get_snapshot())))
+            reader.daemon = True
+            reader.start()
+            reader.join(5.0)
+        finally:
+            context._lock.release()
+        self.assertEqual(len(results), 1)
+
+    def test_concurrent_readers_and_writers(self):
+        context = Context()
+        errors = []
+        deadline = time() + 1.0
+        def write(prefix):
+            i = 0
+            while time() < deadline:
+                context.add(peer('%s%i'%(prefix, i % 50), active_tasks = i))
+                i += 1
+        def read():
+            try:
+                while time() < deadline:
+                    for p in context.get_peers():
+                        p.name
+                    snapshot = context.get_snapshot()
+                    for name in snapshot.peers:
+                        snapshot.peers[name]
+            except Exception, error: #IGNORE:W0703
+                errors.append(error)
+        threads = [Thread(target=write, args=(prefix,)) for prefix in 'ab'] + \
+                  [Thread(target=read) for _ in range(0, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(context.get_peers()), 100)
+
+if __name__ == '__main__':
+    unittest.main()
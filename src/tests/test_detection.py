@@ -0,0 +1,90 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the detection of the resources of the surrogate."""
+
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontends'))
+import detection
+
+class DetectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {}
+        self.saved = (detection._read_file, detection.affinity_cpus, detection.cpu_count)
+        detection._read_file = self.files.get
+
+    def tearDown(self):
+        detection._read_file, detection.affinity_cpus, detection.cpu_count = self.saved
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(detection.parse_cpu_list('0'), 1)
+        self.assertEqual(detection.parse_cpu_list('0-3,6'), 5)
+        self.assertEqual(detection.parse_cpu_list('0-1, 4-5,'), 4)
+        self.assertRaises(ValueError, detection.parse_cpu_list, '0-x')
+
+    def test_affinity_cpus(self):
+        self.assertEqual(detection.affinity_cpus(), None)
+        self.files['/proc/self/status'] = 'Name:\tpython\nCpus_allowed_list:\t0-2,7\n'
+        self.assertEqual(detection.affinity_cpus(), 4)
+
+    def test_quota_cgroup_v2(self):
+        self.files['/sys/fs/cgroup/cpu.max'] = 'max 100000'
+        self.assertEqual(detection.quota_cpus(), None)
+        self.files['/sys/fs/cgroup/cpu.max'] = '150000 100000'
+        self.assertEqual(detection.quota_cpus(), 1.5)
+
+    def test_quota_cgroup_v1(self):
+        self.assertEqual(detection.quota_cpus(), None)
+        self.files['/sys/fs/cgroup/cpu/cpu.cfs_quota_us'] = '-1'
+        self.files['/sys/fs/cgroup/cpu/cpu.cfs_period_us'] = '100000'
+        self.assertEqual(detection.quota_cpus(), None)
+        self.files['/sys/fs/cgroup/cpu/cpu.cfs_quota_us'] = '200000'
+        self.assertEqual(detection.quota_cpus(), 2.0)
+
+    def test_usable_cpus(self):
+        detection.affinity_cpus = lambda: None
+        detection.cpu_count = lambda: 8
+        self.assertEqual(detection.usable_cpus(), 8)
+        detection.affinity_cpus = lambda: 4
+        self.assertEqual(detection.usable_cpus(), 4)
+        self.files['/sys/fs/cgroup/cpu.max'] = '150000 100000'
+        self.assertEqual(detection.usable_cpus(), 2)
+        self.files['/sys/fs/cgroup/cpu.max'] = '10000 100000'
+        self.assertEqual(detection.usable_cpus(), 1)
+
+    def test_link_speed(self):
+        listdir = os.listdir
+        os.listdir = lambda path: ['lo', 'eth0', 'eth1', 'wlan0']
+        try:
+            self.assertEqual(detection.link_speed(), None)
+            for interface, state, speed in (('lo', 'up', None), ('eth0', 'up', '100'),
+                                            ('eth1', 'down', '1000'), ('wlan0', 'up', '-1')):
+                self.files['/sys/class/net/%s/operstate'%interface] = state
+                self.files['/sys/class/net/%s/speed'%interface] = speed
+            self.assertEqual(detection.link_speed(), 100 * 1000000 / 8 * 0.75)
+        finally:
+            os.listdir = listdir
+
+    def test_process_exists(self):
+        self.assertTrue(detection.process_exists(os.getpid()))
+        # Process ids are never this large.
+        self.assertFalse(detection.process_exists(2 ** 30))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the cache and resolver of task input data handles."""
+
+from threading import Event
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontends'))
+try:
+    from handlecache import HandleCache, HandleResolver, handle_key, data_size
+    from workerpool import WorkerPool
+except ImportError:
+    # The datastore package is not installed.
+    HandleCache = None
+
+class Handle(object):
+    def __init__(self, data_id, address = 'peer'):
+        super(Handle, self).__init__()
+        self.id = data_id
+        self.address = address
+
+@unittest.skipIf(HandleCache == None, 'datastore is not installed')
+class HandleCacheTest(unittest.TestCase):
+
+    def test_miss(self):
+        cache = HandleCache(100)
+        self.assertTrue(cache.get('a') is HandleCache.MISS)
+
+    def test_put_get(self):
+        cache = HandleCache(100)
+        cache.put('a', 'x' * 10)
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        self.assertEqual(cache.size(), 10)
+
+    def test_replace(self):
+        cache = HandleCache(100)
+        cache.put('a', 'x' * 10)
+        cache.put('a', 'y' * 20)
+        self.assertEqual(cache.get('a'), 'y' * 20)
+        self.assertEqual(cache.size(), 20)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = HandleCache(30)
+        cache.put('a', 'a' * 10)
+        cache.put('b', 'b' * 10)
+        cache.put('c', 'c' * 10)
+        cache.get('a')
+        cache.put('d', 'd' * 10)
+        self.assertTrue(cache.get('b') is HandleCache.MISS)
+        for key in ('a', 'c', 'd'):
+            self.assertEqual(cache.get(key), key * 10)
+        self.assertEqual(cache.size(), 30)
+
+    def test_oversized_data_is_not_cached(self):
+        cache = HandleCache(30)
+        cache.put('a', 'a' * 10)
+        cache.put('b', 'b' * 31)
+        self.assertTrue(cache.get('b') is HandleCache.MISS)
+        self.assertEqual(cache.get('a'), 'a' * 10)
+
+    def test_expired_entries_miss(self):
+        cache = HandleCache(100, timeout = -1.0)
+        cache.put('a', 'a' * 10)
+        self.assertTrue(cache.get('a') is HandleCache.MISS)
+        self.assertEqual(cache.size(), 0)
+
+    def test_retain(self):
+        cache = HandleCache(100, timeout = -1.0)
+        cache.put('a', 'a' * 10)
+        cache.retain('a', 60.0)
+        self.assertEqual(cache.get('a'), 'a' * 10)
+
+    def test_expire(self):
+        cache = HandleCache(100)
+        cache.put('a', 'a' * 10)
+        cache.expire('a')
+        self.assertTrue(cache.get('a') is HandleCache.MISS)
+        self.assertEqual(cache.size(), 0)
+        # Expiring an unknown key is harmless.
+        cache.expire('b')
+
+    def test_cleanup(self):
+        cache = HandleCache(100)
+        cache.put('a', 'a' * 10)
+        cache.put('b', 'b' * 10)
+        cache.retain('a', -1.0)
+        cache.cleanup()
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size(), 10)
+        self.assertEqual(cache.get('b'), 'b' * 10)
+
+    def test_size_of_contained_data(self):
+        self.assertTrue(data_size({'b' : 'b' * 10 ** 5}) > 10 ** 5)
+        self.assertTrue(data_size(['x' * 10 ** 5] * 3) > 3 * 10 ** 5)
+        self.assertTrue(data_size([('x' * 10 ** 5, Handle('x' * 10 ** 5))]) > 2 * 10 ** 5)
+        # Data that refers to itself is counted once per level.
+        data = []
+        data.append(data)
+        self.assertTrue(data_size(data) > 0)
+
+    def test_sizes(self):
+        cache = HandleCache(100)
+        self.assertEqual(cache.get_size('a'), None)
+        cache.put_size('a', 1000)
+        # The size is known even though the data is not cached.
+        self.assertEqual(cache.get_size('a'), 1000)
+        self.assertTrue(cache.get('a') is HandleCache.MISS)
+        cache.expire('a')
+        self.assertEqual(cache.get_size('a'), None)
+
+    def test_sizes_are_bounded(self):
+        cache = HandleCache(100)
+        for i in range(0, HandleCache.MAX_SIZES + 1):
+            cache.put_size(i, i)
+        self.assertEqual(cache.get_size(0), None)
+        self.assertEqual(cache.get_size(HandleCache.MAX_SIZES), HandleCache.MAX_SIZES)
+
+    def test_handle_key(self):
+        self.assertEqual(handle_key(Handle('1')), handle_key(Handle('1')))
+        self.assertNotEqual(handle_key(Handle('1')), handle_key(Handle('1', 'other')))
+
+@unittest.skipIf(HandleCache == None, 'datastore is not installed')
+class HandleResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fetches = []
+        self.release = Event()
+        self.release.set()
+        self.resolver = HandleResolver(self.fetch, HandleCache(100), WorkerPool(2))
+
+    def tearDown(self):
+        self.release.set()
+        self.resolver.shutdown()
+
+    def fetch(self, handle):
+        self.fetches.append(handle.id)
+        self.release.wait()
+        return 'data of %s'%handle.id
+
+    def test_resolve_caches(self):
+        self.assertEqual(self.resolver.resolve(Handle('1')).wait(5.0), 'data of 1')
+        self.assertEqual(self.resolver.resolve(Handle('1')).wait(5.0), 'data of 1')
+        self.assertEqual(self.fetches, ['1'])
+
+    def test_concurrent_resolves_share_a_fetch(self):
+        self.release.clear()
+        first = self.resolver.resolve(Handle('1'))
+        second = self.resolver.resolve(Handle('1'))
+        self.release.set()
+        self.assertEqual(first.wait(5.0), 'data of 1')
+        self.assertEqual(second.wait(5.0), 'data of 1')
+        self.assertEqual(self.fetches, ['1'])
+
+    def test_input_without_handles(self):
+        self.assertEqual(self.resolver.resolve_input((1, 'a')), None)
+        self.assertEqual(self.resolver.resolve_input({'a' : 1}), None)
+
+if __name__ == '__main__':
+    unittest.main()
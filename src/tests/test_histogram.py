@@ -0,0 +1,99 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the latency histograms."""
+
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontends'))
+from histogram import Histogram, LatencyStats
+
+class HistogramTest(unittest.TestCase):
+
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50.0), None)
+        self.assertEqual(histogram.to_dict()['count'], 0)
+
+    def test_buckets(self):
+        histogram = Histogram()
+        histogram.add(0.75)
+        histogram.add(1.0)
+        # 0.75 is at most 2**0 and 1.0 at most 2**1.
+        self.assertEqual(histogram.buckets[-Histogram.MIN_EXPONENT], 1)
+        self.assertEqual(histogram.buckets[-Histogram.MIN_EXPONENT + 1], 1)
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(histogram.sum, 1.75)
+        self.assertEqual((histogram.min, histogram.max), (0.75, 1.0))
+
+    def test_out_of_range(self):
+        histogram = Histogram()
+        histogram.add(-0.5)
+        histogram.add(1e-9)
+        histogram.add(10000.0)
+        self.assertEqual(histogram.buckets[0], 2)
+        self.assertEqual(histogram.buckets[-1], 1)
+        self.assertEqual(histogram.min, 0.0)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for _ in range(0, 99):
+            histogram.add(0.001)
+        histogram.add(3.0)
+        self.assertTrue(0.001 <= histogram.percentile(50.0) < 0.002)
+        self.assertTrue(0.001 <= histogram.percentile(99.0) < 0.002)
+        self.assertEqual(histogram.percentile(100.0), 3.0)
+
+    def test_percentile_of_last_bucket_is_the_maximum(self):
+        histogram = Histogram()
+        histogram.add(10000.0)
+        self.assertEqual(histogram.percentile(50.0), 10000.0)
+
+class LatencyStatsTest(unittest.TestCase):
+
+    def test_record_execution(self):
+        stats = LatencyStats()
+        timings = {'received' : 1.0, 'started' : 1.5, 'input' : 2.0, 'finished' : 3.0,
+                   'sent' : 3.25, 'core' : 'core-0'}
+        stats.record_execution('t', 0.5, timings, 3.5)
+        snapshot = stats.snapshot()['t']
+        self.assertEqual(sorted(snapshot.keys()), ['callback', 'dispatch', 'execute', 'queue'])
+        self.assertEqual(snapshot['dispatch']['sum'], 0.5)
+        self.assertEqual(snapshot['queue']['sum'], 0.5)
+        self.assertEqual(snapshot['execute']['sum'], 1.0)
+        self.assertEqual(snapshot['callback']['sum'], 0.25)
+        self.assertEqual(stats.core_snapshot(), {'core-0' : (1, 1.0)})
+
+    def test_incomplete_execution(self):
+        stats = LatencyStats()
+        stats.record_execution('t', 0.5, {'received' : 1.0}, 3.5)
+        stats.record_execution('t', 0.5, None, 3.5)
+        self.assertEqual(sorted(stats.snapshot()['t'].keys()), ['dispatch'])
+        self.assertEqual(stats.core_snapshot(), {})
+
+    def test_export_text(self):
+        stats = LatencyStats()
+        stats.record('t', 'resolve', 0.75)
+        stats.record('t', 'resolve', 1000.0)
+        lines = stats.export_text().splitlines()
+        self.assertTrue('scavenger_stage_seconds_bucket{task="t",stage="resolve",le="1"} 1' in lines)
+        self.assertTrue('scavenger_stage_seconds_bucket{task="t",stage="resolve",le="+Inf"} 2' in lines)
+        self.assertTrue('scavenger_stage_seconds_count{task="t",stage="resolve"} 2' in lines)
+        self.assertEqual(len([line for line in lines if 'le="+Inf"' in line]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
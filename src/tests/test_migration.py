@@ -0,0 +1,157 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the migration of tasklets between core schedulers."""
+
+from tempfile import mkdtemp
+from time import time, sleep
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pexecenv'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    from corescheduler import movable_tasklets
+except ImportError:
+    # Stackless is not installed.
+    movable_tasklets = None
+try:
+    from scheduler import Scheduler
+except ImportError:
+    # Stackless or eipc is not installed.
+    Scheduler = None
+from test_checkpoint import install_task
+
+# A task that runs for a while and tells which processes it ran in. Tasks
+# that swallow every exception must not be performed twice either.
+LONG_TASK = """
+import os
+
+def perform(iterations):
+    started = os.getpid()
+    i = 0
+    try:
+        while i < iterations:
+            i += 1
+    except:
+        pass
+    return (started, os.getpid())
+"""
+
+# A long task holding something that cannot be pickled.
+PINNED_TASK = """
+import os
+import thread
+
+def perform(iterations):
+    started = os.getpid()
+    lock = thread.allocate_lock()
+    i = 0
+    while i < iterations:
+        i += 1
+    return (started, os.getpid())
+"""
+
+SHORT_TASK = """
+def perform():
+    return None
+"""
+
+class Tasklet(object):
+    def __init__(self, alive = True, blocked = False):
+        super(Tasklet, self).__init__()
+        self.alive = alive
+        self.blocked = blocked
+
+class Jailor(object):
+    """Records every result that the scheduler hands to the Jailor."""
+
+    def __init__(self):
+        super(Jailor, self).__init__()
+        self.results = []
+
+    def task_callback(self, execid, rcode, opt):
+        self.results.append((execid, rcode, opt))
+
+@unittest.skipIf(movable_tasklets == None, 'stackless is not installed')
+class MovableTaskletsTest(unittest.TestCase):
+
+    def test_selection(self):
+        preempted, fresh, dead, blocked, pinned, awaiting, idle = [Tasklet() for _ in range(0, 7)]
+        dead.alive = False
+        blocked.blocked = True
+        sinners = {preempted : 3, fresh : 0, dead : 5, blocked : 5, pinned : 5, awaiting : 5, idle : 5}
+        executions = {preempted : 1, fresh : 2, dead : 3, blocked : 4, pinned : 5, awaiting : 6}
+        self.assertEqual(movable_tasklets(sinners, executions, set([pinned]), set([6])), 
+                         [(3, preempted)])
+
+    def test_killed_sinners(self):
+        tasklet = Tasklet()
+        self.assertEqual(movable_tasklets({tasklet : -1}, {tasklet : 1}, set(), set()), [])
+
+@unittest.skipIf(Scheduler == None, 'stackless or eipc is not installed')
+class MigrationTest(unittest.TestCase):
+
+    ITERATIONS = 20000000
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        for task_name, code in (('longtask', LONG_TASK), ('pinnedtask', PINNED_TASK), 
+                                ('shorttask', SHORT_TASK)):
+            install_task(self.directory, 'migrationtasks', task_name, code)
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory, True)
+
+    def perform(self, long_task):
+        jailor = Jailor()
+        scheduler = Scheduler(jailor, 2, 'migrationtasks')
+        try:
+            # The executions are spread over the cores in turn, so the first
+            # core is left with the long tasks when the short ones are done.
+            execids = []
+            for i in range(0, 6):
+                if i % 2 == 0:
+                    execids.append(scheduler.schedule(long_task, (MigrationTest.ITERATIONS,)))
+                else:
+                    scheduler.schedule('shorttask', ())
+            deadline = time() + 120
+            while len(jailor.results) < 6 and time() < deadline:
+                sleep(0.1)
+            # Give duplicate results a chance to show up.
+            sleep(0.5)
+        finally:
+            scheduler.stop()
+        self.assertEqual(len(jailor.results), 6)
+        self.assertEqual(len(set([execid for execid, _, _ in jailor.results])), 6)
+        return [opt['output'] for execid, rcode, opt in jailor.results 
+                if execid in execids and rcode == 'DONE']
+
+    def test_migration(self):
+        outputs = self.perform('longtask')
+        self.assertEqual(len(outputs), 3)
+        self.assertTrue(any([started != finished for started, finished in outputs]))
+
+    def test_unpicklable_tasklets_stay(self):
+        outputs = self.perform('pinnedtask')
+        self.assertEqual(len(outputs), 3)
+        self.assertTrue(all([started == finished for started, finished in outputs]))
+
+if __name__ == '__main__':
+    unittest.main()
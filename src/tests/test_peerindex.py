@@ -0,0 +1,96 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the ranking of peers by their estimated completion time."""
+
+from time import time
+import unittest
+import sys
+import os
+
+_src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(_src)
+sys.path.append(os.path.join(_src, 'frontends', 'dynamic'))
+try:
+    from context import PeerIndex
+except ImportError:
+    # The presence and eipc packages are not installed.
+    PeerIndex = None
+
+class Peer(object):
+    def __init__(self, name, net, cpu_strength, cpu_cores = 1, active_tasks = 0, expires = None):
+        super(Peer, self).__init__()
+        self.name = name
+        self.net = net
+        self.cpu_strength = cpu_strength
+        self.cpu_cores = cpu_cores
+        self.active_tasks = active_tasks
+        if expires == None:
+            expires = time() + 60
+        self.expires = expires
+
+@unittest.skipIf(PeerIndex == None, 'presence or eipc is not installed')
+class PeerIndexTest(unittest.TestCase):
+
+    def estimate(self, peer, input_bytes, complexity):
+        transfer, compute = PeerIndex.factors(peer)
+        return input_bytes * transfer + complexity * compute
+
+    def brute_force(self, peers, k, input_bytes, complexity):
+        return sorted([self.estimate(peer, input_bytes, complexity) for peer in peers])[:k]
+
+    def ranked(self, index, k, input_bytes, complexity, exclude = ()):
+        return [peer.name for _, peer in index.best_peers(k, input_bytes, complexity, exclude)]
+
+    def test_factors(self):
+        self.assertEqual(PeerIndex.factors(Peer('a', 100.0, 2.0, 2, 3)), (0.01, 4 / 4.0))
+        self.assertEqual(PeerIndex.factors(Peer('a', 0, 0)), (PeerIndex.UNUSABLE, PeerIndex.UNUSABLE))
+
+    def test_matches_brute_force(self):
+        peers = [Peer('p%i'%i, 10.0 * (i % 7 + 1), 1.0 + (i * 3) % 5, i % 4 + 1, i % 3)
+                 for i in range(0, 30)]
+        index = PeerIndex()
+        for peer in peers:
+            index.update('added', peer)
+        for input_bytes, complexity in ((0, 1.0), (1000, 0.0), (500, 10.0), (10 ** 6, 1.0)):
+            # Peers with the same estimate may be ranked in any order.
+            best = index.best_peers(5, input_bytes, complexity)
+            self.assertEqual([estimate for estimate, _ in best],
+                             self.brute_force(peers, 5, input_bytes, complexity))
+            for estimate, peer in best:
+                self.assertEqual(estimate, self.estimate(peer, input_bytes, complexity))
+
+    def test_changes_and_expiry(self):
+        index = PeerIndex()
+        index.update('added', Peer('a', 100.0, 1.0))
+        index.update('added', Peer('b', 100.0, 2.0))
+        self.assertEqual(self.ranked(index, 2, 0, 1.0), ['b', 'a'])
+        index.update('changed', Peer('b', 100.0, 2.0, 1, 3))
+        self.assertEqual(self.ranked(index, 2, 0, 1.0), ['a', 'b'])
+        index.update('expired', Peer('a', 100.0, 1.0))
+        self.assertEqual(self.ranked(index, 2, 0, 1.0), ['b'])
+
+    def test_exclude_and_stale_peers(self):
+        index = PeerIndex()
+        index.update('added', Peer('a', 100.0, 1.0))
+        index.update('added', Peer('b', 100.0, 2.0))
+        index.update('added', Peer('c', 100.0, 3.0, expires = time() - 1))
+        self.assertEqual(self.ranked(index, 3, 0, 1.0, exclude = ('b',)), ['a'])
+
+    def test_empty(self):
+        self.assertEqual(PeerIndex().best_peers(3, 100, 1.0), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the chunking, sharing and spilling of the surrogate data store."""
+
+from tempfile import mkdtemp
+import unittest
+import shutil
+import logging
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontends'))
+try:
+    from surrogatestore import SurrogateDataStore, content_digest, data_id_digest
+except ImportError:
+    # The datastore package is not installed.
+    SurrogateDataStore = None
+
+@unittest.skipIf(SurrogateDataStore == None, 'datastore is not installed')
+class SurrogateDataStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        # Failing to spill is logged, and expected here.
+        logging.getLogger('datastore').disabled = True
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def store(self, memory_budget = None):
+        return SurrogateDataStore('surrogate', memory_budget, self.directory)
+
+    def spilled(self):
+        return sum([len(files) for _, _, files in os.walk(self.directory)])
+
+    def test_digest_in_data_id(self):
+        store = self.store()
+        handle = store.store_data('hello')
+        self.assertEqual(data_id_digest(handle.id), content_digest('hello'))
+        self.assertEqual(store.fetch_data(handle.id), 'hello')
+
+    def test_identical_items_share_a_chunk(self):
+        store = self.store()
+        first = store.store_data('x' * 100)
+        second = store.store_data('x' * 100)
+        self.assertNotEqual(first.id, second.id)
+        store.expire(first.id)
+        self.assertEqual(store.fetch_data(second.id), 'x' * 100)
+        self.assertEqual(store.data_size(first.id), -1)
+
+    def test_contiguous_items(self):
+        store = self.store()
+        handles = store.store_many(('ab', 'cde', ''), contiguous = True)
+        self.assertEqual([store.fetch_data(handle.id) for handle in handles], ['ab', 'cde', ''])
+        self.assertEqual([store.data_size(handle.id) for handle in handles], [2, 3, 0])
+
+    def test_blob_with_the_content_of_an_item(self):
+        store = self.store()
+        item = store.store_data('abcd')
+        blob = store.store_many(('ab', 'cd'), contiguous = True)
+        store.expire(item.id)
+        self.assertEqual([store.fetch_data(handle.id) for handle in blob], ['ab', 'cd'])
+        item = store.store_data('abcd')
+        for handle in blob:
+            store.expire(handle.id)
+        self.assertEqual(store.fetch_data(item.id), 'abcd')
+
+    def test_resolve_by_content(self):
+        store = self.store()
+        other = self.store()
+        handle = other.store_data('shared')
+        self.assertFalse(store.has_data(handle))
+        store.store_data('shared')
+        self.assertTrue(store.has_data(handle))
+        self.assertEqual(store.resolve_data_handle(handle), 'shared')
+
+    def test_spill_least_recently_used(self):
+        store = self.store(250)
+        first = store.store_data('a' * 100)
+        second = store.store_data('b' * 100)
+        store.fetch_data(first.id)
+        store.store_data('c' * 100)
+        self.assertFalse(store.over_budget())
+        self.assertEqual(self.spilled(), 1)
+        self.assertEqual(store.fetch_data(second.id), 'b' * 100)
+        store.expire(second.id)
+        self.assertEqual(self.spilled(), 0)
+
+    def test_spill_pickled_data(self):
+        store = self.store(0)
+        handle = store.store_data({'b' : 'b' * 100})
+        self.assertEqual(self.spilled(), 1)
+        self.assertEqual(store.fetch_data(handle.id), {'b' : 'b' * 100})
+
+    def test_contained_data_counts_towards_the_budget(self):
+        store = self.store(15 * 10 ** 5)
+        first = store.store_data({'a' : 'a' * 10 ** 6})
+        self.assertTrue(store.data_size(first.id) > 10 ** 6)
+        self.assertEqual(self.spilled(), 0)
+        second = store.store_data(['b' * 10 ** 6])
+        self.assertFalse(store.over_budget())
+        self.assertEqual(self.spilled(), 1)
+        self.assertEqual(store.fetch_data(first.id), {'a' : 'a' * 10 ** 6})
+        self.assertEqual(store.fetch_data(second.id), ['b' * 10 ** 6])
+
+    def test_unpicklable_chunks_stay_in_memory(self):
+        store = self.store(10)
+        function = lambda: None
+        unpicklable = store.store_data(function)
+        text = store.store_data('c' * 100)
+        self.assertEqual(self.spilled(), 1)
+        self.assertTrue(store.fetch_data(unpicklable.id) is function)
+        self.assertEqual(store.fetch_data(text.id), 'c' * 100)
+
+    def test_cleanup_drops_expired_data(self):
+        store = self.store()
+        handle = store.store_data('old')
+        store.retain(handle.id, -1.0)
+        store.cleanup()
+        self.assertEqual(store.data_size(handle.id), -1)
+
+    def test_directories_of_dead_processes_are_removed(self):
+        self.store()
+        # Process ids are never this large.
+        os.mkdir(os.path.join(self.directory, '%i-dead'%(2 ** 30)))
+        self.store()
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all([name.startswith('%i-'%os.getpid()) for name in names]))
+
+if __name__ == '__main__':
+    unittest.main()
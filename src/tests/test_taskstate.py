@@ -0,0 +1,129 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the state kept by tasks between their executions."""
+
+from tempfile import mkdtemp
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pexecenv'))
+try:
+    from taskstate import StateStore, estimate_size
+except ImportError:
+    # Stackless is not installed.
+    StateStore = None
+
+@unittest.skipIf(StateStore == None, 'stackless is not installed')
+class StateStoreTest(unittest.TestCase):
+
+    def test_get_set_delete(self):
+        state = StateStore().state('t')
+        self.assertEqual(state.get('a'), None)
+        self.assertFalse('a' in state)
+        state['a'] = 1
+        self.assertEqual(state['a'], 1)
+        self.assertTrue('a' in state)
+        del state['a']
+        self.assertRaises(KeyError, lambda: state['a'])
+
+    def test_tasks_are_separate(self):
+        store = StateStore()
+        store.state('t').set('a', 1)
+        self.assertEqual(store.state('u').get('a'), None)
+        self.assertTrue(store.state('t') is store.state('t'))
+
+    def test_task_limit(self):
+        store = StateStore(task_limit = 100, core_limit = 1000)
+        state = store.state('t')
+        state.set('a', 'a', 40)
+        state.set('b', 'b', 40)
+        state.get('a')
+        state.set('c', 'c', 40)
+        self.assertEqual([key in state for key in 'abc'], [True, False, True])
+        store.state('u').set('a', 'a', 90)
+        self.assertTrue('a' in state)
+
+    def test_core_limit(self):
+        store = StateStore(task_limit = 100, core_limit = 150)
+        store.state('t').set('a', 'a', 60)
+        store.state('u').set('a', 'a', 60)
+        store.state('t').get('a')
+        store.state('v').set('a', 'a', 60)
+        self.assertEqual(['a' in store.state(task_name) for task_name in 'tuv'], [True, False, True])
+
+    def test_too_large(self):
+        state = StateStore(task_limit = 100).state('t')
+        self.assertRaises(MemoryError, state.set, 'a', 'a', 101)
+        self.assertTrue(estimate_size([]) < estimate_size(['x' * 100]))
+
+    def test_clear(self):
+        state = StateStore().state('t')
+        state['a'] = 1
+        state.clear()
+        self.assertFalse('a' in state)
+
+@unittest.skipIf(StateStore == None, 'stackless is not installed')
+class PrepareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        sys.path.insert(0, self.directory)
+        self.path = os.path.join(self.directory, 'statetask.py')
+        self.write("calls = []\ndef setup():\n    calls.append('v1')\n", 1000)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        sys.modules.pop('statetask', None)
+        shutil.rmtree(self.directory, True)
+
+    def write(self, code, mtime):
+        f = open(self.path, 'w')
+        try:
+            f.write(code)
+        finally:
+            f.close()
+        os.utime(self.path, (mtime, mtime))
+        for compiled in (self.path + 'c', self.path + 'o'):
+            if os.path.exists(compiled):
+                os.remove(compiled)
+
+    def test_setup_runs_once(self):
+        store = StateStore()
+        module = __import__('statetask')
+        module = store.prepare('statetask', module)
+        module = store.prepare('statetask', module)
+        self.assertEqual(module.calls, ['v1'])
+
+    def test_changed_code_is_reloaded(self):
+        store = StateStore()
+        module = store.prepare('statetask', __import__('statetask'))
+        store.state('statetask')['a'] = 1
+        self.write("calls = []\ndef setup():\n    calls.append('v2')\n", 2000)
+        module = store.prepare('statetask', module)
+        self.assertEqual(module.calls, ['v2'])
+        self.assertFalse('a' in store.state('statetask'))
+
+    def test_invalidate_runs_setup_again(self):
+        store = StateStore()
+        module = store.prepare('statetask', __import__('statetask'))
+        store.invalidate('statetask')
+        module = store.prepare('statetask', module)
+        self.assertEqual(module.calls, ['v1', 'v1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the zygote that preloads modules and forks the core schedulers."""
+
+from __future__ import with_statement
+from multiprocessing import Process
+from tempfile import mkdtemp
+from time import time, sleep
+import unittest
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pexecenv'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    from zygote import Zygote
+except ImportError:
+    # Stackless is not installed.
+    Zygote = None
+try:
+    from scheduler import Scheduler
+except ImportError:
+    # Stackless or eipc is not installed.
+    Scheduler = None
+from test_checkpoint import install_task, Jailor
+
+def running(pid):
+    """Checks whether a process exists and is not a zombie."""
+    try:
+        f = open('/proc/%i/stat'%pid)
+    except IOError:
+        return False
+    try:
+        return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    finally:
+        f.close()
+
+def wait_until_gone(pid, timeout = 5.0):
+    deadline = time() + timeout
+    while running(pid) and time() < deadline:
+        sleep(0.05)
+    return not running(pid)
+
+if Zygote != None:
+    class SleepingZygote(Zygote):
+        """
+        A zygote forking processes that sleep instead of core schedulers. The
+        ids of the processes are written to the file named by pidfile.
+        """
+        pidfile = os.devnull
+
+        def _Zygote__fork(self, eipc_handle):
+            process = Process(target=sleep, args=(60,))
+            process.start()
+            with open(self.pidfile, 'a') as f:
+                f.write('%i\n'%process.pid)
+            return process.pid
+
+    class StuckZygote(SleepingZygote):
+        """A zygote that gets stuck forking the core of the 'stuck' handle."""
+        def _Zygote__fork(self, eipc_handle):
+            if eipc_handle == 'stuck':
+                sleep(60)
+            return SleepingZygote._Zygote__fork(self, eipc_handle)
+
+@unittest.skipIf(Zygote == None, 'stackless is not installed')
+class ZygoteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        install_task(self.directory, 'zygotetasks', 'hangingtask', 'import time\ntime.sleep(60)\n')
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory, True)
+
+    def test_fork_cores(self):
+        zygote = SleepingZygote(['a', 'b'], 'zygotetasks', spare_handles = ['c'])
+        zygote.start()
+        try:
+            cores = zygote.wait_for_cores(10.0)
+            self.assertEqual(len(cores), 2)
+            replacement = zygote.fork_core(0, 10.0)
+            cores.append(replacement)
+            for core in cores:
+                self.assertEqual(core.zygote_pid, zygote.pid)
+                self.assertTrue(running(core.pid))
+            self.assertEqual(len(set([core.pid for core in cores])), 3)
+            for core in cores:
+                core.terminate()
+                self.assertTrue(wait_until_gone(core.pid))
+        finally:
+            zygote.terminate()
+            zygote.join()
+
+    def test_hanging_preload_is_killed(self):
+        zygote = SleepingZygote(['a', 'b'], 'zygotetasks', tasks = ['hangingtask'])
+        zygote.start()
+        start = time()
+        self.assertEqual(zygote.wait_for_cores(1.0), None)
+        self.assertTrue(time() - start < 5.0)
+        self.assertFalse(zygote.is_alive())
+
+    def test_cores_forked_before_the_timeout_are_killed(self):
+        zygote = StuckZygote(['a', 'stuck', 'b'], 'zygotetasks')
+        zygote.pidfile = os.path.join(self.directory, 'pids')
+        zygote.start()
+        self.assertEqual(zygote.wait_for_cores(2.0), None)
+        with open(zygote.pidfile) as f:
+            pids = [int(line) for line in f]
+        self.assertEqual(len(pids), 1)
+        for pid in pids:
+            self.assertTrue(wait_until_gone(pid))
+
+@unittest.skipIf(Scheduler == None, 'stackless or eipc is not installed')
+class RespawnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        install_task(self.directory, 'zygotetasks', 'shorttask', 'def perform():\n    return 42\n')
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory, True)
+
+    def test_respawned_cores_are_forked_by_the_zygote(self):
+        jailor = Jailor()
+        scheduler = Scheduler(jailor, 1, 'zygotetasks', preload_tasks = ['shorttask'])
+        try:
+            schedulers = scheduler._Scheduler__schedulers
+            zygote = scheduler._Scheduler__zygote
+            dead = schedulers[0][0]
+            self.assertEqual(dead.zygote_pid, zygote.pid)
+            dead.terminate()
+            self.assertTrue(wait_until_gone(dead.pid))
+            execid = scheduler.schedule('shorttask', ())
+            jailor.done.wait(10.0)
+            self.assertEqual(jailor.results[execid][0], 'DONE')
+            replacement = schedulers[0][0]
+            self.assertNotEqual(replacement.pid, dead.pid)
+            self.assertEqual(replacement.zygote_pid, zygote.pid)
+        finally:
+            scheduler.stop()
+
+if __name__ == '__main__':
+    unittest.main()